@@ -0,0 +1,249 @@
+"""Benchmarks for the quadtree matrix engine in nodes.py.
+
+Generates seeded synthetic matrices (varying max_depth, fill ratio and
+payload mix) and times the main engine operations plus headless
+rendering and code execution. Results are printed as a table on stderr
+and written as JSON, so runs from different versions can be compared:
+
+    python bench.py --output before.json
+    python bench.py --output after.json --compare before.json
+
+Use --quick for a smaller matrix of scenarios.
+"""
+import argparse
+import base64
+import copy
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Render without a window or sound device
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+from PIL import Image
+
+import nodes
+
+QUADTREE_SIZE = 512
+PALETTE = [0xE6194B, 0x3CB44B, 0xFFE119, 0x4363D8, 0xF58231, 0x911EB4, 0x46F0F0, 0xF032E6,
+           0xBCF60C, 0xFABEBE, 0x008080, 0xE6BEFF, 0x9A6324, 0xFFFAC8, 0x800000, 0xAAFFC3]
+PAYLOAD_MIXES = {
+    "none": (),
+    "text": ("text",),
+    "mixed": ("text", "code", "image"),
+}
+# Fraction of filled cells that also carry a payload, and a cap per layer
+PAYLOAD_RATIO = 0.02
+MAX_PAYLOADS_PER_LAYER = 500
+
+
+def make_image_data(rng: random.Random) -> str:
+    img = Image.new("RGB", (16, 16), tuple(rng.randrange(256) for _ in range(3)))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def make_payload(kind: str, rng: random.Random, image_data: str) -> dict:
+    if kind == "text":
+        return {"type": "text", "text": f"cell {rng.randrange(10000)}", "color": [0, 0, 0]}
+    if kind == "code":
+        lines = [f"x{i} = {rng.randrange(100)} * {i}" for i in range(rng.randrange(3, 30))]
+        return {"type": "code", "code": "\n".join(lines + ["print(x0)"]), "language": "python"}
+    return {"type": "image", "data": image_data}
+
+
+def make_matrix(engine: nodes.QuadtreeMatrix, max_depth: int, fill: float, mix: str, seed: int) -> nodes.Matrix:
+    """Build a reproducible synthetic matrix"""
+    rng = random.Random(seed)
+    image_data = make_image_data(rng)
+    matrix = engine.create_empty_matrix(QUADTREE_SIZE, max_depth)
+    kinds = PAYLOAD_MIXES[mix]
+    for d, layer in enumerate(matrix.layers):
+        cells = layer.size * layer.size
+        filled = rng.sample(range(cells), int(cells * fill))
+        colors = layer.nodes
+        for idx in filled:
+            colors[idx] = rng.choice(PALETTE)
+        if kinds:
+            count = min(MAX_PAYLOADS_PER_LAYER, max(1, int(len(filled) * PAYLOAD_RATIO)))
+            for idx in filled[:count]:
+                matrix.set_payload(d, idx, make_payload(rng.choice(kinds), rng, image_data))
+    matrix.invalidate_index()
+    return matrix
+
+
+def measure(fn, setup=None, repeat: int = 5) -> dict:
+    """Time fn over repeat runs, then measure its peak allocation once.
+
+    setup (if given) runs before each call, untimed, and its result is
+    passed to fn.
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - start)
+
+    arg = setup() if setup else None
+    tracemalloc.start()
+    fn(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "runs": repeat,
+        "peak_kib": peak / 1024,
+    }
+
+
+def bench_scenario(app: nodes.QuadtreeApp, max_depth: int, fill: float, mix: str, seed: int,
+                   repeat: int, tmp_dir: str) -> list:
+    scenario = {"max_depth": max_depth, "fill": fill, "payloads": mix}
+    engine = app.matrix
+    results = []
+
+    def record(op, stats, **extra):
+        results.append({"scenario": scenario, "op": op, **stats, **extra})
+
+    record("create_empty_matrix", measure(lambda _: engine.create_empty_matrix(QUADTREE_SIZE, max_depth), repeat=repeat))
+
+    matrix = make_matrix(engine, max_depth, fill, mix, seed)
+    engine.contexts["bench"] = matrix
+
+    for layer_format in (nodes.LAYER_COMPRESSED, nodes.LAYER_PLAIN):
+        path = os.path.join(tmp_dir, f"bench_{layer_format}.json")
+        stats = measure(lambda _: engine.save_json("bench", path, layer_format=layer_format), repeat=repeat)
+        record(f"save_json[{layer_format}]", stats, file_bytes=os.path.getsize(path))
+
+        def load(_):
+            ctx_id = engine.load_json(path, lazy=False)
+            del engine.contexts[ctx_id]
+        record(f"load_json[{layer_format}]", measure(load, repeat=repeat))
+
+    # Subdivide the whole top cell down to the deepest layer, on a fresh copy each run
+    def fresh_copy(_=None):
+        clone = copy.deepcopy(matrix)
+        clone.journal = nodes.Journal()
+        return clone
+    record("subdivide", measure(lambda m: m.subdivide_region(0, 0, 0, 1, 1, max_depth), fresh_copy, repeat=repeat))
+
+    engine.current_ctx = "bench"
+    for d in sorted({max_depth // 2, max_depth}):
+        app.current_depth = d
+        app.render_quadtree()  # warm the grid and font caches
+        record(f"render_quadtree[d={d}]", measure(lambda _: app.render_quadtree(), repeat=repeat))
+
+    engine.current_ctx = "default"
+    del engine.contexts["bench"]
+    return results
+
+
+def bench_executor(repeat: int, service_address: str = None) -> list:
+    executor = nodes.CodeExecutor()
+    executor.service_address = service_address
+    programs = {
+        "execute[noop]": "pass",
+        "execute[10k lines]": "for i in range(10000):\n    print('line', i)",
+    }
+    results = []
+    for op, code in programs.items():
+        stats = measure(lambda _: executor.execute(code, "python"), repeat=repeat)
+        results.append({"scenario": {}, "op": op, **stats})
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def result_key(result: dict) -> str:
+    scenario = result["scenario"]
+    label = " ".join(f"{k}={v}" for k, v in scenario.items())
+    return f"{result['op']} {label}".strip()
+
+
+def print_table(results: list, baseline: dict):
+    for result in results:
+        key = result_key(result)
+        line = f"{key:<60} {result['median_ms']:10.2f} ms {result['peak_kib']:10.0f} KiB"
+        old = baseline.get(key)
+        if old:
+            line += f"   x{result['median_ms'] / old['median_ms']:.2f} vs baseline"
+        print(line, file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the quadtree matrix engine")
+    parser.add_argument("--quick", action="store_true", help="run a reduced set of scenarios")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per operation")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--exec-service", help="host:port or unix:/path of an exec_service.py daemon to run the executor benchmarks on "
+                             "(its token is read from QUADTREE_EXEC_TOKEN)")
+    args = parser.parse_args()
+
+    depths = (4, 6) if args.quick else (4, 6, 8)
+    fills = (0.5,) if args.quick else (0.1, 0.5, 1.0)
+    mixes = ("none", "mixed") if args.quick else tuple(PAYLOAD_MIXES)
+
+    app = nodes.QuadtreeApp()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for max_depth in depths:
+            for fill in fills:
+                for mix in mixes:
+                    results += bench_scenario(app, max_depth, fill, mix, args.seed, args.repeat, tmp_dir)
+    results += bench_executor(args.repeat, args.exec_service)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "format_version": nodes.MATRIX_FORMAT_VERSION,
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "orjson": nodes.orjson is not None,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "quick": args.quick,
+            "exec_service": args.exec_service,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = {result_key(r): r for r in json.load(f)["results"]}
+    print_table(results, baseline)
+
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,705 @@
+"""Execution service for code cells.
+
+A local daemon that runs code on behalf of many CodeExecutor clients
+(set QUADTREE_EXEC_SERVICE=host:port before starting nodes.py). Requests
+are queued by priority, at most --workers run at once and at most
+--per-client of them for any one connection, and code runs in a pool of
+warm interpreters that are reused from job to job instead of paying for
+interpreter start-up and imports (see --preload) on every run.
+
+    python exec_service.py [--host 127.0.0.1] [--port 8766] [--workers N]
+                           [--per-client N] [--max-jobs-per-worker 50]
+                           [--preload numpy --preload PIL.Image]
+                           [--unix /path/to/socket]
+
+Anyone who can connect can run code as the service's user, so clients
+must authenticate. Over TCP they must present the shared token from
+QUADTREE_EXEC_TOKEN (or --token). If neither is set, one is generated
+and printed at start-up. With --unix the service listens on a Unix
+socket that only its own user may open (mode 0600), and a token is
+optional. Traffic is not encrypted, so binding --host beyond loopback
+prints a warning.
+
+The protocol is newline-delimited JSON. A client with a token sends it
+first:
+
+    {"type": "hello", "token": "..."}
+
+Client requests:
+
+    {"type": "run", "id": "1", "code": "...", "language": "python",
+     "priority": 0, "timeout": 5}
+    {"type": "batch", "jobs": [<run request>, ...]}
+    {"type": "cancel", "id": "1"}
+
+Service messages:
+
+    {"type": "queued", "id": "1", "position": 3}
+    {"type": "started", "id": "1"}
+    {"type": "output", "chunks": [["1", "stdout", "text"], ...]}
+    {"type": "done", "id": "1", "returncode": 0, "timed_out": false, "cancelled": false}
+    {"type": "error", "id": "1", "message": "..."}
+
+Errors that concern no single job (such as a failed hello, after which
+the connection is closed) carry "id": null.
+
+Output of all running jobs is collected and sent to each client in one
+message per --flush-interval instead of one message per write.
+
+Each job gets fresh globals. Afterwards the worker restores its working
+directory, os.environ, sys.path, sys.argv, the standard streams and
+sys.modules (modules the job imported are dropped again). A worker is
+only reused when that leaves it as it started. A job that rebinds an
+attribute of an already loaded module (json.dumps = ...) or leaves
+threads running gets its worker replaced. Workers are also replaced
+after --max-jobs-per-worker jobs and killed when a job times out or is
+cancelled. A worker only ever runs the jobs of one connection; another
+client gets a fresh one.
+
+This is not a sandbox. State the worker cannot check carries over to
+the same connection's later jobs: objects mutated in place inside
+modules, signal handlers, interpreter settings and open file
+descriptors. Every job can use anything the service's user can. This
+module only needs the standard library, so the service does not pull in
+pygame.
+"""
+import argparse
+import codecs
+import contextlib
+import functools
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import itertools
+import json
+import math
+import os
+import secrets
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+DEFAULT_PORT = 8766
+TOKEN_ENV = "QUADTREE_EXEC_TOKEN"
+# Seconds a new connection has to send its hello, and the most it may send
+AUTH_TIMEOUT = 10.0
+MAX_HELLO_BYTES = 64 * 1024
+LANGUAGES = ("python",)
+
+# Runs inside each worker: executes one job per line read from the control
+# pipe and ends its stdout and stderr with a marker carrying the job token,
+# exit code and whether the job left threads running.
+WORKER_SOURCE = r'''
+import json, os, sys, threading, traceback
+for _name in sys.argv[1:]:
+    try:
+        __import__(_name)
+    except Exception as _e:
+        print(f"preload of {_name} failed: {_e}", file=sys.stderr)
+_control = os.fdopen(os.dup(0), "rb")
+_null = os.open(os.devnull, os.O_RDONLY)
+os.dup2(_null, 0)
+os.close(_null)
+sys.stdin = open(os.devnull)
+
+# Process-wide state every job starts from. Functions the worker relies on
+# are bound here so a job that patches them cannot fake a clean result.
+_loads, _write, _compile, _exec = json.loads, os.write, compile, exec
+_active_count, _print_exception = threading.active_count, traceback.print_exception
+_getcwd, _chdir, _environ = os.getcwd, os.chdir, os.environ
+_argv, _path, _stdout, _stderr = sys.argv, list(sys.path), sys.stdout, sys.stderr
+_cwd = _getcwd()
+_env = dict(_environ)
+_modules = dict(sys.modules)
+_attrs = {_n: dict(_m.__dict__) for _n, _m in _modules.items()
+          if _n != "__main__" and isinstance(getattr(_m, "__dict__", None), dict)}
+
+
+def _restore():
+    """Undo what a job changed in the process; return False if the worker must be replaced"""
+    clean = _active_count() == 1 and not _stdout.closed and not _stderr.closed
+    sys.argv, sys.stdout, sys.stderr = _argv, _stdout, _stderr
+    sys.path[:] = _path
+    try:
+        if _getcwd() != _cwd:
+            _chdir(_cwd)
+        if _environ != _env:
+            _environ.clear()
+            _environ.update(_env)
+    except Exception:
+        clean = False
+    for _n in [_n for _n in sys.modules if _n not in _modules]:
+        del sys.modules[_n]
+    sys.modules.update(_modules)
+    # Rebinding an attribute of an already loaded module (json.dumps = ...)
+    # cannot be undone reliably, so it marks the worker dirty
+    for _n, _a in _attrs.items():
+        _d = _modules[_n].__dict__
+        if _d.keys() != _a.keys():
+            return False
+        for _k, _v in _a.items():
+            if _d[_k] is not _v:
+                return False
+    return clean
+
+
+for _line in _control:
+    _job = _loads(_line)
+    sys.argv = [_job["filename"]]
+    _globals = {"__name__": "__main__", "__file__": _job["filename"], "__builtins__": __builtins__}
+    _code = 0
+    try:
+        _exec(_compile(_job["code"], _job["filename"], "exec"), _globals)
+    except SystemExit as _e:
+        if isinstance(_e.code, int):
+            _code = _e.code
+        elif _e.code is not None:
+            print(_e.code, file=sys.stderr)
+            _code = 1
+    except BaseException as _e:
+        _print_exception(type(_e), _e, _e.__traceback__.tb_next)
+        _code = 1
+    del _globals
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except Exception:
+        pass
+    try:
+        _clean = _restore()
+    except Exception:
+        _clean = False
+    _end = f"\x00{_job['token']}:{_code}:{int(_clean)}\x00".encode()
+    _write(1, _end)
+    _write(2, _end)
+'''
+
+
+class Job:
+    """One execution request and its progress"""
+
+    def __init__(self, client: 'ServiceClient', job_id: str, code: str, language: str, priority: int, timeout: float):
+        self.client = client
+        self.id = job_id
+        self.code = code
+        self.language = language
+        self.priority = priority
+        self.timeout = timeout
+        self.token = secrets.token_hex(8)
+        self.worker: Optional['Worker'] = None
+        self.deadline = 0.0
+        self.open_streams = {'stdout', 'stderr'}
+        self.returncode: Optional[int] = None
+        self.timed_out = False
+        self.cancelled = False
+
+
+class Worker:
+    """A warm interpreter process that runs jobs one after another"""
+
+    def __init__(self, service: 'ExecutionService', preload: List[str]):
+        self.service = service
+        self.process = subprocess.Popen([sys.executable, "-u", "-c", WORKER_SOURCE, *preload],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.job: Optional[Job] = None
+        self.jobs_run = 0
+        # The client whose jobs this worker has run; no other client's jobs go to it
+        self.owner: Optional['ServiceClient'] = None
+        self.open_streams = {'stdout', 'stderr'}
+        for name, pipe in (('stdout', self.process.stdout), ('stderr', self.process.stderr)):
+            threading.Thread(target=self._read, args=(name, pipe), daemon=True).start()
+
+    def run(self, job: Job):
+        self.job = job
+        job.worker = self
+        request = {"token": job.token, "code": job.code, "filename": f"<cell {job.id}>"}
+        try:
+            self.process.stdin.write(json.dumps(request).encode('utf-8') + b"\n")
+            self.process.stdin.flush()
+        except OSError:
+            # The reader threads see the worker exit and fail the job
+            self.kill()
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+    def _read(self, stream: str, pipe):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = ""
+        for data in iter(functools.partial(pipe.read1, 1 << 16), b''):
+            pending = self._scan(stream, pending + decoder.decode(data))
+        pipe.close()
+        self.service.stream_closed(self, stream)
+
+    def _scan(self, stream: str, pending: str) -> str:
+        """Pass text before the current job's end marker on and handle the marker"""
+        job = self.job
+        if job is None or stream not in job.open_streams:
+            # Output of preloads, or of threads a finished job left behind
+            return ""
+        marker = "\x00" + job.token + ":"
+        start = pending.find(marker)
+        if start < 0:
+            # Hold back a tail that could be the beginning of the marker
+            cut = pending.rfind("\x00", max(0, len(pending) - len(marker) - 24))
+            cut = len(pending) if cut < 0 else cut
+            self.service.output(job, stream, pending[:cut])
+            return pending[cut:]
+        end = pending.find("\x00", start + len(marker))
+        self.service.output(job, stream, pending[:start])
+        if end < 0:
+            return pending[start:]
+        returncode, clean = pending[start + len(marker):end].split(":")
+        self.service.stream_finished(self, job, stream, int(returncode), clean == "1")
+        return ""
+
+
+class ServiceClient:
+    """One connection to the service and its outgoing message batch"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.send_lock = threading.Lock()
+        self.jobs: Dict[str, Job] = {}
+        self.running = 0
+        self.outbox: List[Dict[str, Any]] = []
+        self.chunks: List[list] = []
+        self.closed = False
+
+    def queue(self, message: Dict[str, Any]):
+        self.flush_output()
+        self.outbox.append(message)
+
+    def flush_output(self):
+        if self.chunks:
+            self.outbox.append({"type": "output", "chunks": self.chunks})
+            self.chunks = []
+
+    def take_outbox(self) -> List[Dict[str, Any]]:
+        self.flush_output()
+        messages, self.outbox = self.outbox, []
+        return messages
+
+    def send(self, messages: List[Dict[str, Any]]):
+        if not messages or self.closed:
+            return
+        data = b"".join(json.dumps(m, separators=(",", ":")).encode('utf-8') + b"\n" for m in messages)
+        with self.send_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                self.closed = True
+
+
+class ExecutionService:
+    """Priority queue of jobs shared by all clients, run on a pool of warm workers.
+
+    All state is guarded by self.lock; a dispatcher thread starts queued
+    jobs, enforces deadlines and sends each client its batched messages.
+    """
+
+    def __init__(self, workers: int = 4, per_client: Optional[int] = None, max_jobs_per_worker: int = 50,
+                 preload: List[str] = (), max_timeout: float = 300.0, flush_interval: float = 0.02):
+        self.max_workers = workers
+        self.per_client = per_client or workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.preload = list(preload)
+        self.max_timeout = max_timeout
+        self.flush_interval = flush_interval
+        self.lock = threading.Condition()
+        self.queue: List[tuple] = []
+        self.order = itertools.count()
+        self.idle: List[Worker] = []
+        self.busy: Dict[Worker, Job] = {}
+        self.clients: List[ServiceClient] = []
+        self.running = True
+        # Set with the lock held when there is work for the dispatcher before the next flush
+        self.woken = False
+        with self.lock:
+            self._replenish()
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self.dispatcher.start()
+
+    # --- Requests ---
+
+    def connect(self, wfile) -> ServiceClient:
+        client = ServiceClient(wfile)
+        with self.lock:
+            self.clients.append(client)
+        return client
+
+    def disconnect(self, client: ServiceClient):
+        """Drop a client's queued jobs and stop its running ones"""
+        with self.lock:
+            client.closed = True
+            self.queue = [entry for entry in self.queue if entry[2].client is not client]
+            heapq.heapify(self.queue)
+            for job in client.jobs.values():
+                if job.worker is not None and job.returncode is None:
+                    job.cancelled = True
+                    job.worker.kill()
+            for worker in [worker for worker in self.idle if worker.owner is client]:
+                self._retire(worker)
+            self.clients.remove(client)
+            self._wake()
+
+    def handle(self, client: ServiceClient, message: Any):
+        with self.lock:
+            if not isinstance(message, dict):
+                client.queue({"type": "error", "id": None, "message": "expected a JSON object"})
+            elif message.get("type") == "run":
+                self._submit(client, message)
+            elif message.get("type") == "batch" and isinstance(message.get("jobs"), list):
+                for request in message["jobs"]:
+                    self._submit(client, request)
+            elif message.get("type") == "cancel":
+                self._cancel(client, str(message.get("id")))
+            elif message.get("type") == "hello":
+                # Already checked by the request handler when the service has a token
+                pass
+            else:
+                client.queue({"type": "error", "id": message.get("id"), "message": "unknown request type"})
+            self._wake()
+
+    def _submit(self, client: ServiceClient, request: Any):
+        job_id = str(request.get("id")) if isinstance(request, dict) else None
+        try:
+            if job_id is None or job_id in client.jobs:
+                raise ValueError("every job needs an id that is unique on its connection")
+            language = str(request.get("language", "python")).lower()
+            if language not in LANGUAGES:
+                raise ValueError(f"No executor available for {language} on the execution service")
+            if not isinstance(request.get("code"), str):
+                raise ValueError("code must be a string")
+            try:
+                timeout = float(request.get("timeout", 5.0))
+            except (TypeError, ValueError):
+                timeout = math.nan
+            if not math.isfinite(timeout) or timeout <= 0:
+                raise ValueError("timeout must be a positive number of seconds")
+            timeout = min(timeout, self.max_timeout)
+            priority = int(request.get("priority", 0))
+        except (TypeError, ValueError) as e:
+            client.queue({"type": "error", "id": job_id, "message": str(e)})
+            return
+        job = Job(client, job_id, request["code"], language, priority, timeout)
+        client.jobs[job_id] = job
+        # Higher priority first, then first come first served
+        heapq.heappush(self.queue, (-priority, next(self.order), job))
+        client.queue({"type": "queued", "id": job_id, "position": len(self.queue)})
+
+    def _cancel(self, client: ServiceClient, job_id: str):
+        job = client.jobs.get(job_id)
+        if job is None or job.returncode is not None:
+            return
+        job.cancelled = True
+        if job.worker is not None:
+            job.worker.kill()
+        else:
+            self.queue = [entry for entry in self.queue if entry[2] is not job]
+            heapq.heapify(self.queue)
+            self._finish(job, -1)
+
+    # --- Worker events (called from worker reader threads) ---
+
+    def output(self, job: Job, stream: str, text: str):
+        if not text:
+            return
+        with self.lock:
+            chunks = job.client.chunks
+            if chunks and chunks[-1][0] == job.id and chunks[-1][1] == stream:
+                chunks[-1][2] += text
+            else:
+                chunks.append([job.id, stream, text])
+
+    def stream_finished(self, worker: Worker, job: Job, stream: str, returncode: int, clean: bool):
+        with self.lock:
+            job.open_streams.discard(stream)
+            if job.open_streams or job.returncode is not None:
+                return
+            self._finish(job, returncode)
+            self.busy.pop(worker, None)
+            worker.job = None
+            worker.jobs_run += 1
+            if clean and worker.jobs_run < self.max_jobs_per_worker and self.running:
+                self.idle.append(worker)
+            else:
+                worker.kill()
+            self._wake()
+
+    def stream_closed(self, worker: Worker, stream: str):
+        """A worker pipe reached end of file: the process exited or was killed"""
+        with self.lock:
+            worker.open_streams.discard(stream)
+            if worker.open_streams:
+                return
+            returncode = worker.process.wait()
+            job = worker.job
+            if job is not None and job.returncode is None:
+                self._finish(job, returncode)
+            worker.job = None
+            self.busy.pop(worker, None)
+            if worker in self.idle:
+                self.idle.remove(worker)
+            self._wake()
+
+    def _finish(self, job: Job, returncode: int):
+        job.returncode = returncode
+        if job.worker is not None:
+            job.client.running -= 1
+        job.client.jobs.pop(job.id, None)
+        job.client.queue({"type": "done", "id": job.id, "returncode": returncode,
+                          "timed_out": job.timed_out, "cancelled": job.cancelled})
+
+    # --- Dispatching ---
+
+    def _wake(self):
+        self.woken = True
+        self.lock.notify()
+
+    def _replenish(self):
+        # Keep the pool full so a freed slot always finds a warm worker
+        while self.running and len(self.idle) + len(self.busy) < self.max_workers:
+            self.idle.append(Worker(self, self.preload))
+
+    def _retire(self, worker: Worker):
+        # Out of the pool at once; _replenish starts a fresh worker in its place
+        self.idle.remove(worker)
+        worker.kill()
+
+    def _idle_worker(self, client: 'ServiceClient') -> Worker:
+        """Take an idle worker that is fresh or has only run client's jobs.
+
+        If every idle worker belongs to another client, the least recently
+        used one is replaced by a fresh worker.
+        """
+        for i in range(len(self.idle) - 1, -1, -1):
+            if self.idle[i].owner in (None, client):
+                return self.idle.pop(i)
+        self._retire(self.idle[0])
+        self._replenish()
+        return self.idle.pop()
+
+    def _start_jobs(self):
+        skipped = []
+        while self.queue and self.idle and len(self.busy) < self.max_workers:
+            entry = heapq.heappop(self.queue)
+            job = entry[2]
+            if job.client.running >= self.per_client:
+                skipped.append(entry)
+                continue
+            worker = self._idle_worker(job.client)
+            worker.owner = job.client
+            self.busy[worker] = job
+            job.client.running += 1
+            job.deadline = time.monotonic() + job.timeout
+            job.client.queue({"type": "started", "id": job.id})
+            worker.run(job)
+        for entry in skipped:
+            heapq.heappush(self.queue, entry)
+
+    def _check_deadlines(self):
+        now = time.monotonic()
+        for worker, job in self.busy.items():
+            if not job.timed_out and not job.cancelled and now >= job.deadline:
+                job.timed_out = True
+                worker.kill()
+
+    def _dispatch_loop(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.woken, self.flush_interval)
+                self.woken = False
+                if not self.running:
+                    break
+                self._check_deadlines()
+                self._replenish()
+                self._start_jobs()
+                batches = [(client, client.take_outbox()) for client in self.clients]
+            for client, messages in batches:
+                client.send(messages)
+
+    def shutdown(self):
+        with self.lock:
+            self.running = False
+            for worker in [*self.idle, *self.busy]:
+                worker.kill()
+            self._wake()
+        self.dispatcher.join()
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"queued": len(self.queue), "running": len(self.busy), "idle": len(self.idle)}
+
+
+class ServiceRequestHandler(socketserver.StreamRequestHandler):
+    server: 'ServiceServer'
+    # Messages are small and latency bound; don't let Nagle hold them back
+    disable_nagle_algorithm = True
+
+    def authenticate(self) -> bool:
+        """Check the hello a client must send first when the service has a token"""
+        token = self.server.token
+        if not token:
+            return True
+        self.connection.settimeout(AUTH_TIMEOUT)
+        try:
+            message = json.loads(self.rfile.readline(MAX_HELLO_BYTES))
+        except (OSError, ValueError):
+            message = None
+        self.connection.settimeout(None)
+        if isinstance(message, dict) and message.get("type") == "hello" and isinstance(message.get("token"), str):
+            # Compare digests so the check takes the same time for any token
+            given = hashlib.sha256(message["token"].encode("utf-8")).digest()
+            if hmac.compare_digest(given, hashlib.sha256(token.encode("utf-8")).digest()):
+                return True
+        with contextlib.suppress(OSError):
+            self.wfile.write(b'{"type":"error","id":null,"message":"authentication failed"}\n')
+        return False
+
+    def handle(self):
+        if not self.authenticate():
+            return
+        service = self.server.service
+        client = service.connect(self.wfile)
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                except ValueError as e:
+                    client.send([{"type": "error", "id": None, "message": f"invalid JSON: {e}"}])
+                    continue
+                service.handle(client, message)
+        except OSError:
+            pass
+        finally:
+            service.disconnect(client)
+
+
+class UnixServiceRequestHandler(ServiceRequestHandler):
+    disable_nagle_algorithm = False
+
+
+class ServiceServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    handler = ServiceRequestHandler
+
+    def __init__(self, address, service: ExecutionService, token: Optional[str] = None):
+        super().__init__(address, self.handler)
+        self.service = service
+        self.token = token
+
+
+class UnixServiceServer(ServiceServer):
+    """ServiceServer on a Unix socket that only the service's user can open"""
+
+    address_family = getattr(socket, "AF_UNIX", None)
+    allow_reuse_address = False
+    handler = UnixServiceRequestHandler
+
+    def __init__(self, path: str, service: ExecutionService, token: Optional[str] = None):
+        remove_stale_socket(path)
+        # Created with mode 0600 from the start instead of chmod-ing it afterwards
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, service, token)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        super().server_close()
+        with contextlib.suppress(OSError):
+            os.remove(self.server_address)
+
+
+def remove_stale_socket(path: str):
+    """Remove a Unix socket file left behind by a service that is no longer running"""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except OSError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path)
+    except OSError:
+        pass
+    else:
+        raise OSError(f"another service is already listening on {path}")
+    finally:
+        probe.close()
+
+
+def is_loopback(host: str) -> bool:
+    """Return True if every address host resolves to is a loopback address"""
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except OSError:
+        return False
+    return all(ipaddress.ip_address(info[4][0].split("%")[0]).is_loopback for info in infos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run code cells for CodeExecutor clients")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="jobs run at once")
+    parser.add_argument("--per-client", type=int, help="jobs run at once for one connection (default: --workers)")
+    parser.add_argument("--max-jobs-per-worker", type=int, default=50, help="jobs before a worker is replaced")
+    parser.add_argument("--max-timeout", type=float, default=300.0, help="upper bound on a job's timeout in seconds")
+    parser.add_argument("--preload", action="append", default=[], help="module every worker imports when it starts")
+    parser.add_argument("--flush-interval", type=float, default=0.02, help="seconds between output batches")
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket only this user can open instead of TCP")
+    parser.add_argument("--token", default=os.environ.get(TOKEN_ENV),
+                        help=f"shared secret clients must send (default: ${TOKEN_ENV}; prefer the variable, "
+                             "command lines are visible to other users)")
+    args = parser.parse_args()
+    if args.unix and UnixServiceServer.address_family is None:
+        parser.error("--unix needs a platform with Unix sockets")
+
+    token = args.token
+    if not args.unix:
+        if not token:
+            token = secrets.token_urlsafe(24)
+            print(f"No token given; clients must set {TOKEN_ENV}={token}", file=sys.stderr)
+        if not is_loopback(args.host):
+            print(f"Warning: {args.host or 'all interfaces'} is reachable beyond this machine and traffic, "
+                  "including the token, is not encrypted", file=sys.stderr)
+
+    service = ExecutionService(args.workers, args.per_client, args.max_jobs_per_worker, args.preload,
+                               args.max_timeout, args.flush_interval)
+    try:
+        if args.unix:
+            server = UnixServiceServer(args.unix, service, token)
+            where = f"unix:{args.unix}"
+        else:
+            server = ServiceServer((args.host, args.port), service, token)
+            where = f"{args.host}:{server.server_address[1]}"
+    except OSError as e:
+        service.shutdown()
+        sys.exit(f"Could not listen: {e}")
+    print(f"Execution service on {where} with {args.workers} worker(s)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
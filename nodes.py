@@ -1,19 +1,47 @@
 import pygame
 import json
 import os
+import pickle
 import importlib
 import importlib.util
 import sys
 import subprocess
 import base64
+import bisect
+import codecs
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import hashlib
+import http.client
 import io
+import itertools
+import keyword
+import multiprocessing
+import queue
+import re
+import socket
+import struct
+import threading
+import zlib
 import tempfile
+import time
 import tkinter as tk
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 from pathlib import Path
+from urllib.parse import quote, unquote, urlsplit
 from tkinter import filedialog, simpledialog, colorchooser
 from PIL import Image
+
+try:
+    import orjson  # optional accelerated JSON backend
+except ImportError:
+    orjson = None
 from dataclasses import dataclass, field
-from typing import Dict, List, Tuple, Optional, Any, Union
+from typing import Callable, Deque, Dict, List, Tuple, Optional, Any, Union
 
 pygame.init()
 
@@ -32,6 +60,12 @@ SURFACE = (255, 255, 255)  # White
 TEXT = (51, 51, 51)  # Dark Gray
 CODE_BG = (247, 247, 240)  # Light Code Background
 CODE_NUM = (144, 144, 144)  # Line Number Gray
+SYNTAX_COLORS = {
+    'keyword': (0, 0, 160),
+    'string': (163, 21, 21),
+    'comment': (0, 128, 0),
+    'number': (9, 134, 88),
+}
 GRID_COLOR = (204, 204, 204)  # Grid lines
 BUTTON_HOVER = (219, 213, 137)  # Lighter version of SECONDARY
 
@@ -59,10 +93,431 @@ def wrap_text(text: str, font: pygame.font.Font, max_px: int) -> list[str]:
     return lines
 
 
-@dataclass
+def journaled(label: str):
+    """Record every change made by a Matrix method as one journal entry"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.edit(label):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _u32_array(values=()) -> array:
+    """Return an array of unsigned 32-bit ints"""
+    return array('I' if array('I').itemsize == 4 else 'L', values)
+
+
+# Current matrix file format; older files are upgraded through MIGRATIONS
+MATRIX_FORMAT_VERSION = 2
+MAX_COLOR = 0xFFFFFF
+
+
+class MatrixFormatError(ValueError):
+    """Raised when a matrix file fails validation"""
+
+
+# Layer formats accepted by write_matrix / save_json
+LAYER_PLAIN = 'plain'            # one JSON int per node
+LAYER_PACKED = 'packed'          # base64 little-endian uint32, no compression
+LAYER_COMPRESSED = 'compressed'  # palette or uint32 bytes, zlib-compressed
+COMPRESSED_ENCODINGS = ('palette-zlib', 'u32-zlib')
+
+
+def _json_dumps(data: Any, compact: bool = True) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=0 if compact else orjson.OPT_INDENT_2)
+    if compact:
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return json.dumps(data, indent=2).encode('utf-8')
+
+
+def _json_loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _u32_bytes(nodes: List[int]) -> bytes:
+    values = _u32_array(nodes)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def pack_layer(size: int, nodes: List[int]) -> Dict[str, Any]:
+    """Encode layer nodes as base64 little-endian uint32 without compression"""
+    return {
+        'size': size,
+        'encoding': 'u32',
+        'data': base64.b64encode(_u32_bytes(nodes)).decode('ascii')
+    }
+
+
+def encode_layer(size: int, nodes: List[int]) -> Dict[str, Any]:
+    """Encode layer nodes as a zlib-compressed block.
+
+    Layers with at most 256 distinct colors are stored as one palette index
+    byte per node; others as little-endian uint32 values. Either way zlib
+    collapses the long runs of zeros and repeated colors.
+    """
+    palette = sorted(set(nodes))
+    if len(palette) <= 256:
+        lookup = {color: i for i, color in enumerate(palette)}
+        raw = bytes(map(lookup.__getitem__, nodes))
+        return {
+            'size': size,
+            'encoding': 'palette-zlib',
+            'palette': palette,
+            'data': base64.b64encode(zlib.compress(raw, 6)).decode('ascii')
+        }
+
+    return {
+        'size': size,
+        'encoding': 'u32-zlib',
+        'data': base64.b64encode(zlib.compress(_u32_bytes(nodes), 6)).decode('ascii')
+    }
+
+
+def decode_layer(layer_data: Dict[str, Any]) -> List[int]:
+    """Decode the nodes of a layer written by encode_layer or pack_layer"""
+    encoding = layer_data.get('encoding')
+    raw = base64.b64decode(layer_data['data'])
+    if encoding in COMPRESSED_ENCODINGS:
+        raw = zlib.decompress(raw)
+
+    if encoding == 'palette-zlib':
+        # Map palette indices to uint32 one byte plane at a time
+        palette = layer_data['palette']
+        if raw and max(raw) >= len(palette):
+            raise MatrixFormatError("Palette index out of range")
+        buf = bytearray(4 * len(raw))
+        for k in range(4):
+            plane = bytes((palette[i] >> (8 * k)) & 0xFF if i < len(palette) else 0 for i in range(256))
+            buf[k::4] = raw.translate(plane)
+        raw = bytes(buf)
+    elif encoding not in ('u32', 'u32-zlib'):
+        raise MatrixFormatError(f"Unknown layer encoding: {encoding}")
+
+    values = _u32_array()
+    values.frombytes(raw)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    nodes = values.tolist()
+
+    size = layer_data['size']
+    if len(nodes) != size * size:
+        raise MatrixFormatError(f"Layer of size {size} decoded to {len(nodes)} nodes")
+    return nodes
+
+
 class Layer:
-    size: int
-    nodes: List[int] = field(default_factory=list)
+    """One depth of the quadtree.
+
+    A layer loaded from a compressed file keeps its encoded block and only
+    decodes it the first time nodes is accessed. An evicted layer keeps
+    just a loader for its block in a LayerStore on disk. Once loaded back,
+    it holds on to that slot until its nodes change, so evicting it again
+    writes nothing.
+    """
+
+    def __init__(self, size: int, nodes: Optional[List[int]] = None, encoded: Optional[Dict[str, Any]] = None,
+                 loader: Optional[Callable[[], Dict[str, Any]]] = None):
+        self.size = size
+        self._encoded = encoded
+        self._loader = loader
+        if nodes is None and encoded is None and loader is None:
+            nodes = []
+        self._nodes = nodes
+        # Block in a LayerStore that still matches nodes, if any
+        self._slot: Optional[LayerSlot] = None
+
+    @property
+    def nodes(self) -> List[int]:
+        if self._nodes is None:
+            self._nodes = decode_layer(self._block())
+            if isinstance(self._loader, LayerSlot):
+                self._slot = self._loader
+            self._encoded = None
+            self._loader = None
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, nodes: List[int]):
+        self._nodes = nodes
+        self._encoded = None
+        self._loader = None
+        self._slot = None
+
+    def changed(self):
+        """Forget the stored copy after nodes were modified in place"""
+        self._slot = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._nodes is not None
+
+    def load(self) -> List[int]:
+        """Decode the layer now if it is not loaded yet"""
+        return self.nodes
+
+    def resident_bytes(self) -> int:
+        """Approximate memory held by this layer, in bytes"""
+        if self._nodes is not None:
+            return 8 * len(self._nodes)
+        if self._encoded is not None:
+            return len(self._encoded['data'])
+        return 0
+
+    def __getstate__(self):
+        # Evicted layers are shipped as their encoded block, not the loader
+        state = self.__dict__.copy()
+        if self._nodes is None and self._encoded is None:
+            state['_encoded'] = self._loader()
+        state['_loader'] = None
+        state['_slot'] = None
+        return state
+
+    def _block(self) -> Dict[str, Any]:
+        return self._encoded if self._encoded is not None else self._loader()
+
+    def to_json(self, layer_format: str = LAYER_COMPRESSED) -> Dict[str, Any]:
+        """Return the serializable form of this layer"""
+        if layer_format == LAYER_PLAIN:
+            return {'size': self.size, 'nodes': self.nodes}
+        if self._nodes is None:
+            # Never decoded, so the stored block is still current if it matches
+            block = self._block()
+            compressed = block.get('encoding') in COMPRESSED_ENCODINGS
+            if compressed == (layer_format == LAYER_COMPRESSED):
+                return block
+        if layer_format == LAYER_PACKED:
+            return pack_layer(self.size, self.nodes)
+        return encode_layer(self.size, self.nodes)
+
+    def evict(self, store: 'LayerStore'):
+        """Move this layer's data out of memory into store"""
+        if self._nodes is None and self._encoded is None:
+            return
+        if self._slot is None or self._slot.store is not store:
+            self._slot = store.put(self.to_json(LAYER_COMPRESSED))
+        self._loader = self._slot
+        self._nodes = None
+        self._encoded = None
+
+    def __eq__(self, other):
+        if not isinstance(other, Layer):
+            return NotImplemented
+        return self.size == other.size and self.nodes == other.nodes
+
+    def __repr__(self):
+        state = f"{len(self._nodes)} nodes" if self._nodes is not None else "not loaded"
+        return f"Layer(size={self.size}, {state})"
+
+
+class LayerSlot:
+    """One encoded layer in a LayerStore; calling it reads the layer back.
+
+    The slot's space is given back to the store as soon as nothing
+    refers to the slot any more.
+    """
+
+    __slots__ = ('store', 'offset', 'length')
+
+    def __init__(self, store: 'LayerStore', offset: int, length: int):
+        self.store = store
+        self.offset = offset
+        self.length = length
+
+    def __call__(self) -> Dict[str, Any]:
+        return self.store.get(self.offset, self.length)
+
+    def __del__(self):
+        self.store.release(self.offset, self.length)
+
+
+class LayerStore:
+    """Scratch file holding encoded layers evicted from memory.
+
+    Space of released slots is reused first-fit by later layers, and
+    free space at the end of the file is handed back, so the file stays
+    near the size of the layers actually spilled.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self.file = None
+        # End of the used part of the file, and the (offset, length) gaps before it
+        self.end = 0
+        self.free: List[Tuple[int, int]] = []
+
+    def put(self, layer_data: Dict[str, Any]) -> LayerSlot:
+        """Store an encoded layer and return its slot"""
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.directory)
+        blob = json.dumps(layer_data, separators=(',', ':')).encode('utf-8')
+        offset = self._allocate(len(blob))
+        self.file.seek(offset)
+        self.file.write(blob)
+        if offset + len(blob) == self.end:
+            self.file.truncate(self.end)
+        return LayerSlot(self, offset, len(blob))
+
+    def get(self, offset: int, length: int) -> Dict[str, Any]:
+        self.file.seek(offset)
+        return json.loads(self.file.read(length))
+
+    def _allocate(self, length: int) -> int:
+        for i, (offset, size) in enumerate(self.free):
+            if size >= length:
+                if size == length:
+                    del self.free[i]
+                else:
+                    self.free[i] = (offset + length, size - length)
+                return offset
+        offset = self.end
+        self.end += length
+        return offset
+
+    def release(self, offset: int, length: int):
+        """Make a slot's space available again, merging it with neighbouring gaps"""
+        i = bisect.bisect_left(self.free, (offset, length))
+        if i > 0 and sum(self.free[i - 1]) == offset:
+            i -= 1
+            offset, length = self.free[i][0], self.free[i][1] + length
+            del self.free[i]
+        if i < len(self.free) and offset + length == self.free[i][0]:
+            length += self.free.pop(i)[1]
+        if offset + length == self.end:
+            self.end = offset
+        else:
+            self.free.insert(i, (offset, length))
+
+
+class OccupancyIndex:
+    """Sorted per-row index of the occupied cells of one square layer.
+
+    Occupied rows are kept in a sorted list and each row holds a sorted
+    list of occupied columns, so rectangle and nearest-cell queries only
+    touch occupied rows and cells instead of scanning the whole layer.
+    """
+
+    def __init__(self, size: int, cells=()):
+        self.size = size
+        self.rows: Dict[int, List[int]] = {}
+        self.row_keys: List[int] = []
+        self.count = 0
+        for idx in sorted(cells):
+            cy, cx = divmod(idx, size)
+            row = self.rows.get(cy)
+            if row is None:
+                row = self.rows[cy] = []
+                self.row_keys.append(cy)
+            row.append(cx)
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, idx: int) -> bool:
+        cy, cx = divmod(idx, self.size)
+        row = self.rows.get(cy)
+        if not row:
+            return False
+        i = bisect.bisect_left(row, cx)
+        return i < len(row) and row[i] == cx
+
+    def add(self, idx: int):
+        cy, cx = divmod(idx, self.size)
+        row = self.rows.get(cy)
+        if row is None:
+            self.rows[cy] = [cx]
+            bisect.insort(self.row_keys, cy)
+            self.count += 1
+            return
+        i = bisect.bisect_left(row, cx)
+        if i == len(row) or row[i] != cx:
+            row.insert(i, cx)
+            self.count += 1
+
+    def discard(self, idx: int):
+        cy, cx = divmod(idx, self.size)
+        row = self.rows.get(cy)
+        if not row:
+            return
+        i = bisect.bisect_left(row, cx)
+        if i < len(row) and row[i] == cx:
+            del row[i]
+            self.count -= 1
+            if not row:
+                del self.rows[cy]
+                del self.row_keys[bisect.bisect_left(self.row_keys, cy)]
+
+    def set_row(self, cy: int, cols: List[int]):
+        """Replace the occupied columns of row cy with a sorted list"""
+        old = self.rows.get(cy)
+        if old is not None:
+            self.count -= len(old)
+        if cols:
+            if old is None:
+                bisect.insort(self.row_keys, cy)
+            self.rows[cy] = cols
+            self.count += len(cols)
+        elif old is not None:
+            del self.rows[cy]
+            del self.row_keys[bisect.bisect_left(self.row_keys, cy)]
+
+    def iter_rect(self, x0: int, y0: int, x1: int, y1: int):
+        """Yield occupied indices with x0 <= x < x1 and y0 <= y < y1"""
+        size = self.size
+        lo = bisect.bisect_left(self.row_keys, y0)
+        hi = bisect.bisect_left(self.row_keys, y1)
+        for cy in self.row_keys[lo:hi]:
+            row = self.rows[cy]
+            a = bisect.bisect_left(row, x0)
+            b = bisect.bisect_left(row, x1)
+            base = cy * size
+            for cx in row[a:b]:
+                yield base + cx
+
+    def nearest(self, x: int, y: int) -> Optional[Tuple[int, int]]:
+        """Return (idx, squared distance) of the occupied cell closest to (x, y)"""
+        if not self.count:
+            return None
+        best = None
+        best_dist = None
+        keys = self.row_keys
+        start = bisect.bisect_left(keys, y)
+        up, down = start - 1, start
+        while up >= 0 or down < len(keys):
+            # Visit whichever candidate row is closer to y first
+            if down < len(keys) and (up < 0 or keys[down] - y <= y - keys[up]):
+                cy = keys[down]
+                down += 1
+            else:
+                cy = keys[up]
+                up -= 1
+            dy2 = (cy - y) ** 2
+            if best_dist is not None and dy2 >= best_dist:
+                break
+            row = self.rows[cy]
+            i = bisect.bisect_left(row, x)
+            for j in (i - 1, i):
+                if 0 <= j < len(row):
+                    dist = dy2 + (row[j] - x) ** 2
+                    if best_dist is None or dist < best_dist:
+                        best, best_dist = cy * self.size + row[j], dist
+        return best, best_dist
+
+
+HASH_SIZE = 16
+
+
+def payload_digest(payload: Dict[str, Any]) -> bytes:
+    """Return a content digest of a payload, independent of key order"""
+    raw = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.blake2b(raw, digest_size=HASH_SIZE).digest()
 
 
 @dataclass
@@ -70,8 +525,1439 @@ class Matrix:
     quadtree_size: int
     max_depth: int
     layers: List[Layer] = field(default_factory=list)
-    payload_pool: Dict[str, Any] = field(default_factory=dict)
-    version: int = 1
+    # Payloads indexed per depth: payloads[d][idx] -> payload dict
+    payloads: Dict[int, Dict[int, Any]] = field(default_factory=dict)
+    version: int = MATRIX_FORMAT_VERSION
+    # Lazily built occupancy indexes, kept in sync by the mutators below
+    _color_index: Dict[int, OccupancyIndex] = field(default_factory=dict, repr=False, compare=False)
+    _payload_index: Dict[int, OccupancyIndex] = field(default_factory=dict, repr=False, compare=False)
+    # Undo/redo history; attached by QuadtreeMatrix for editable contexts
+    journal: Optional['Journal'] = field(default=None, repr=False, compare=False)
+    # Merkle digests per depth and the cells changed since they were computed
+    _hashes: Optional[List[List[bytes]]] = field(default=None, repr=False, compare=False)
+    _hash_dirty: Dict[int, set] = field(default_factory=dict, repr=False, compare=False)
+
+    def color_index(self, d: int) -> OccupancyIndex:
+        """Return the index of non-zero color cells at depth d"""
+        index = self._color_index.get(d)
+        if index is None:
+            layer = self.layers[d]
+            index = OccupancyIndex(layer.size, (i for i, c in enumerate(layer.nodes) if c))
+            self._color_index[d] = index
+        return index
+
+    def payload_index(self, d: int) -> OccupancyIndex:
+        """Return the index of cells holding a payload at depth d"""
+        index = self._payload_index.get(d)
+        if index is None:
+            index = OccupancyIndex(self.layers[d].size, self.layer_payloads(d))
+            self._payload_index[d] = index
+        return index
+
+    def evict_layers(self, keep: set, store: LayerStore):
+        """Spill every loaded layer whose depth is not in keep to store"""
+        for d, layer in enumerate(self.layers):
+            if d not in keep:
+                layer.evict(store)
+                # Digests describe content, which eviction leaves untouched
+                self._color_index.pop(d, None)
+                self._payload_index.pop(d, None)
+
+    def invalidate_index(self, d: Optional[int] = None):
+        """Drop cached indexes and digests after nodes were modified directly"""
+        if d is None:
+            self._color_index.clear()
+            self._payload_index.clear()
+        else:
+            self._color_index.pop(d, None)
+            self._payload_index.pop(d, None)
+        self._hashes = None
+        self._hash_dirty.clear()
+
+    def replace_content(self, other: 'Matrix'):
+        """Take over the layers and payloads of other in place, keeping this matrix's journal"""
+        self.quadtree_size = other.quadtree_size
+        self.max_depth = other.max_depth
+        self.layers = other.layers
+        self.payloads = other.payloads
+        self.version = other.version
+        self.invalidate_index()
+
+    def __getstate__(self):
+        # History, indexes and digests stay with the in-process matrix
+        state = self.__dict__.copy()
+        state['journal'] = None
+        state['_color_index'] = {}
+        state['_payload_index'] = {}
+        state['_hashes'] = None
+        state['_hash_dirty'] = {}
+        return state
+
+    # --- Merkle hashing ---
+
+    def _mark_dirty(self, d: int, start: int, count: int = 1):
+        if self._hashes is None:
+            return
+        if count > max(1, self.layers[d].size ** 2 // 4):
+            # Rehashing everything is cheaper than tracking a huge dirty set
+            self._hashes = None
+            self._hash_dirty.clear()
+            return
+        self._hash_dirty.setdefault(d, set()).update(range(start, start + count))
+
+    def _node_digest(self, d: int, idx: int, memo: Dict[bytes, bytes]) -> bytes:
+        # Digest of one cell: its color, its payload and its four children
+        layer = self.layers[d]
+        key = layer.nodes[idx].to_bytes(4, 'little')
+        if d < self.max_depth:
+            child = self._hashes[d + 1]
+            cy, cx = divmod(idx, layer.size)
+            row = 2 * layer.size
+            base = 2 * cy * row + 2 * cx
+            key += child[base] + child[base + 1] + child[base + row] + child[base + row + 1]
+        payload = self.layer_payloads(d).get(idx)
+        if payload is not None:
+            key += b'P' + payload_digest(payload)
+        digest = memo.get(key)
+        if digest is None:
+            digest = memo[key] = hashlib.blake2b(key, digest_size=HASH_SIZE).digest()
+        return digest
+
+    def _layer_digests(self, d: int, memo: Dict[bytes, bytes]) -> List[bytes]:
+        # Same as _node_digest for every cell, without the per-cell call overhead
+        layer = self.layers[d]
+        size = layer.size
+        blake2b = hashlib.blake2b
+        colors = [color.to_bytes(4, 'little') for color in layer.nodes]
+        if d < self.max_depth:
+            child = self._hashes[d + 1]
+            row = 2 * size
+            keys = []
+            for cy in range(size):
+                top = 2 * cy * row
+                bottom = top + row
+                for cx in range(0, row, 2):
+                    keys.append(child[top + cx] + child[top + cx + 1] + child[bottom + cx] + child[bottom + cx + 1])
+            keys = [c + k for c, k in zip(colors, keys)]
+        else:
+            keys = colors
+        for idx, payload in self.layer_payloads(d).items():
+            keys[idx] += b'P' + payload_digest(payload)
+        digests = []
+        for key in keys:
+            digest = memo.get(key)
+            if digest is None:
+                digest = memo[key] = blake2b(key, digest_size=HASH_SIZE).digest()
+            digests.append(digest)
+        return digests
+
+    def _refresh_hashes(self):
+        # Uniform regions repeat the same key, so most cells hit the memo
+        memo = {}
+        if self._hashes is None:
+            self._hashes = [None] * (self.max_depth + 1)
+            self._hash_dirty.clear()
+            for d in range(self.max_depth, -1, -1):
+                self._hashes[d] = self._layer_digests(d, memo)
+            return
+        if not self._hash_dirty:
+            return
+
+        # Recompute dirty cells bottom-up, carrying each change to its parent
+        carry = set()
+        for d in range(self.max_depth, -1, -1):
+            dirty = self._hash_dirty.pop(d, set()) | carry
+            hashes = self._hashes[d]
+            for idx in dirty:
+                hashes[idx] = self._node_digest(d, idx, memo)
+            size = self.layers[d].size
+            carry = {(idx // size // 2) * (size // 2) + (idx % size) // 2 for idx in dirty}
+
+    def subtree_hash(self, d: int = 0, idx: int = 0) -> bytes:
+        """Return the Merkle digest of cell (d, idx) and everything beneath it.
+
+        Two subtrees with equal digests hold the same colors and payloads.
+        Digests are cached and only the changed paths are rehashed.
+        """
+        self._refresh_hashes()
+        return self._hashes[d][idx]
+
+    def content_hash(self) -> str:
+        """Return a hex digest of the whole matrix content"""
+        return (self.max_depth.to_bytes(1, 'little') + self.subtree_hash()).hex()
+
+    def same_subtree(self, other: 'Matrix', d: int = 0, idx: int = 0) -> bool:
+        """Check whether (d, idx) holds the same subtree here and in other"""
+        if other.max_depth != self.max_depth:
+            return False
+        return self.subtree_hash(d, idx) == other.subtree_hash(d, idx)
+
+    def duplicate_subtrees(self, d: int) -> List[List[int]]:
+        """Group the non-empty cells of depth d whose subtrees are identical"""
+        empty = self._empty_digests()[d]
+        self._refresh_hashes()
+        groups = {}
+        for idx, digest in enumerate(self._hashes[d]):
+            if digest != empty:
+                groups.setdefault(digest, []).append(idx)
+        return [cells for cells in groups.values() if len(cells) > 1]
+
+    def _empty_digests(self) -> List[bytes]:
+        # Digest of an all-zero subtree rooted at each depth
+        digests = [b''] * (self.max_depth + 1)
+        children = b''
+        for d in range(self.max_depth, -1, -1):
+            digests[d] = hashlib.blake2b(bytes(4) + children * 4, digest_size=HASH_SIZE).digest()
+            children = digests[d]
+        return digests
+
+    @contextlib.contextmanager
+    def edit(self, label: str):
+        """Group every change made inside the block into one journal entry"""
+        if self.journal is None:
+            yield
+            return
+        self.journal.begin(label)
+        try:
+            yield
+        finally:
+            self.journal.end()
+
+    def apply_ops(self, ops: List[tuple], undo: bool = False):
+        """Apply journal ops forwards, or their inverse in reverse order"""
+        for kind, d, pos, old, new in (reversed(ops) if undo else ops):
+            value = old if undo else new
+            if kind == 'nodes':
+                self.write_nodes(d, pos, list(value))
+            elif value is None:
+                self.remove_payload(d, pos)
+            else:
+                self.set_payload(d, pos, value)
+
+    def apply_records(self, records: List[list]):
+        """Apply absolute [kind, depth, position, value] records (see Edit.records)"""
+        for kind, d, pos, value in records:
+            if kind == 'nodes':
+                self.write_nodes(d, pos, list(value))
+            elif value is None:
+                self.remove_payload(d, pos)
+            else:
+                self.set_payload(d, pos, value)
+
+    def undo(self) -> bool:
+        """Revert the most recent journaled edit"""
+        return self.journal is not None and self.journal.undo(self)
+
+    def redo(self) -> bool:
+        """Re-apply the most recently undone edit"""
+        return self.journal is not None and self.journal.redo(self)
+
+    def set_color(self, d: int, idx: int, color: int):
+        """Set the color of cell (d, idx)"""
+        layer = self.layers[d]
+        nodes = layer.nodes
+        if nodes[idx] == color:
+            return
+        old = nodes[idx]
+        nodes[idx] = color
+        layer.changed()
+        self._mark_dirty(d, idx)
+        index = self._color_index.get(d)
+        if index is not None:
+            if color:
+                index.add(idx)
+            else:
+                index.discard(idx)
+        if self.journal is not None:
+            self.journal.record(('nodes', d, idx, [old], [color]))
+
+    def get_payload(self, d: int, idx: int) -> Optional[Dict[str, Any]]:
+        """Return the payload stored at (d, idx), if any"""
+        layer_payloads = self.payloads.get(d)
+        if layer_payloads is None:
+            return None
+        return layer_payloads.get(idx)
+
+    def set_payload(self, d: int, idx: int, payload: Dict[str, Any]):
+        """Store a payload at (d, idx)"""
+        old = self.get_payload(d, idx)
+        self.payloads.setdefault(d, {})[idx] = payload
+        self._mark_dirty(d, idx)
+        index = self._payload_index.get(d)
+        if index is not None:
+            index.add(idx)
+        if self.journal is not None:
+            self.journal.record(('payload', d, idx, old, payload))
+
+    def remove_payload(self, d: int, idx: int):
+        """Remove the payload at (d, idx) if present"""
+        layer_payloads = self.payloads.get(d)
+        if layer_payloads and idx in layer_payloads:
+            old = layer_payloads.pop(idx)
+            if not layer_payloads:
+                del self.payloads[d]
+            self._mark_dirty(d, idx)
+            index = self._payload_index.get(d)
+            if index is not None:
+                index.discard(idx)
+            if self.journal is not None:
+                self.journal.record(('payload', d, idx, old, None))
+
+    def layer_payloads(self, d: int) -> Dict[int, Any]:
+        """Return the occupied payload cells of a layer (idx -> payload)"""
+        return self.payloads.get(d, {})
+
+    # --- Bulk region operations ---
+
+    def write_nodes(self, d: int, start: int, values: List[int]):
+        """Overwrite a contiguous run of nodes at depth d beginning at start"""
+        if not values:
+            return
+        layer = self.layers[d]
+        if self.journal is not None:
+            old = layer.nodes[start:start + len(values)]
+            if old == values:
+                return
+        layer.nodes[start:start + len(values)] = values
+        layer.changed()
+        self._mark_dirty(d, start, len(values))
+        index = self._color_index.get(d)
+        if index is not None:
+            nodes = layer.nodes
+            size = layer.size
+            for cy in range(start // size, (start + len(values) - 1) // size + 1):
+                base = cy * size
+                index.set_row(cy, [x for x, c in enumerate(nodes[base:base + size]) if c])
+        if self.journal is not None:
+            self.journal.record(('nodes', d, start, old, list(values)))
+
+    def subtree_rect(self, d: int, idx: int, dd: int) -> Tuple[int, int, int, int]:
+        """Return the rectangle (x0, y0, x1, y1) covered by cell (d, idx) at depth dd"""
+        cy, cx = divmod(idx, self.layers[d].size)
+        scale = 1 << (dd - d)
+        return cx * scale, cy * scale, (cx + 1) * scale, (cy + 1) * scale
+
+    @journaled('fill_rect')
+    def fill_rect(self, d: int, x0: int, y0: int, x1: int, y1: int, color: int):
+        """Set every cell in the rectangle at depth d to color"""
+        size = self.layers[d].size
+        x0, y0, x1, y1 = max(0, x0), max(0, y0), min(size, x1), min(size, y1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        if x1 - x0 == size:
+            # Full-width rectangles are one contiguous run
+            self.write_nodes(d, y0 * size, [color] * (size * (y1 - y0)))
+            return
+        run = [color] * (x1 - x0)
+        for cy in range(y0, y1):
+            self.write_nodes(d, cy * size + x0, run)
+
+    @journaled('clear_payloads')
+    def clear_payloads(self, d: int, x0: int, y0: int, x1: int, y1: int):
+        """Remove every payload in the rectangle at depth d"""
+        if d not in self.payloads:
+            return
+        for idx in list(self.payload_index(d).iter_rect(x0, y0, x1, y1)):
+            self.remove_payload(d, idx)
+
+    @journaled('clear_subtree')
+    def clear_subtree(self, d: int, idx: int):
+        """Reset cell (d, idx) and every cell beneath it"""
+        for dd in range(d, self.max_depth + 1):
+            rect = self.subtree_rect(d, idx, dd)
+            self.fill_rect(dd, *rect, 0)
+            self.clear_payloads(dd, *rect)
+
+    @journaled('flood_fill')
+    def flood_fill(self, d: int, idx: int, color: int) -> int:
+        """Recolor the 4-connected region of same-colored cells around (d, idx).
+
+        Returns the number of cells changed.
+        """
+        layer = self.layers[d]
+        size = layer.size
+        nodes = layer.nodes
+        target = nodes[idx]
+        if target == color:
+            return 0
+
+        # Spans are written one run at a time; rebuild the index lazily afterwards
+        self._color_index.pop(d, None)
+        filled = 0
+        stack = [idx]
+        while stack:
+            i = stack.pop()
+            if nodes[i] != target:
+                continue
+            cy, cx = divmod(i, size)
+            base = cy * size
+            left = cx
+            while left > 0 and nodes[base + left - 1] == target:
+                left -= 1
+            right = cx + 1
+            while right < size and nodes[base + right] == target:
+                right += 1
+            self.write_nodes(d, base + left, [color] * (right - left))
+            filled += right - left
+
+            for ny in (cy - 1, cy + 1):
+                if not 0 <= ny < size:
+                    continue
+                nbase = ny * size
+                x = left
+                while x < right:
+                    if nodes[nbase + x] == target:
+                        stack.append(nbase + x)
+                        while x < right and nodes[nbase + x] == target:
+                            x += 1
+                    x += 1
+        return filled
+
+    @journaled('subdivide_region')
+    def subdivide_region(self, d: int, x0: int, y0: int, x1: int, y1: int, to_depth: int):
+        """Propagate colors and payloads of a region at depth d down to to_depth"""
+        to_depth = min(to_depth, self.max_depth)
+        for dd in range(d, to_depth):
+            src = self.layers[dd]
+            dst_size = self.layers[dd + 1].size
+            for cy in range(y0, y1):
+                row = src.nodes[cy * src.size + x0:cy * src.size + x1]
+                doubled = [0] * (2 * len(row))
+                doubled[0::2] = row
+                doubled[1::2] = row
+                for ry in (2 * cy, 2 * cy + 1):
+                    self.write_nodes(dd + 1, ry * dst_size + 2 * x0, doubled)
+
+            if dd in self.payloads:
+                for i in list(self.payload_index(dd).iter_rect(x0, y0, x1, y1)):
+                    py, px = divmod(i, src.size)
+                    payload = self.payloads[dd][i]
+                    for ry in (2 * py, 2 * py + 1):
+                        for rx in (2 * px, 2 * px + 1):
+                            self.set_payload(dd + 1, ry * dst_size + rx, payload.copy())
+
+            x0, y0, x1, y1 = 2 * x0, 2 * y0, 2 * x1, 2 * y1
+
+    def copy_subtree(self, d: int, idx: int) -> 'Subtree':
+        """Return a detached copy of cell (d, idx) and everything beneath it"""
+        layers = []
+        payloads: Dict[int, Dict[int, Any]] = {}
+        for k, dd in enumerate(range(d, self.max_depth + 1)):
+            x0, y0, x1, y1 = self.subtree_rect(d, idx, dd)
+            size = self.layers[dd].size
+            nodes = self.layers[dd].nodes
+            n = x1 - x0
+            rel_nodes = []
+            for cy in range(y0, y1):
+                rel_nodes.extend(nodes[cy * size + x0:cy * size + x1])
+            layers.append(Layer(size=n, nodes=rel_nodes))
+
+            if dd in self.payloads:
+                for i in self.payload_index(dd).iter_rect(x0, y0, x1, y1):
+                    py, px = divmod(i, size)
+                    payloads.setdefault(k, {})[(py - y0) * n + (px - x0)] = copy.deepcopy(self.payloads[dd][i])
+        return Subtree(layers=layers, payloads=payloads)
+
+    @journaled('paste_subtree')
+    def paste_subtree(self, subtree: 'Subtree', d: int, idx: int):
+        """Replace cell (d, idx) and its descendants with a copied subtree"""
+        self.clear_subtree(d, idx)
+        depth_count = min(len(subtree.layers), self.max_depth - d + 1)
+        for k in range(depth_count):
+            dd = d + k
+            x0, y0, x1, y1 = self.subtree_rect(d, idx, dd)
+            size = self.layers[dd].size
+            src = subtree.layers[k]
+            n = src.size
+            for ry in range(n):
+                self.write_nodes(dd, (y0 + ry) * size + x0, src.nodes[ry * n:(ry + 1) * n])
+            for i, payload in subtree.payloads.get(k, {}).items():
+                py, px = divmod(i, n)
+                self.set_payload(dd, (y0 + py) * size + x0 + px, copy.deepcopy(payload))
+
+    # --- Diff and patch ---
+
+    def diff(self, other: 'Matrix') -> 'Patch':
+        """Return the patch that turns this matrix into other.
+
+        Only subtrees whose digests differ are visited, so the cost follows
+        the size of the change rather than the size of the matrix.
+        """
+        if other.max_depth != self.max_depth:
+            raise ValueError(f"cannot diff depth {self.max_depth} against depth {other.max_depth}")
+        patch = Patch(self.max_depth, self.content_hash(), other.content_hash())
+        frontier = [0] if patch.base != patch.target else []
+        for d in range(self.max_depth + 1):
+            if not frontier:
+                break
+            mine, theirs = self._hashes[d], other._hashes[d]
+            old_nodes, new_nodes = self.layers[d].nodes, other.layers[d].nodes
+            old_payloads, new_payloads = self.layer_payloads(d), other.layer_payloads(d)
+            size = self.layers[d].size
+            changed = []
+            children = []
+            for idx in sorted(frontier):
+                if mine[idx] == theirs[idx]:
+                    continue
+                if old_nodes[idx] != new_nodes[idx]:
+                    changed.append(idx)
+                old, new = old_payloads.get(idx), new_payloads.get(idx)
+                if old != new:
+                    patch.ops.append(('payload', d, idx, old, copy.deepcopy(new)))
+                if d < self.max_depth:
+                    cy, cx = divmod(idx, size)
+                    base = 4 * cy * size + 2 * cx
+                    children.extend((base, base + 1, base + 2 * size, base + 2 * size + 1))
+
+            # Collapse changed cells into contiguous node runs
+            run_start = None
+            for i, idx in enumerate(changed):
+                if run_start is None:
+                    run_start = idx
+                if i + 1 == len(changed) or changed[i + 1] != idx + 1:
+                    patch.ops.append(('nodes', d, run_start,
+                                      list(old_nodes[run_start:idx + 1]), list(new_nodes[run_start:idx + 1])))
+                    run_start = None
+            frontier = children
+        return patch
+
+    @journaled('apply_patch')
+    def apply_patch(self, patch: 'Patch', strict: bool = False):
+        """Apply a patch made by diff as one undoable edit.
+
+        With strict, the patch is only applied to a matrix matching its base.
+        """
+        if patch.max_depth != self.max_depth:
+            raise ValueError(f"patch for depth {patch.max_depth} cannot apply to depth {self.max_depth}")
+        if strict and self.content_hash() != patch.base:
+            raise ValueError("matrix does not match the patch base")
+        self.apply_ops(patch.ops)
+
+
+@dataclass
+class Subtree:
+    """Detached copy of a cell and its descendants, used for copy/paste"""
+    # layers[k] covers the copied cell at k levels below it (size 2**k)
+    layers: List[Layer] = field(default_factory=list)
+    payloads: Dict[int, Dict[int, Any]] = field(default_factory=dict)
+
+
+@dataclass
+class Patch:
+    """Difference between two matrices, as journal-style ops.
+
+    base and target are the content hashes before and after the patch.
+    """
+    max_depth: int
+    base: str
+    target: str
+    ops: List[tuple] = field(default_factory=list)
+
+    def inverse(self) -> 'Patch':
+        """Return the patch that undoes this one"""
+        ops = [(kind, d, pos, new, old) for kind, d, pos, old, new in reversed(self.ops)]
+        return Patch(self.max_depth, self.target, self.base, ops)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'max_depth': self.max_depth,
+            'base': self.base,
+            'target': self.target,
+            'ops': [list(op) for op in self.ops]
+        }
+
+    @classmethod
+    def from_json(cls, data: Any) -> 'Patch':
+        if not isinstance(data, dict) or not isinstance(data.get('ops'), list):
+            raise MatrixFormatError("patch must be an object with an 'ops' list")
+        max_depth = _check_int(data.get('max_depth'), "patch.max_depth", 0, 30)
+        ops = []
+        for i, op in enumerate(data['ops']):
+            where = f"patch.ops[{i}]"
+            if not isinstance(op, list) or len(op) != 5 or op[0] not in ('nodes', 'payload'):
+                raise MatrixFormatError(f"{where}: expected [kind, depth, position, old, new]")
+            kind, d, pos, old, new = op
+            _check_int(d, f"{where}.depth", 0, max_depth)
+            _check_int(pos, f"{where}.position", 0, (1 << d) ** 2 - 1)
+            if kind == 'nodes':
+                if not isinstance(old, list) or not isinstance(new, list) or len(old) != len(new) \
+                        or pos + len(new) > (1 << d) ** 2:
+                    raise MatrixFormatError(f"{where}: node runs must be equal-length lists inside the layer")
+                for color in old + new:
+                    _check_int(color, f"{where}.nodes", 0, MAX_COLOR)
+            else:
+                for payload in (old, new):
+                    if payload is not None:
+                        validate_payload(payload, where)
+            ops.append((kind, d, pos, old, new))
+        return cls(max_depth, str(data.get('base', '')), str(data.get('target', '')), ops)
+
+
+def _payload_size(payload: Optional[Dict[str, Any]]) -> int:
+    """Rough in-memory footprint of a payload, in bytes"""
+    if not payload:
+        return 0
+    return sum(len(v) if isinstance(v, str) else 16 for v in payload.values())
+
+
+@dataclass
+class Edit:
+    """One undoable edit as compact deltas.
+
+    Each op is (kind, depth, position, old, new): 'nodes' ops carry the old
+    and new values of a contiguous node run starting at position, 'payload'
+    ops carry the old and new payload of one cell (None when absent).
+    """
+    label: str
+    ops: List[tuple] = field(default_factory=list)
+    size: int = 0
+
+    def add(self, op: tuple):
+        if op[0] == 'nodes' and self.ops:
+            last = self.ops[-1]
+            # Merge runs that continue the previous write
+            if last[0] == 'nodes' and last[1] == op[1] and last[2] + len(last[4]) == op[2]:
+                last[3].extend(op[3])
+                last[4].extend(op[4])
+                self.size += 16 * len(op[4])
+                return
+        self.ops.append(op)
+        if op[0] == 'nodes':
+            self.size += 64 + 16 * len(op[4])
+        else:
+            self.size += 64 + _payload_size(op[3]) + _payload_size(op[4])
+
+    def records(self, undo: bool = False) -> List[list]:
+        """Return the ops as absolute [kind, depth, position, value] records.
+
+        These carry only the resulting values, so they can be logged or sent
+        to another copy of the matrix and applied with Matrix.apply_records.
+        """
+        ops = reversed(self.ops) if undo else self.ops
+        return [[kind, d, pos, old if undo else new] for kind, d, pos, old, new in ops]
+
+
+class Journal:
+    """Bounded undo/redo history of Matrix edits.
+
+    The oldest edits are dropped once the history exceeds max_bytes or
+    max_edits, so memory stays bounded regardless of context size.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_edits: int = 1000):
+        self.max_bytes = max_bytes
+        self.max_edits = max_edits
+        self.undo_stack: Deque[Edit] = deque()
+        self.redo_stack: List[Edit] = []
+        self.bytes = 0
+        self.current: Optional[Edit] = None
+        self.depth = 0
+        self.recording = True
+        # Called as listener(edit, undo) whenever an edit is committed, undone or redone
+        self.listeners = []
+
+    def begin(self, label: str):
+        if self.depth == 0:
+            self.current = Edit(label)
+        self.depth += 1
+
+    def end(self):
+        self.depth -= 1
+        if self.depth == 0:
+            edit, self.current = self.current, None
+            if edit.ops:
+                self.commit(edit)
+
+    def record(self, op: tuple):
+        if not self.recording:
+            return
+        if self.current is not None:
+            self.current.add(op)
+            return
+        edit = Edit(op[0])
+        edit.add(op)
+        self.commit(edit)
+
+    def commit(self, edit: Edit):
+        for undone in self.redo_stack:
+            self.bytes -= undone.size
+        self.redo_stack.clear()
+        self.undo_stack.append(edit)
+        self.bytes += edit.size
+        self._notify(edit, undo=False)
+        while len(self.undo_stack) > 1 and (self.bytes > self.max_bytes or len(self.undo_stack) > self.max_edits):
+            self.bytes -= self.undo_stack.popleft().size
+
+    def clear(self):
+        """Forget all history, e.g. after the matrix content was replaced wholesale"""
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.bytes = 0
+
+    def _notify(self, edit: Edit, undo: bool):
+        for listener in self.listeners:
+            listener(edit, undo)
+
+    def _apply(self, matrix: Matrix, edit: Edit, undo: bool):
+        self.recording = False
+        try:
+            matrix.apply_ops(edit.ops, undo=undo)
+        finally:
+            self.recording = True
+
+    def undo(self, matrix: Matrix) -> bool:
+        if not self.undo_stack:
+            return False
+        edit = self.undo_stack.pop()
+        self._apply(matrix, edit, undo=True)
+        self.redo_stack.append(edit)
+        self._notify(edit, undo=True)
+        return True
+
+    def redo(self, matrix: Matrix) -> bool:
+        if not self.redo_stack:
+            return False
+        edit = self.redo_stack.pop()
+        self._apply(matrix, edit, undo=False)
+        self.undo_stack.append(edit)
+        self._notify(edit, undo=False)
+        return True
+
+    def replay(self, matrix: Matrix):
+        """Apply the retained history, oldest first, to another matrix.
+
+        The target must match the state the oldest retained edit was made on.
+        """
+        for edit in self.undo_stack:
+            with matrix.edit(edit.label):
+                matrix.apply_ops(edit.ops)
+
+
+def _check_int(value: Any, where: str, minimum: int = 0, maximum: Optional[int] = None) -> int:
+    if value.__class__ is not int or value < minimum or (maximum is not None and value > maximum):
+        bounds = f">= {minimum}" if maximum is None else f"in [{minimum}, {maximum}]"
+        raise MatrixFormatError(f"{where}: expected an integer {bounds}, got {value!r}")
+    return value
+
+
+def validate_payload(payload: Any, where: str):
+    """Check the shape of one payload dict"""
+    if not isinstance(payload, dict):
+        raise MatrixFormatError(f"{where}: payload must be an object")
+    kind = payload.get('type')
+    if kind == 'text':
+        if not isinstance(payload.get('text'), str):
+            raise MatrixFormatError(f"{where}: text payload needs a 'text' string")
+        color = payload.get('color', [0, 0, 0])
+        if not isinstance(color, list) or len(color) != 3:
+            raise MatrixFormatError(f"{where}: text color must be [r, g, b]")
+        for channel in color:
+            _check_int(channel, f"{where}.color", 0, 255)
+    elif kind == 'code':
+        if not isinstance(payload.get('code'), str) or not isinstance(payload.get('language', ''), str):
+            raise MatrixFormatError(f"{where}: code payload needs 'code' and 'language' strings")
+    elif kind == 'image':
+        if not isinstance(payload.get('data'), str):
+            raise MatrixFormatError(f"{where}: image payload needs a base64 'data' string")
+    else:
+        raise MatrixFormatError(f"{where}: unknown payload type {kind!r}")
+
+
+def parse_payload_pool(pool: Dict[str, Any], layer_sizes: Optional[List[int]] = None,
+                       blobs: Optional[Dict[str, Any]] = None) -> Dict[int, Dict[int, Any]]:
+    """Convert a serialized "d:idx" keyed payload pool into a per-depth index.
+
+    With layer_sizes given, keys and payload shapes are validated as they
+    are converted. Entries of the form {"$ref": digest} are resolved against
+    blobs and share one payload object.
+    """
+    if not isinstance(pool, dict):
+        raise MatrixFormatError("payload_pool must be an object")
+    if blobs is None:
+        blobs = {}
+    elif not isinstance(blobs, dict):
+        raise MatrixFormatError("payload_blobs must be an object")
+    elif layer_sizes is not None:
+        for digest, payload in blobs.items():
+            validate_payload(payload, f"payload_blobs[{digest!r}]")
+    payloads = {}
+    for key, payload in pool.items():
+        try:
+            d, idx = (int(part) for part in key.split(':', 1))
+        except ValueError:
+            raise MatrixFormatError(f"payload_pool: malformed key {key!r}") from None
+        if isinstance(payload, dict) and '$ref' in payload:
+            ref = payload['$ref']
+            if ref not in blobs:
+                raise MatrixFormatError(f"payload_pool[{key!r}]: unknown payload reference {ref!r}")
+            payload = blobs[ref]
+        elif layer_sizes is not None:
+            validate_payload(payload, f"payload_pool[{key!r}]")
+        if layer_sizes is not None:
+            if not 0 <= d < len(layer_sizes) or not 0 <= idx < layer_sizes[d] ** 2:
+                raise MatrixFormatError(f"payload_pool[{key!r}]: cell is outside the matrix")
+        payloads.setdefault(d, {})[idx] = payload
+    return payloads
+
+
+def build_payload_pool(payloads: Dict[int, Dict[int, Any]], dedup: bool = False) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Convert a per-depth payload index back to the serialized "d:idx" form.
+
+    Returns (pool, blobs). With dedup, payloads stored in more than one cell
+    are written once to blobs and referenced from the pool by digest.
+    """
+    pool = {}
+    refs = {}
+    for d in sorted(payloads):
+        for idx in sorted(payloads[d]):
+            payload = payloads[d][idx]
+            pool[f"{d}:{idx}"] = payload
+            if dedup:
+                refs.setdefault(payload_digest(payload).hex(), []).append(f"{d}:{idx}")
+
+    blobs = {}
+    for digest, keys in refs.items():
+        if len(keys) > 1:
+            blobs[digest] = pool[keys[0]]
+            for key in keys:
+                pool[key] = {'$ref': digest}
+    return pool, blobs
+
+
+MIGRATIONS: Dict[int, Callable[[Dict[str, Any]], Dict[str, Any]]] = {}
+
+
+def migration(from_version: int):
+    """Register a function upgrading parsed file data from from_version to the next"""
+    def register(upgrade):
+        MIGRATIONS[from_version] = upgrade
+        return upgrade
+    return register
+
+
+def _css_to_rgb(color: Any) -> Any:
+    """Convert '#rgb', '#rrggbb' or 'rgb(r, g, b)' to [r, g, b]; leave other values alone"""
+    if not isinstance(color, str):
+        return color
+    text = color.strip().lower()
+    try:
+        if text.startswith('#'):
+            digits = text[1:]
+            if len(digits) == 3:
+                digits = ''.join(ch * 2 for ch in digits)
+            value = int(digits, 16)
+            return [(value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF]
+        if text.startswith('rgb(') and text.endswith(')'):
+            return [int(part) for part in text[4:-1].split(',')][:3]
+    except ValueError:
+        pass
+    return [0, 0, 0]
+
+
+@migration(1)
+def _upgrade_v1(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Version 1 files exported by nodes.html use camelCase keys, CSS text colors and data-URL images"""
+    for camel, snake in (('quadtreeSize', 'quadtree_size'), ('maxDepth', 'max_depth'), ('payloadPool', 'payload_pool')):
+        if camel in data and snake not in data:
+            data[snake] = data.pop(camel)
+    pool = data.get('payload_pool')
+    if isinstance(pool, dict):
+        for payload in pool.values():
+            if not isinstance(payload, dict):
+                continue
+            if payload.get('type') == 'text' and 'color' in payload:
+                payload['color'] = _css_to_rgb(payload['color'])
+            elif payload.get('type') == 'image' and isinstance(payload.get('data'), str) and payload['data'].startswith('data:'):
+                payload['data'] = payload['data'].split(',', 1)[-1]
+            elif payload.get('type') == 'code':
+                payload.setdefault('language', 'python')
+    return data
+
+
+def migrate_matrix_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Upgrade parsed file data to MATRIX_FORMAT_VERSION"""
+    version = _check_int(data.get('version', 1), "version", 1)
+    if 'quadtreeSize' in data and 'quadtree_size' not in data:
+        # nodes.html exports are always in the version 1 layout, but older
+        # pages stamped them with the version of the file they had loaded
+        version = 1
+    if version > MATRIX_FORMAT_VERSION:
+        raise MatrixFormatError(f"file format version {version} is newer than this editor ({MATRIX_FORMAT_VERSION})")
+    while version < MATRIX_FORMAT_VERSION:
+        if version not in MIGRATIONS:
+            raise MatrixFormatError(f"no migration from format version {version}")
+        data = MIGRATIONS[version](data)
+        version += 1
+        data['version'] = version
+    return data
+
+
+def _layer_from_data(d: int, layer_data: Any, lazy: bool) -> Layer:
+    """Validate one serialized layer and turn it into a Layer"""
+    where = f"layers[{d}]"
+    if not isinstance(layer_data, dict):
+        raise MatrixFormatError(f"{where}: layer must be an object")
+    size = layer_data.get('size')
+    if size != 1 << d:
+        raise MatrixFormatError(f"{where}: size must be {1 << d}, got {size!r}")
+
+    if 'encoding' in layer_data:
+        encoding = layer_data['encoding']
+        if encoding not in ('u32',) + COMPRESSED_ENCODINGS or not isinstance(layer_data.get('data'), str):
+            raise MatrixFormatError(f"{where}: unsupported layer encoding {encoding!r}")
+        if encoding == 'palette-zlib':
+            palette = layer_data.get('palette')
+            if not isinstance(palette, list) or len(palette) > 256:
+                raise MatrixFormatError(f"{where}: palette must be a list of at most 256 colors")
+            for color in palette:
+                _check_int(color, f"{where}.palette", 0, MAX_COLOR)
+        # Node counts of encoded layers are checked when they are decoded
+        layer = Layer(size=size, encoded=layer_data)
+        if not lazy:
+            layer.load()
+        return layer
+
+    nodes = layer_data.get('nodes')
+    if not isinstance(nodes, list) or len(nodes) != size * size:
+        found = len(nodes) if isinstance(nodes, list) else type(nodes).__name__
+        raise MatrixFormatError(f"{where}: expected {size * size} nodes, found {found}")
+    for i, color in enumerate(nodes):
+        if color.__class__ is not int or not 0 <= color <= MAX_COLOR:
+            raise MatrixFormatError(f"{where}.nodes[{i}]: invalid color {color!r}")
+    return Layer(size=size, nodes=nodes)
+
+
+def matrix_from_data(data: Any, lazy: bool = True) -> Matrix:
+    """Migrate, validate and convert parsed file data into a Matrix.
+
+    Every layer and payload is checked once while it is converted, so a bad
+    file is rejected here instead of failing later at render time.
+    """
+    if not isinstance(data, dict):
+        raise MatrixFormatError("matrix file must contain a JSON object")
+    data = migrate_matrix_data(data)
+
+    quadtree_size = _check_int(data.get('quadtree_size'), "quadtree_size", 1)
+    max_depth = _check_int(data.get('max_depth'), "max_depth", 0, 30)
+    layers_data = data.get('layers')
+    if not isinstance(layers_data, list) or len(layers_data) != max_depth + 1:
+        raise MatrixFormatError(f"layers: expected {max_depth + 1} layers for max_depth {max_depth}")
+
+    # Process layers (compressed layers are decoded on first access)
+    layers = [_layer_from_data(d, layer_data, lazy) for d, layer_data in enumerate(layers_data)]
+    payloads = parse_payload_pool(data.get('payload_pool', {}), [layer.size for layer in layers],
+                                  data.get('payload_blobs'))
+
+    return Matrix(
+        quadtree_size=quadtree_size,
+        max_depth=max_depth,
+        version=data['version'],
+        layers=layers,
+        payloads=payloads
+    )
+
+
+def read_matrix(filepath: str, lazy: bool = True) -> Matrix:
+    """Read a matrix snapshot written by write_matrix (or an older file)"""
+    with open(filepath, 'rb') as f:
+        return matrix_from_data(_json_loads(f.read()), lazy)
+
+
+def matrix_to_data(matrix: Matrix, layer_format: str = LAYER_COMPRESSED, compact: bool = True) -> Dict[str, Any]:
+    """Return the file representation of a matrix (the inverse of matrix_from_data)"""
+    pool, blobs = build_payload_pool(matrix.payloads, dedup=compact)
+    data = {
+        'version': matrix.version,
+        'quadtree_size': matrix.quadtree_size,
+        'max_depth': matrix.max_depth,
+        'layers': [layer.to_json(layer_format) for layer in matrix.layers],
+        'payload_pool': pool
+    }
+    if blobs:
+        data['payload_blobs'] = blobs
+    return data
+
+
+def write_matrix(matrix: Matrix, filepath: str, layer_format: str = LAYER_COMPRESSED, compact: bool = True):
+    """Write a full matrix snapshot, replacing filepath atomically.
+
+    compact drops indentation and whitespace; orjson is used when installed.
+    Compact snapshots also store repeated payloads only once.
+    """
+    data = matrix_to_data(matrix, layer_format, compact)
+    tmp_path = filepath + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_json_dumps(data, compact))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+    _fsync_directory(filepath)
+
+
+def _fsync_directory(filepath: str):
+    """Make a rename or unlink next to filepath durable (skipped where unsupported)"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(filepath)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def replay_change_log(matrix: Matrix, wal_path: str) -> int:
+    """Apply the records of an autosave change log to a matrix.
+
+    Records hold absolute values, so replaying a log onto a snapshot that
+    already contains some of its edits is harmless. A torn final line left
+    by a crash is ignored. Returns the number of records applied.
+    """
+    applied = 0
+    with open(wal_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            matrix.apply_records(record['ops'])
+            applied += 1
+    return applied
+
+
+def discard_change_log(filepath: str):
+    """Remove the autosave change log of filepath, if any"""
+    wal_path = filepath + '.wal'
+    if os.path.exists(wal_path):
+        os.remove(wal_path)
+        _fsync_directory(wal_path)
+
+
+class AutosaveLog:
+    """Append-only change log kept next to a matrix file.
+
+    Each journaled edit is appended to <file>.wal as one JSON line holding
+    only the new values it wrote, so saving costs O(change). The log is
+    folded into a full snapshot every compact_every records or
+    compact_interval seconds. The snapshot at filepath must already hold
+    the matrix's current state; the log starts out empty.
+    """
+
+    def __init__(self, matrix: Matrix, filepath: str, compact_every: int = 200, compact_interval: float = 60.0):
+        self.matrix = matrix
+        self.filepath = filepath
+        self.wal_path = filepath + '.wal'
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self.pending = 0
+        self.last_compact = time.monotonic()
+        self.wal = open(self.wal_path, 'a', encoding='utf-8')
+        self.reset()
+        matrix.journal.listeners.append(self.on_edit)
+
+    def on_edit(self, edit: Edit, undo: bool):
+        record = {'label': edit.label, 'ops': edit.records(undo)}
+        self.wal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.wal.flush()
+        os.fsync(self.wal.fileno())
+        self.pending += 1
+        if self.pending >= self.compact_every:
+            self.compact()
+
+    def maybe_compact(self):
+        """Compact if edits are pending and the interval has elapsed"""
+        if self.pending and time.monotonic() - self.last_compact >= self.compact_interval:
+            self.compact()
+
+    def compact(self):
+        """Write a full snapshot and truncate the change log"""
+        # write_matrix has made the snapshot durable before the log goes
+        write_matrix(self.matrix, self.filepath)
+        self.reset()
+
+    def reset(self):
+        """Empty the change log after a snapshot holding all of its edits was written"""
+        self.wal.truncate(0)
+        self.wal.seek(0)
+        os.fsync(self.wal.fileno())
+        self.pending = 0
+        self.last_compact = time.monotonic()
+
+    def close(self):
+        if self.pending:
+            self.compact()
+        self.matrix.journal.listeners.remove(self.on_edit)
+        self.wal.close()
+        if os.path.exists(self.wal_path) and os.path.getsize(self.wal_path) == 0:
+            os.remove(self.wal_path)
+
+
+# --- Session mode: sharing a context through a server.py coordinator ---
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+WS_OP_CONTINUATION = 0x0
+WS_OP_TEXT = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+
+
+def websocket_accept(key: str) -> str:
+    """Return the Sec-WebSocket-Accept value for a handshake key"""
+    digest = hashlib.sha1((key + WS_GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class WebSocket:
+    """RFC 6455 message framing over an already upgraded connection.
+
+    Clients must mask the frames they send, servers must not, so the role
+    decides how outgoing frames are written. Sending is thread-safe;
+    receiving is meant for a single reader thread.
+    """
+
+    def __init__(self, rfile, wfile, client: bool = False, sock: Optional[socket.socket] = None):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.client = client
+        self.sock = sock
+        self.closed = False
+        self.send_lock = threading.Lock()
+
+    def _read_exact(self, count: int) -> bytes:
+        data = self.rfile.read(count)
+        if len(data) < count:
+            raise WebSocketClosed("connection lost")
+        return data
+
+    def _read_frame(self) -> Tuple[bool, int, bytes]:
+        first, second = self._read_exact(2)
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        masked = bool(second & 0x80)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read_exact(8))[0]
+        if masked == self.client:
+            # Frames from clients are always masked, frames from servers never
+            self.close(1002)
+            raise WebSocketClosed("bad frame masking")
+        if length > WS_MAX_MESSAGE_BYTES:
+            self.close(1009)
+            raise WebSocketClosed("message too large")
+        mask = self._read_exact(4) if masked else b''
+        data = self._read_exact(length)
+        if masked:
+            data = _ws_mask(data, mask)
+        return fin, opcode, data
+
+    def receive(self) -> Optional[str]:
+        """Return the next text message, or None once the connection is closed"""
+        parts: List[bytes] = []
+        size = 0
+        while True:
+            try:
+                fin, opcode, data = self._read_frame()
+            except (WebSocketClosed, OSError, ValueError):
+                self.closed = True
+                return None
+            if opcode == WS_OP_PING:
+                self._send_frame(WS_OP_PONG, data)
+                continue
+            if opcode == WS_OP_PONG:
+                continue
+            if opcode == WS_OP_CLOSE:
+                self.close(struct.unpack('!H', data[:2])[0] if len(data) >= 2 else 1000)
+                return None
+            if opcode not in (WS_OP_TEXT, WS_OP_BINARY, WS_OP_CONTINUATION) or (opcode == WS_OP_CONTINUATION) != bool(parts):
+                self.close(1002)
+                return None
+            parts.append(data)
+            size += len(data)
+            if size > WS_MAX_MESSAGE_BYTES:
+                self.close(1009)
+                return None
+            if fin:
+                try:
+                    return b''.join(parts).decode('utf-8')
+                except UnicodeDecodeError:
+                    self.close(1007)
+                    return None
+
+    def _send_frame(self, opcode: int, data: bytes):
+        header = bytearray([0x80 | opcode])
+        mask_bit = 0x80 if self.client else 0
+        length = len(data)
+        if length < 126:
+            header.append(mask_bit | length)
+        elif length < 1 << 16:
+            header.append(mask_bit | 126)
+            header += struct.pack('!H', length)
+        else:
+            header.append(mask_bit | 127)
+            header += struct.pack('!Q', length)
+        if self.client:
+            mask = os.urandom(4)
+            header += mask
+            data = _ws_mask(data, mask)
+        with self.send_lock:
+            if self.closed and opcode != WS_OP_CLOSE:
+                raise WebSocketClosed("connection closed")
+            self.wfile.write(bytes(header) + data)
+            self.wfile.flush()
+
+    def send(self, text: str):
+        """Send one text message"""
+        self._send_frame(WS_OP_TEXT, text.encode('utf-8'))
+
+    def send_json(self, message: Any):
+        self.send(json.dumps(message, separators=(',', ':')))
+
+    def close(self, code: int = 1000):
+        if self.closed:
+            return
+        try:
+            self._send_frame(WS_OP_CLOSE, struct.pack('!H', code))
+        except OSError:
+            pass
+        self.closed = True
+        if self.sock is not None:
+            # Wakes up a reader blocked in receive()
+            with contextlib.suppress(OSError):
+                self.sock.shutdown(socket.SHUT_RDWR)
+
+
+def _ws_mask(data: bytes, mask: bytes) -> bytes:
+    # XOR a whole message at once through big integers instead of byte by byte
+    length = len(data)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')).to_bytes(length, 'little')
+
+
+def websocket_connect(host: str, port: int, path: str, timeout: float = 10.0) -> WebSocket:
+    """Open a client WebSocket to ws://host:port/path"""
+    sock = socket.create_connection((host, port), timeout)
+    try:
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        sock.sendall((f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\n"
+                      f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode('latin-1'))
+        rfile = sock.makefile('rb')
+        status = rfile.readline().decode('latin-1').split()
+        headers = {}
+        while True:
+            line = rfile.readline().decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(status) < 2 or status[1] != '101' or headers.get('sec-websocket-accept') != websocket_accept(key):
+            raise ConnectionError(f"WebSocket handshake with {host}:{port}{path} failed: {' '.join(status)}")
+    except BaseException:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return WebSocket(rfile, sock.makefile('wb'), client=True, sock=sock)
+
+
+class SessionClient:
+    """Local copy of a context shared through a server.py coordinator.
+
+    Local edits are applied at once and sent to the coordinator as absolute
+    records. The coordinator numbers every edit it applies and broadcasts
+    it to all clients, so every copy converges on its order: for each cell
+    the edit with the highest sequence number wins. Remote edits go under
+    this client's edits that the coordinator has not echoed back yet, which
+    are re-applied on top until it does. If the coordinator rejects one of
+    them, the local copy is rebuilt from its snapshot.
+    """
+
+    def __init__(self, url: str):
+        parts = urlsplit(url if '//' in url else f"http://{url}")
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 8765
+        self.ctx_id = unquote(parts.path.strip('/')) or 'default'
+        self.matrix: Optional[Matrix] = None
+        self.ws: Optional[WebSocket] = None
+        self.client_id = None
+        # Sequence number of the last coordinator edit reflected locally
+        self.seq = 0
+        self.next_client_seq = 0
+        # (client_seq, records) sent but not yet echoed by the coordinator
+        self.pending: Deque[Tuple[int, List[list]]] = deque()
+        self.inbox: queue.Queue = queue.Queue()
+        self.connected = False
+        # Reasons the coordinator gave for rejected edits, for the UI to show
+        self.errors: List[str] = []
+
+    @property
+    def label(self) -> str:
+        return f"{self.ctx_id}@{self.host}:{self.port}"
+
+    def connect(self) -> Matrix:
+        """Join the session and return the local copy of its context"""
+        path = quote(self.ctx_id, safe='')
+        # Subscribe before taking the snapshot so no later edit can be missed
+        self.ws = websocket_connect(self.host, self.port, f"/ws/{path}")
+        try:
+            hello = json.loads(self.ws.receive() or 'null')
+            if not isinstance(hello, dict) or hello.get('type') != 'hello':
+                raise ConnectionError(f"unexpected greeting from {self.host}:{self.port}")
+            self.client_id = hello['client']
+            threading.Thread(target=self._read, daemon=True).start()
+            matrix, self.seq = self._fetch_snapshot()
+        except BaseException:
+            self.ws.close()
+            raise
+        matrix.journal = Journal()
+        matrix.journal.listeners.append(self.on_edit)
+        self.matrix = matrix
+        self.connected = True
+        return matrix
+
+    def _fetch_snapshot(self) -> Tuple[Matrix, int]:
+        """Download the coordinator's copy of the context and the seq it reflects"""
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            conn.request('GET', f"/api/contexts/{quote(self.ctx_id, safe='')}/file")
+            response = conn.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise ConnectionError(f"could not fetch {self.ctx_id}: HTTP {response.status}")
+            seq = int(response.getheader('X-Session-Seq', 0))
+        finally:
+            conn.close()
+        return matrix_from_data(_json_loads(body)), seq
+
+    def _read(self):
+        while True:
+            text = self.ws.receive()
+            if text is None:
+                self.inbox.put(None)
+                return
+            try:
+                self.inbox.put(json.loads(text))
+            except ValueError:
+                continue
+
+    def on_edit(self, edit: Edit, undo: bool):
+        if not self.connected:
+            return
+        self.next_client_seq += 1
+        records = edit.records(undo)
+        self.pending.append((self.next_client_seq, records))
+        try:
+            self.ws.send_json({'op': 'records', 'label': edit.label, 'records': records,
+                               'client_seq': self.next_client_seq})
+        except (OSError, WebSocketClosed):
+            self.connected = False
+
+    def _acknowledge(self, client_seq: Optional[int]):
+        while self.pending and client_seq is not None and self.pending[0][0] <= client_seq:
+            self.pending.popleft()
+
+    def _reject(self, client_seq: Optional[int]):
+        self.pending = deque(entry for entry in self.pending if entry[0] != client_seq)
+
+    def _apply_remote(self, records: List[list]):
+        journal = self.matrix.journal
+        journal.recording = False
+        try:
+            self.matrix.apply_records(records)
+            for _, own in self.pending:
+                self.matrix.apply_records(own)
+        finally:
+            journal.recording = True
+
+    def _dispatch(self, message: Dict[str, Any], apply: bool = True) -> bool:
+        """Handle one coordinator message; return True if it changed the local copy.
+
+        With apply unset, remote edits only advance seq; used while catching
+        up to a snapshot that already holds them.
+        """
+        kind = message.get('type')
+        if kind == 'ops':
+            if message['seq'] <= self.seq:
+                # Already part of the snapshot
+                return False
+            self.seq = message['seq']
+            if message.get('client') == self.client_id:
+                # One of ours, now in its final place in the order
+                self._acknowledge(message.get('client_seq'))
+            elif apply:
+                self._apply_remote(message['ops'])
+                return True
+        elif kind == 'ack':
+            self._acknowledge(message.get('client_seq'))
+        elif kind == 'error':
+            self._reject(message.get('client_seq'))
+            self.errors.append(str(message.get('message')))
+        return False
+
+    def poll(self) -> bool:
+        """Apply messages received since the last call; return True if the matrix changed"""
+        changed = False
+        rejected = False
+        while True:
+            try:
+                message = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                self.connected = False
+                break
+            rejected = rejected or message.get('type') == 'error'
+            changed = self._dispatch(message) or changed
+        if rejected and self.connected:
+            # The rejected edit is still applied locally
+            self.resync()
+            changed = True
+        return changed
+
+    def resync(self):
+        """Rebuild the local copy from the coordinator's snapshot.
+
+        Every edit numbered up to the snapshot's seq was queued to this
+        client before the snapshot was taken, so those messages are read
+        first: they tell which of our pending edits the snapshot already
+        holds. The remaining ones are re-applied on top of it.
+        """
+        try:
+            snapshot, seq = self._fetch_snapshot()
+            while self.seq < seq:
+                message = self.inbox.get(timeout=30)
+                if message is None:
+                    raise ConnectionError("connection lost")
+                self._dispatch(message, apply=False)
+        except (OSError, ValueError, http.client.HTTPException, queue.Empty):
+            self.connected = False
+            return
+        journal = self.matrix.journal
+        journal.recording = False
+        try:
+            self.matrix.replace_content(snapshot)
+            for _, own in self.pending:
+                self.matrix.apply_records(own)
+        finally:
+            journal.recording = True
+        # The history describes edits to the copy that was just replaced
+        journal.clear()
+
+    def close(self):
+        self.connected = False
+        if self.matrix is not None and self.on_edit in self.matrix.journal.listeners:
+            self.matrix.journal.listeners.remove(self.on_edit)
+        if self.ws is not None:
+            self.ws.close()
 
 
 class Button:
@@ -509,6 +2395,393 @@ class Modal:
         return False
 
 
+class OutputLog:
+    """Line-indexed execution output with a cap on the lines kept in memory.
+
+    Only the last max_lines lines are held in a ring buffer; the complete
+    output is appended to a temp file (log_path) as it arrives. Line
+    indexes are absolute, counted from the start of the output, so lines
+    dropped from the front stay addressable via first_line.
+
+    The temp file is created on the first write and deleted by close();
+    whoever holds the log owns it, and it can be used as a context
+    manager. Output written after close() is only kept in memory.
+    """
+
+    def __init__(self, text: str = "", max_lines: int = 100_000):
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+        self.first_line = 0
+        self.partial = ""
+        self.log_file = None
+        self.log_path: Optional[str] = None
+        self.closed = False
+        if text:
+            self.write(text)
+
+    def write(self, text: str):
+        """Append output, completing any unterminated last line"""
+        if self.log_file is None and not self.closed:
+            self.log_file = tempfile.NamedTemporaryFile(
+                'w', encoding='utf-8', prefix='quadtree_output_', suffix='.log', delete=False)
+            self.log_path = self.log_file.name
+        if self.log_file is not None:
+            self.log_file.write(text)
+        pieces = (self.partial + text).split('\n')
+        self.partial = pieces.pop()
+        overflow = len(self.lines) + len(pieces) - self.lines.maxlen
+        if overflow > 0:
+            self.first_line += overflow
+        self.lines.extend(pieces)
+
+    def flush(self):
+        if self.log_file is not None:
+            self.log_file.flush()
+
+    def __len__(self) -> int:
+        """Absolute number of lines, including the unterminated last one"""
+        return self.first_line + len(self.lines) + 1
+
+    def line(self, number: int) -> str:
+        """Return a line by absolute number ('' for lines no longer held)"""
+        i = number - self.first_line
+        if i == len(self.lines):
+            return self.partial
+        if 0 <= i < len(self.lines):
+            return self.lines[i]
+        return ""
+
+    def text(self) -> str:
+        """Return the retained output as one string"""
+        return '\n'.join(list(self.lines) + [self.partial])
+
+    def __str__(self) -> str:
+        return self.text()
+
+    def search(self, needle: str, start: int = 0) -> Optional[int]:
+        """Return the next retained line at or after start containing needle, wrapping around"""
+        if not needle:
+            return None
+        needle = needle.lower()
+        lines = self.lines
+        # Position len(lines) stands for the unfinished partial line
+        offset = max(0, start - self.first_line) % (len(lines) + 1)
+        # Walk the deque with islice; indexing into its middle is O(n) per line
+        for i, line in enumerate(itertools.islice(lines, offset, None), offset):
+            if needle in line.lower():
+                return self.first_line + i
+        if needle in self.partial.lower():
+            return self.first_line + len(lines)
+        for i, line in enumerate(itertools.islice(lines, offset)):
+            if needle in line.lower():
+                return self.first_line + i
+        return None
+
+    def close(self):
+        """Delete the full log file; safe to call more than once"""
+        self.closed = True
+        if self.log_file is None:
+            return
+        self.log_file.close()
+        self.log_file = None
+        try:
+            os.remove(self.log_path)
+        except OSError:
+            pass
+
+    def __enter__(self) -> 'OutputLog':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ExecutionJob:
+    """A running code execution whose output is captured as it is produced.
+
+    Reader threads push (stream, text) chunks onto a queue; poll() moves
+    them into log and on_output from the caller's thread, and kills the
+    process once its deadline passes. Output produced before a timeout
+    or cancel is kept. The caller owns log and should close() it once
+    the output is no longer needed.
+    """
+
+    def __init__(self, args: List[str], timeout: float = 5.0,
+                 on_output: Optional[Callable[[str, str], None]] = None,
+                 max_lines: int = 100_000, cleanup: Optional[str] = None):
+        self.log = OutputLog(max_lines=max_lines)
+        self.on_output = on_output
+        self.timeout = timeout
+        self.cleanup = cleanup
+        self.chunks: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self.returncode: Optional[int] = None
+        self.timed_out = False
+        self.cancelled = False
+        # Set if the readers were still running when the job finished
+        self.truncated = False
+        self.deadline = time.monotonic() + timeout
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.readers = [
+            threading.Thread(target=self._read, args=(name, pipe), daemon=True)
+            for name, pipe in (('stdout', self.process.stdout), ('stderr', self.process.stderr))
+        ]
+        for reader in self.readers:
+            reader.start()
+
+    def _read(self, stream: str, pipe):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for data in iter(functools.partial(pipe.read1, 1 << 16), b''):
+            text = decoder.decode(data)
+            if text:
+                self.chunks.put((stream, text))
+        text = decoder.decode(b'', final=True)
+        if text:
+            self.chunks.put((stream, text))
+        pipe.close()
+
+    def _emit(self, stream: str, text: str):
+        self.log.write(text)
+        if self.on_output:
+            self.on_output(stream, text)
+
+    @property
+    def done(self) -> bool:
+        return self.returncode is not None
+
+    @property
+    def success(self) -> bool:
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    def cancel(self):
+        """Stop the process; the output so far is kept"""
+        if self.process.poll() is None:
+            self.cancelled = True
+            self.process.kill()
+
+    def poll(self) -> List[Tuple[str, str]]:
+        """Deliver the chunks captured since the last call and check for exit"""
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.chunks.get_nowait())
+            except queue.Empty:
+                break
+        for stream, text in chunks:
+            self._emit(stream, text)
+        if self.returncode is None:
+            if self.process.poll() is None:
+                if time.monotonic() < self.deadline:
+                    return chunks
+                self.timed_out = True
+                self.process.kill()
+            self._finish(chunks)
+        return chunks
+
+    def _finish(self, chunks: List[Tuple[str, str]]):
+        self.process.wait()
+        for reader in self.readers:
+            reader.join(timeout=1.0)
+        # A process the code started can keep the pipes open after the job exits
+        self.truncated = any(reader.is_alive() for reader in self.readers)
+        self._drain(chunks)
+        self.returncode = self.process.returncode
+        self.log.flush()
+        if self.cleanup:
+            try:
+                os.remove(self.cleanup)
+            except OSError:
+                pass
+
+    def _drain(self, chunks: List[Tuple[str, str]]):
+        # Deliver what is left in the queue, then say why the run stopped early
+        while not self.chunks.empty():
+            stream, text = self.chunks.get_nowait()
+            self._emit(stream, text)
+            chunks.append((stream, text))
+        if self.timed_out or self.cancelled:
+            reason = f"timed out ({self.timeout:g}s limit)" if self.timed_out else "cancelled"
+            note = f"\nExecution {reason}\n"
+            self._emit('stderr', note)
+            chunks.append(('stderr', note))
+        if self.truncated:
+            note = "\n[output truncated]\n"
+            self._emit('stderr', note)
+            chunks.append(('stderr', note))
+
+    def stream(self, interval: float = 0.05):
+        """Yield (stream, text) chunks as they arrive until the process ends"""
+        while not self.done:
+            try:
+                stream, text = self.chunks.get(timeout=interval)
+            except queue.Empty:
+                pass
+            else:
+                self._emit(stream, text)
+                yield stream, text
+            yield from self.poll()
+
+    def wait(self) -> Tuple[bool, OutputLog]:
+        """Run to completion and return (success, log); the log stays open for the caller"""
+        for _ in self.stream():
+            pass
+        return self.success, self.log
+
+
+EXEC_SERVICE_PORT = 8766
+
+
+class RemoteExecutionJob(ExecutionJob):
+    """An ExecutionJob running on an exec_service.py daemon instead of a local process.
+
+    The service enforces the timeout; chunks and the final result are
+    delivered by the ExecutionServiceClient reader thread.
+    """
+
+    def __init__(self, service: 'ExecutionServiceClient', job_id: str, timeout: float = 5.0,
+                 on_output: Optional[Callable[[str, str], None]] = None, max_lines: int = 100_000):
+        self.log = OutputLog(max_lines=max_lines)
+        self.on_output = on_output
+        self.timeout = timeout
+        self.cleanup = None
+        self.chunks: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self.returncode: Optional[int] = None
+        self.timed_out = False
+        self.cancelled = False
+        self.truncated = False
+        self.service = service
+        self.id = job_id
+        # The service's 'done' or 'error' message, once it arrives
+        self.result: Optional[Dict[str, Any]] = None
+        # Set by the reader thread whenever chunks or the result arrive
+        self.wake = threading.Event()
+
+    def cancel(self):
+        """Ask the service to stop the job; the output so far is kept"""
+        if self.returncode is None and self.result is None and not self.cancelled:
+            self.cancelled = True
+            self.service.send({'type': 'cancel', 'id': self.id})
+
+    def poll(self) -> List[Tuple[str, str]]:
+        """Deliver the chunks received since the last call and check for the result"""
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.chunks.get_nowait())
+            except queue.Empty:
+                break
+        for stream, text in chunks:
+            self._emit(stream, text)
+        if self.returncode is None and self.result is not None:
+            self._finish(chunks)
+        return chunks
+
+    def _finish(self, chunks: List[Tuple[str, str]]):
+        result = self.result
+        if result.get('type') == 'error':
+            self.chunks.put(('stderr', f"{result.get('message')}\n"))
+        self.timed_out = bool(result.get('timed_out'))
+        self.cancelled = self.cancelled or bool(result.get('cancelled'))
+        self._drain(chunks)
+        returncode = result.get('returncode')
+        self.returncode = returncode if isinstance(returncode, int) else 1
+        self.log.flush()
+
+    def stream(self, interval: float = 0.05):
+        """Yield (stream, text) chunks as they arrive until the service reports the result"""
+        while not self.done:
+            self.wake.wait(interval)
+            self.wake.clear()
+            yield from self.poll()
+
+
+class ExecutionServiceClient:
+    """Connection to an exec_service.py daemon, shared by every remote job of a CodeExecutor"""
+
+    def __init__(self, address: str, token: Optional[str] = None, timeout: float = 5.0):
+        if address.startswith('unix:'):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            try:
+                self.sock.connect(address[len('unix:'):])
+            except OSError:
+                self.sock.close()
+                raise
+        else:
+            host, _, port = address.rpartition(':')
+            if not host:
+                host, port = port, EXEC_SERVICE_PORT
+            self.sock = socket.create_connection((host, int(port)), timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(None)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+        self.send_lock = threading.Lock()
+        self.jobs: Dict[str, RemoteExecutionJob] = {}
+        self.next_id = 0
+        self.closed = False
+        # Why the service dropped the connection, if it said (e.g. a rejected token)
+        self.error: Optional[str] = None
+        threading.Thread(target=self._read, daemon=True).start()
+        if token:
+            self.send({'type': 'hello', 'token': token})
+
+    def send(self, message: Dict[str, Any]):
+        data = json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self.send_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def submit(self, cells: List[Tuple[str, str]], timeout: float, priority: int = 0,
+               on_output: Optional[Callable[[str, str], None]] = None,
+               max_lines: int = 100_000) -> List[RemoteExecutionJob]:
+        """Queue (code, language) cells as one batch and return their jobs"""
+        jobs, requests = [], []
+        for code, language in cells:
+            self.next_id += 1
+            job = RemoteExecutionJob(self, str(self.next_id), timeout, on_output, max_lines)
+            self.jobs[job.id] = job
+            jobs.append(job)
+            requests.append({'id': job.id, 'code': code, 'language': language,
+                             'priority': priority, 'timeout': timeout})
+        if len(requests) == 1:
+            self.send({'type': 'run', **requests[0]})
+        else:
+            self.send({'type': 'batch', 'jobs': requests})
+        return jobs
+
+    def _read(self):
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                kind = message.get('type')
+                if kind == 'output':
+                    for job_id, stream, text in message['chunks']:
+                        job = self.jobs.get(job_id)
+                        if job is not None:
+                            job.chunks.put((stream, text))
+                            job.wake.set()
+                elif kind == 'error' and message.get('id') is None:
+                    self.error = str(message.get('message'))
+                elif kind in ('done', 'error'):
+                    job = self.jobs.pop(str(message.get('id')), None)
+                    if job is not None:
+                        job.result = message
+                        job.wake.set()
+        except (OSError, ValueError):
+            pass
+        self.closed = True
+        reason = f"Execution service: {self.error}" if self.error else "Lost connection to the execution service"
+        for job in list(self.jobs.values()):
+            job.result = {'type': 'error', 'message': reason}
+            job.wake.set()
+        self.jobs.clear()
+
+    def close(self):
+        self.closed = True
+        with contextlib.suppress(OSError):
+            self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+
 class CodeExecutor:
     """Handles execution of code in different languages"""
     
@@ -522,62 +2795,198 @@ class CodeExecutor:
             "html": ".html",
         }
         
-        self.executor_map = {
-            "python": self.execute_python,
+        self.starter_map = {
+            "python": self.start_python,
         }
+
+        # Lines of output kept in memory per run; the rest is only on disk
+        self.max_output_lines = 100_000
+        self.timeout = 5.0
+
+        # "host:port" or "unix:/path" of an exec_service.py daemon to run code on instead of locally
+        self.service_address = os.environ.get("QUADTREE_EXEC_SERVICE") or None
+        # Shared secret the daemon expects in the hello
+        self.service_token = os.environ.get("QUADTREE_EXEC_TOKEN") or None
+        self.service: Optional[ExecutionServiceClient] = None
+        # Queue priority of remote runs; higher runs first
+        self.priority = 0
         
         # Ensure tmp directory exists
         self.tmp_dir = os.path.join(tempfile.gettempdir(), "quadtree_code")
         os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def start(self, code: str, language: str,
+              on_output: Optional[Callable[[str, str], None]] = None) -> Optional[ExecutionJob]:
+        """Start executing code in the background, or return None if the language has no executor"""
+        if self.service_address:
+            return self.start_many([(code, language)], on_output)[0]
+        starter = self.starter_map.get(language.lower())
+        return starter(code, on_output) if starter else None
+
+    def start_many(self, cells: List[Tuple[str, str]],
+                   on_output: Optional[Callable[[str, str], None]] = None) -> List[Optional[ExecutionJob]]:
+        """Start several (code, language) cells; in remote mode they are sent as one batch"""
+        if not self.service_address:
+            return [self.start(code, language, on_output) for code, language in cells]
+        if self.service is None or self.service.closed:
+            self.service = ExecutionServiceClient(self.service_address, self.service_token)
+        return self.service.submit(cells, self.timeout, self.priority, on_output, self.max_output_lines)
     
-    def execute(self, code: str, language: str) -> Tuple[bool, str]:
-        """Execute code in the given language"""
-        executor = self.executor_map.get(language.lower())
-        if executor:
-            return executor(code)
-        else:
+    def execute(self, code: str, language: str,
+                on_output: Optional[Callable[[str, str], None]] = None) -> Tuple[bool, str]:
+        """Execute code in the given language, passing output chunks to on_output as they arrive"""
+        try:
+            job = self.start(code, language, on_output)
+        except Exception as e:
+            return False, f"Execution error: {str(e)}"
+        if job is None:
             return False, f"No executor available for {language}. Would you like to create one?"
+        with job.log:
+            success, log = job.wait()
+            return success, log.text()
     
-    def execute_python(self, code: str) -> Tuple[bool, str]:
+    def execute_python(self, code: str, on_output: Optional[Callable[[str, str], None]] = None) -> Tuple[bool, str]:
         """Execute Python code"""
+        return self.execute(code, "python", on_output)
+
+    def start_python(self, code: str, on_output: Optional[Callable[[str, str], None]] = None) -> ExecutionJob:
+        """Start Python code in a subprocess with unbuffered output"""
         # Save code to temporary file
-        temp_file = os.path.join(self.tmp_dir, f"temp_{hash(code)}.py")
+        temp_file = os.path.join(self.tmp_dir, f"temp_{hash(code)}_{time.monotonic_ns()}.py")
         with open(temp_file, "w", encoding="utf-8") as f:
             f.write(code)
-        
-        try:
-            # Execute in subprocess to capture output and isolate errors
-            result = subprocess.run(
-                [sys.executable, temp_file],
-                capture_output=True,
-                text=True,
-                timeout=5  # 5 second timeout
-            )
-            
-            # Clean up temp file
-            try:
-                os.remove(temp_file)
-            except:
-                pass
-                
-            if result.returncode == 0:
-                return True, result.stdout
-            else:
-                return False, f"Error:\n{result.stderr}"
-        except subprocess.TimeoutExpired:
-            return False, "Execution timed out (5s limit)"
-        except Exception as e:
-            return False, f"Execution error: {str(e)}"
+        return ExecutionJob([sys.executable, "-u", temp_file], self.timeout, on_output,
+                            self.max_output_lines, cleanup=temp_file)
+
+
+def write_pickled_matrix(blob: bytes, filepath: str, layer_format: str = LAYER_COMPRESSED, compact: bool = True):
+    """Process-pool entry point: unpickle a matrix snapshot and write it"""
+    write_matrix(pickle.loads(blob), filepath, layer_format, compact)
+
+
+def estimate_matrix_bytes(matrix: Matrix) -> int:
+    """Rough resident size of a matrix, in bytes"""
+    total = 0
+    for layer in matrix.layers:
+        total += layer.resident_bytes()
+    for layer_payloads in matrix.payloads.values():
+        for payload in layer_payloads.values():
+            total += 64 + _payload_size(payload)
+    if matrix.journal is not None:
+        total += matrix.journal.bytes
+    return total
+
+
+class ContextPool(MutableMapping):
+    """Context ID -> Matrix mapping with a memory budget.
+
+    When resident contexts exceed budget_bytes, the least recently used
+    ones are written to a cache directory and dropped from memory; they
+    are read back transparently on their next access. Pinned contexts
+    (e.g. ones with autosave) are never spilled. A spilled context comes
+    back without its undo history.
+    """
+
+    def __init__(self, budget_bytes: int = 1 << 30, cache_dir: Optional[str] = None):
+        self.budget_bytes = budget_bytes
+        self.cache_dir = cache_dir
+        self.pinned = set()
+        self._order: Dict[str, None] = {}  # every context ID, in insertion order
+        self._resident: "OrderedDict[str, Matrix]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._spilled: Dict[str, str] = {}
+        self._spill_count = 0
+
+    def __getitem__(self, ctx_id: str) -> Matrix:
+        matrix = self._resident.get(ctx_id)
+        if matrix is not None and next(reversed(self._resident)) == ctx_id:
+            # Repeated access to the current context stays cheap
+            return matrix
+        if matrix is None:
+            if ctx_id not in self._spilled:
+                raise KeyError(ctx_id)
+            matrix = self._reload(ctx_id)
+        self._resident.move_to_end(ctx_id)
+        self._sizes[ctx_id] = estimate_matrix_bytes(matrix)
+        self._enforce_budget()
+        return matrix
+
+    def __setitem__(self, ctx_id: str, matrix: Matrix):
+        self._drop_spill(ctx_id)
+        self._order[ctx_id] = None
+        self._resident[ctx_id] = matrix
+        self._resident.move_to_end(ctx_id)
+        self._sizes[ctx_id] = estimate_matrix_bytes(matrix)
+        self._enforce_budget()
+
+    def __delitem__(self, ctx_id: str):
+        if ctx_id not in self._order:
+            raise KeyError(ctx_id)
+        del self._order[ctx_id]
+        self._resident.pop(ctx_id, None)
+        self._sizes.pop(ctx_id, None)
+        self.pinned.discard(ctx_id)
+        self._drop_spill(ctx_id)
+
+    def __contains__(self, ctx_id) -> bool:
+        return ctx_id in self._order
+
+    def __iter__(self):
+        return iter(list(self._order))
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def is_resident(self, ctx_id: str) -> bool:
+        return ctx_id in self._resident
+
+    def resident_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def _enforce_budget(self):
+        # The most recently used context always stays resident
+        for ctx_id in list(self._resident)[:-1]:
+            if self.resident_bytes() <= self.budget_bytes:
+                break
+            if ctx_id not in self.pinned:
+                self._spill(ctx_id)
+
+    def _spill(self, ctx_id: str):
+        if self.cache_dir is None:
+            self.cache_dir = tempfile.mkdtemp(prefix="quadtree_contexts_")
+        self._spill_count += 1
+        path = os.path.join(self.cache_dir, f"ctx_{self._spill_count}.json")
+        write_matrix(self._resident.pop(ctx_id), path)
+        self._sizes.pop(ctx_id, None)
+        self._spilled[ctx_id] = path
+
+    def _reload(self, ctx_id: str) -> Matrix:
+        path = self._spilled.pop(ctx_id)
+        matrix = read_matrix(path)
+        matrix.journal = Journal()
+        os.remove(path)
+        self._resident[ctx_id] = matrix
+        return matrix
+
+    def _drop_spill(self, ctx_id: str):
+        path = self._spilled.pop(ctx_id, None)
+        if path and os.path.exists(path):
+            os.remove(path)
 
 
 class QuadtreeMatrix:
     """Main class for quadtree matrix operations"""
     
-    def __init__(self):
-        self.contexts = {}
+    def __init__(self, memory_budget: int = 1 << 30):
+        self.contexts = ContextPool(memory_budget)
         self.current_ctx = ""
         self.active_cell = None
         self.code_executor = CodeExecutor()
+        self.autosaves: Dict[str, AutosaveLog] = {}
+        self.sessions: Dict[str, SessionClient] = {}
+        self.layer_store = LayerStore()
+        self.io_executor = None
+        self.io_pending = []
         
     def create_empty_matrix(self, size: int, max_depth: int) -> Matrix:
         """Create a new empty matrix with the given size and depth"""
@@ -591,92 +3000,468 @@ class QuadtreeMatrix:
             quadtree_size=size,
             max_depth=max_depth,
             layers=layers,
-            payload_pool={}
+            payloads={}
         )
     
     def create_new_context(self, id: str, size: int, max_depth: int) -> Matrix:
         """Create a new named context"""
         self.contexts[id] = self.create_empty_matrix(size, max_depth)
+        self.contexts[id].journal = Journal()
         return self.contexts[id]
     
     def get_context_list(self) -> List[str]:
         """Get list of all context IDs"""
         return list(self.contexts.keys())
+
+    # --- Spatial queries (cell coordinates, half-open rectangles) ---
+
+    def cells_in_rect(self, ctx_id: str, d: int, x0: int, y0: int, x1: int, y1: int) -> List[Tuple[int, int, Optional[Dict[str, Any]]]]:
+        """Return (idx, color, payload) for every non-empty cell in a rectangle at depth d"""
+        matrix = self.contexts[ctx_id]
+        nodes = matrix.layers[d].nodes
+        cells = set(matrix.color_index(d).iter_rect(x0, y0, x1, y1))
+        cells.update(matrix.payload_index(d).iter_rect(x0, y0, x1, y1))
+        return [(idx, nodes[idx], matrix.get_payload(d, idx)) for idx in sorted(cells)]
+
+    def payloads_in_subtree(self, ctx_id: str, payload_type: Optional[str] = None, d: int = 0, idx: int = 0) -> List[Tuple[int, int, Dict[str, Any]]]:
+        """Return (depth, idx, payload) for payloads under cell (d, idx), optionally filtered by type"""
+        matrix = self.contexts[ctx_id]
+        cy, cx = divmod(idx, matrix.layers[d].size)
+        results = []
+        for dd in range(d, matrix.max_depth + 1):
+            if dd not in matrix.payloads:
+                continue
+            scale = 1 << (dd - d)
+            for i in matrix.payload_index(dd).iter_rect(cx * scale, cy * scale, (cx + 1) * scale, (cy + 1) * scale):
+                payload = matrix.payloads[dd][i]
+                if payload_type is None or payload.get('type') == payload_type:
+                    results.append((dd, i, payload))
+        return results
+
+    def nearest_cell(self, ctx_id: str, d: int, x: int, y: int) -> Optional[int]:
+        """Return the index of the non-empty cell at depth d closest to (x, y)"""
+        matrix = self.contexts[ctx_id]
+        candidates = [
+            found for found in (matrix.color_index(d).nearest(x, y), matrix.payload_index(d).nearest(x, y))
+            if found is not None
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda found: (found[1], found[0]))[0]
+
+    def color_histogram(self, ctx_id: str, d: int, x0: int, y0: int, x1: int, y1: int) -> Dict[int, int]:
+        """Count cell colors in a rectangle at depth d (empty cells are counted under 0)"""
+        matrix = self.contexts[ctx_id]
+        size = matrix.layers[d].size
+        nodes = matrix.layers[d].nodes
+        histogram: Dict[int, int] = {}
+        filled = 0
+        for idx in matrix.color_index(d).iter_rect(x0, y0, x1, y1):
+            color = nodes[idx]
+            histogram[color] = histogram.get(color, 0) + 1
+            filled += 1
+        area = (max(0, min(x1, size) - max(x0, 0))) * (max(0, min(y1, size) - max(y0, 0)))
+        if area > filled:
+            histogram[0] = area - filled
+        return histogram
+
+    def diff_contexts(self, ctx_a: str, ctx_b: str) -> Patch:
+        """Return the patch that turns context ctx_a into ctx_b"""
+        return self.contexts[ctx_a].diff(self.contexts[ctx_b])
+
+    def apply_patch(self, ctx_id: str, patch: Patch, strict: bool = False):
+        """Apply a patch to a context as one undoable edit"""
+        self.contexts[ctx_id].apply_patch(patch, strict)
+
+    def contexts_equal(self, ctx_a: str, ctx_b: str) -> bool:
+        """Compare the content of two contexts by their root digests"""
+        return self.contexts[ctx_a].same_subtree(self.contexts[ctx_b])
+
+    def dedup_payloads(self) -> int:
+        """Share one object between identical payloads of all resident contexts.
+
+        Spilled contexts are left on disk. Returns the number of duplicate
+        payloads that were released.
+        """
+        canonical: Dict[bytes, Any] = {}
+        released = 0
+        for ctx_id in list(self.contexts):
+            if not self.contexts.is_resident(ctx_id):
+                continue
+            for layer_payloads in self.contexts[ctx_id].payloads.values():
+                for idx, payload in layer_payloads.items():
+                    shared = canonical.setdefault(payload_digest(payload), payload)
+                    if shared is not payload:
+                        # Same content, so digests and indexes stay valid
+                        layer_payloads[idx] = shared
+                        released += 1
+        return released
     
-    def load_json(self, filepath: str) -> Optional[str]:
-        """Load matrix from JSON file and return the assigned context ID"""
+    def load_json(self, filepath: str, lazy: bool = True) -> Optional[str]:
+        """Load matrix from JSON file and return the assigned context ID.
+
+        With lazy set, compressed layers stay encoded until first accessed.
+        """
         try:
-            with open(filepath, 'r') as f:
-                data = json.load(f)
+            matrix = read_matrix(filepath, lazy)
             
-            # Basic validation
-            if not all(key in data for key in ['quadtree_size', 'max_depth', 'layers']):
-                raise ValueError("Invalid matrix format")
-            
-            # Convert to our data structures
-            matrix = Matrix(
-                quadtree_size=data['quadtree_size'],
-                max_depth=data['max_depth'],
-                version=data.get('version', 1),
-                layers=[],
-                payload_pool=data.get('payload_pool', {})
-            )
-            
-            # Process layers
-            for layer_data in data['layers']:
-                layer = Layer(
-                    size=layer_data['size'],
-                    nodes=layer_data['nodes']
-                )
-                matrix.layers.append(layer)
-            
-            # Create context ID from filename
-            ctx_id = os.path.basename(filepath).replace('.json', '')
-            if ctx_id in self.contexts:
-                base_id = ctx_id
-                counter = 1
-                while ctx_id in self.contexts:
-                    ctx_id = f"{base_id}_{counter}"
-                    counter += 1
-            
-            self.contexts[ctx_id] = matrix
-            return ctx_id
+            return self.add_matrix(filepath, matrix)
             
         except Exception as e:
             print(f"Error loading JSON: {e}")
             return None
     
-    def save_json(self, ctx_id: str, filepath: str) -> bool:
-        """Save matrix to JSON file"""
+    def add_matrix(self, filepath: str, matrix: Matrix) -> str:
+        """Register a matrix read from filepath as a new context and return its ID"""
+        # Recover edits logged by autosave since the last snapshot
+        wal_path = filepath + '.wal'
+        if os.path.exists(wal_path):
+            if replay_change_log(matrix, wal_path):
+                # Fold the recovered edits into the snapshot so the log cannot
+                # later replay over newer saves
+                write_matrix(matrix, filepath)
+            self._snapshot_saved(filepath, matrix)
+        
+        # Create context ID from filename
+        ctx_id = os.path.basename(filepath).replace('.json', '')
+        if ctx_id in self.contexts:
+            base_id = ctx_id
+            counter = 1
+            while ctx_id in self.contexts:
+                ctx_id = f"{base_id}_{counter}"
+                counter += 1
+        
+        matrix.journal = Journal()
+        self.contexts[ctx_id] = matrix
+        return ctx_id
+    
+    # --- Background import/export ---
+    
+    def _io_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self.io_executor is None:
+            # Forking would copy pygame's state and locks held by the autosave
+            # and output reader threads into the workers; start them clean
+            self.io_executor = concurrent.futures.ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn"))
+        return self.io_executor
+    
+    def import_files_async(self, filepaths: List[str]):
+        """Parse several matrix files concurrently; collect them with poll_background"""
+        for filepath in filepaths:
+            future = self._io_pool().submit(read_matrix, filepath)
+            self.io_pending.append(('import', filepath, None, future))
+    
+    def export_contexts_async(self, targets: List[Tuple[str, str]], layer_format: str = LAYER_COMPRESSED, compact: bool = True):
+        """Write several (ctx_id, filepath) pairs concurrently"""
+        for ctx_id, filepath in targets:
+            # Snapshot now so later edits cannot race the worker
+            matrix = self.contexts[ctx_id]
+            blob = pickle.dumps(matrix, pickle.HIGHEST_PROTOCOL)
+            future = self._io_pool().submit(write_pickled_matrix, blob, filepath, layer_format, compact)
+            self.io_pending.append(('export', filepath, matrix, future))
+    
+    def poll_background(self) -> List[Tuple[str, str, Optional[str], Optional[BaseException]]]:
+        """Return finished jobs as (kind, filepath, ctx_id, error) without blocking.
+
+        Imported matrices are registered as contexts here, on the caller's thread.
+        """
+        finished = []
+        still_pending = []
+        for kind, filepath, source, future in self.io_pending:
+            if not future.done():
+                still_pending.append((kind, filepath, source, future))
+                continue
+            error = future.exception()
+            ctx_id = None
+            if error is None and kind == 'import':
+                ctx_id = self.add_matrix(filepath, future.result())
+            elif error is None:
+                # The snapshot was taken at submit time and may miss later edits
+                self._snapshot_saved(filepath, source, current=False)
+            finished.append((kind, filepath, ctx_id, error))
+        self.io_pending = still_pending
+        return finished
+
+    def save_json(self, ctx_id: str, filepath: str, layer_format: str = LAYER_COMPRESSED, compact: bool = True) -> bool:
+        """Save matrix to JSON file (see write_matrix for the format options)"""
         if ctx_id not in self.contexts:
             return False
         
-        matrix = self.contexts[ctx_id]
-        data = {
-            'version': matrix.version,
-            'quadtree_size': matrix.quadtree_size,
-            'max_depth': matrix.max_depth,
-            'layers': [],
-            'payload_pool': matrix.payload_pool
-        }
-        
-        # Convert layers to serializable format
-        for layer in matrix.layers:
-            data['layers'].append({
-                'size': layer.size,
-                'nodes': layer.nodes
-            })
-        
         try:
-            with open(filepath, 'w') as f:
-                json.dump(data, f, indent=2)
+            write_matrix(self.contexts[ctx_id], filepath, layer_format, compact)
+            self._snapshot_saved(filepath, self.contexts[ctx_id])
             return True
         except Exception as e:
             print(f"Error saving JSON: {e}")
             return False
 
+    def _snapshot_saved(self, filepath: str, matrix: Matrix, current: bool = True):
+        """Retire the change log that a snapshot just written to filepath supersedes.
+
+        current tells whether the snapshot holds matrix's latest state; if
+        not and matrix is autosaved to filepath, it is compacted once more.
+        """
+        path = os.path.abspath(filepath)
+        for autosave in self.autosaves.values():
+            if os.path.abspath(autosave.filepath) == path:
+                if autosave.matrix is matrix and not current:
+                    autosave.compact()
+                else:
+                    autosave.reset()
+                return
+        discard_change_log(filepath)
+
+    def evict_layers(self, ctx_id: str, keep_depths):
+        """Spill the layers of a context that are not in keep_depths to disk"""
+        self.contexts[ctx_id].evict_layers(set(keep_depths), self.layer_store)
+
+    def enable_autosave(self, ctx_id: str, filepath: str, **kwargs) -> 'AutosaveLog':
+        """Start logging edits of a context to filepath's change log"""
+        self.disable_autosave(ctx_id)
+        matrix = self.contexts[ctx_id]
+        # Start from a snapshot of the current state so the log only holds later edits
+        write_matrix(matrix, filepath)
+        self.autosaves[ctx_id] = AutosaveLog(matrix, filepath, **kwargs)
+        self.contexts.pinned.add(ctx_id)
+        return self.autosaves[ctx_id]
+
+    def disable_autosave(self, ctx_id: str):
+        """Compact and close the change log of a context, if any"""
+        autosave = self.autosaves.pop(ctx_id, None)
+        if autosave:
+            autosave.close()
+            if ctx_id not in self.sessions:
+                self.contexts.pinned.discard(ctx_id)
+
+    def join_session(self, url: str) -> str:
+        """Join a context shared by a server.py coordinator and return its local context ID"""
+        client = SessionClient(url)
+        matrix = client.connect()
+        ctx_id = client.label
+        self.leave_session(ctx_id)
+        self.contexts[ctx_id] = matrix
+        # The client holds on to this matrix, so it must never be spilled
+        self.contexts.pinned.add(ctx_id)
+        self.sessions[ctx_id] = client
+        return ctx_id
+
+    def leave_session(self, ctx_id: str):
+        """Disconnect a session context; the local copy stays as a plain context"""
+        client = self.sessions.pop(ctx_id, None)
+        if client:
+            client.close()
+            if ctx_id not in self.autosaves:
+                self.contexts.pinned.discard(ctx_id)
+
+    def poll_sessions(self) -> List[str]:
+        """Apply edits received from session peers and return the contexts that changed"""
+        changed = []
+        for ctx_id, client in list(self.sessions.items()):
+            if client.poll():
+                changed.append(ctx_id)
+            if not client.connected:
+                print(f"Session {ctx_id} disconnected")
+                self.leave_session(ctx_id)
+                changed.append(ctx_id)
+        return changed
+
+
+class LineBuffer:
+    """Editable text stored as blocks of lines.
+
+    Per-block line and character counts are summed into prefix tables that
+    are rebuilt lazily after an edit, so row/offset lookups are a bisect
+    plus a short walk inside one block, and an edit only touches the lines
+    it changes instead of copying the whole text.
+    """
+    BLOCK_LINES = 256
+
+    def __init__(self, text: str = ""):
+        self.set_text(text)
+
+    def set_text(self, text: str):
+        lines = text.split('\n')
+        self.blocks = [lines[i:i + self.BLOCK_LINES] for i in range(0, len(lines), self.BLOCK_LINES)]
+        self.block_chars = [sum(len(line) + 1 for line in block) for block in self.blocks]
+        self._line_starts = None
+        self._char_starts = None
+
+    def text(self) -> str:
+        return '\n'.join(line for block in self.blocks for line in block)
+
+    def __len__(self) -> int:
+        # Every line but the last is followed by a newline
+        return sum(self.block_chars) - 1
+
+    def _prefix(self):
+        if self._line_starts is None:
+            self._line_starts = [0]
+            self._char_starts = [0]
+            for block, chars in zip(self.blocks, self.block_chars):
+                self._line_starts.append(self._line_starts[-1] + len(block))
+                self._char_starts.append(self._char_starts[-1] + chars)
+        return self._line_starts, self._char_starts
+
+    def line_count(self) -> int:
+        return self._prefix()[0][-1]
+
+    def _locate(self, row: int) -> Tuple[int, int]:
+        # (block, row within block) of a line
+        line_starts = self._prefix()[0]
+        b = min(bisect.bisect_right(line_starts, row), len(self.blocks)) - 1
+        return b, row - line_starts[b]
+
+    def line(self, row: int) -> str:
+        b, r = self._locate(row)
+        return self.blocks[b][r]
+
+    def lines(self, start: int, stop: int) -> List[str]:
+        """Return lines start..stop-1 (clipped to the buffer)"""
+        result = []
+        row = max(0, start)
+        stop = min(stop, self.line_count())
+        while row < stop:
+            b, r = self._locate(row)
+            chunk = self.blocks[b][r:r + stop - row]
+            result.extend(chunk)
+            row += len(chunk)
+        return result
+
+    def line_start(self, row: int) -> int:
+        """Return the offset of the first character of a line"""
+        b, r = self._locate(row)
+        return self._char_starts[b] + sum(len(line) + 1 for line in self.blocks[b][:r])
+
+    def row_col(self, offset: int) -> Tuple[int, int]:
+        """Convert a character offset to (row, column)"""
+        line_starts, char_starts = self._prefix()
+        offset = max(0, min(offset, len(self)))
+        b = min(bisect.bisect_right(char_starts, offset), len(self.blocks)) - 1
+        pos = char_starts[b]
+        block = self.blocks[b]
+        for r, line in enumerate(block):
+            if pos + len(line) + 1 > offset or r == len(block) - 1:
+                return line_starts[b] + r, offset - pos
+            pos += len(line) + 1
+
+    def offset(self, row: int, col: int) -> int:
+        """Convert (row, column) to a character offset, clamping both"""
+        row = max(0, min(row, self.line_count() - 1))
+        return self.line_start(row) + max(0, min(col, len(self.line(row))))
+
+    def _replace_rows(self, first: int, last: int, new_lines: List[str]):
+        # Replace lines first..last (inclusive) and re-chunk the touched blocks
+        b0, r0 = self._locate(first)
+        b1, r1 = self._locate(last)
+        merged = self.blocks[b0][:r0] + new_lines + self.blocks[b1][r1 + 1:]
+        if len(merged) <= 2 * self.BLOCK_LINES:
+            chunks = [merged]
+        else:
+            chunks = [merged[i:i + self.BLOCK_LINES] for i in range(0, len(merged), self.BLOCK_LINES)]
+        self.blocks[b0:b1 + 1] = chunks
+        self.block_chars[b0:b1 + 1] = [sum(len(line) + 1 for line in chunk) for chunk in chunks]
+        self._line_starts = None
+        self._char_starts = None
+
+    def insert(self, offset: int, text: str):
+        """Insert text at a character offset"""
+        row, col = self.row_col(offset)
+        line = self.line(row)
+        b, r = self._locate(row)
+        if '\n' not in text:
+            self.blocks[b][r] = line[:col] + text + line[col:]
+            self.block_chars[b] += len(text)
+            self._char_starts = self._line_starts = None
+            return
+        pieces = text.split('\n')
+        pieces[0] = line[:col] + pieces[0]
+        pieces[-1] += line[col:]
+        self._replace_rows(row, row, pieces)
+
+    def delete(self, start: int, end: int):
+        """Remove the characters between two offsets"""
+        if end <= start:
+            return
+        row0, col0 = self.row_col(start)
+        row1, col1 = self.row_col(end)
+        self._replace_rows(row0, row1, [self.line(row0)[:col0] + self.line(row1)[col1:]])
+
+
+class SyntaxHighlighter:
+    """Line-by-line Python lexer that remembers the state at each line start.
+
+    The only state carried between lines is an open triple-quoted string.
+    States are kept for every line lexed so far; an edit drops the states
+    after the edited line and they are recomputed on demand.
+    """
+    LANGUAGES = ('python', 'py')
+    TOKEN_RE = re.compile(
+        r'(?P<comment>#.*)'
+        r'|(?P<triple>[rRbBuUfF]{0,2}(?:"""|\'\'\'))'
+        r'|(?P<string>[rRbBuUfF]{0,2}(?:"(?:\\.|[^"\\])*"?|\'(?:\\.|[^\'\\])*\'?))'
+        r'|(?P<number>\b(?:0[xXoObB][0-9a-fA-F_]+|\d[\d_]*\.?\d*(?:[eE][+-]?\d+)?j?))'
+        r'|(?P<name>[A-Za-z_]\w*)'
+    )
+
+    def __init__(self, language: str = 'python'):
+        self.reset(language)
+
+    def reset(self, language: str):
+        self.language = language
+        self.enabled = language.strip().lower() in self.LANGUAGES
+        self.states: List[Optional[str]] = [None]
+
+    def invalidate(self, row: int):
+        """Forget the states of every line after row"""
+        del self.states[row + 1:]
+
+    def state_at(self, buffer: 'LineBuffer', row: int) -> Optional[str]:
+        """Return the lexer state at the start of row, lexing up to it if needed"""
+        if not self.enabled:
+            return None
+        if len(self.states) <= row:
+            start = len(self.states) - 1
+            state = self.states[start]
+            for line in buffer.lines(start, row):
+                state = self.lex(line, state)[1]
+                self.states.append(state)
+        return self.states[min(row, len(self.states) - 1)]
+
+    def lex(self, line: str, state: Optional[str]) -> Tuple[List[Tuple[int, int, str]], Optional[str]]:
+        """Return the colored spans (start, end, kind) of a line and the state after it"""
+        spans = []
+        pos = 0
+        if state:
+            end = line.find(state)
+            if end < 0:
+                return [(0, len(line), 'string')], state
+            spans.append((0, end + 3, 'string'))
+            pos = end + 3
+        while True:
+            match = self.TOKEN_RE.search(line, pos)
+            if not match:
+                return spans, None
+            kind = match.lastgroup
+            start, pos = match.span()
+            if kind == 'triple':
+                quote = line[pos - 3:pos]
+                end = line.find(quote, pos)
+                if end < 0:
+                    spans.append((start, len(line), 'string'))
+                    return spans, quote
+                pos = end + 3
+                kind = 'string'
+            elif kind == 'name':
+                if not keyword.iskeyword(match.group()):
+                    continue
+                kind = 'keyword'
+            spans.append((start, pos, kind))
+
 
 class CodeEditorModal:
+    # Rendered line surfaces kept across frames, keyed by content
+    LINE_CACHE_SIZE = 1024
+
     def __init__(self, screen_width, screen_height):
         self.width = int(screen_width * 0.7)
         self.height = int(screen_height * 0.7)
@@ -688,7 +3473,9 @@ class CodeEditorModal:
         )
         
         self.visible = False
-        self.code = ""
+        self.buffer = LineBuffer()
+        self.highlighter = SyntaxHighlighter()
+        self.line_cache = OrderedDict()
         self.language = "python"
         self.cell = None
         self.cursor_pos = 0
@@ -745,6 +3532,15 @@ class CodeEditorModal:
             "python"
         )
     
+    @property
+    def code(self):
+        return self.buffer.text()
+
+    @code.setter
+    def code(self, text):
+        self.buffer.set_text(text)
+        self.highlighter.invalidate(0)
+
     def show(self, code="", language="python", cell=None):
         self.visible = True
         self.code = code
@@ -761,7 +3557,7 @@ class CodeEditorModal:
         return None, None
     
     def get_lines(self):
-        return self.code.split('\n')
+        return self.buffer.lines(0, self.buffer.line_count())
 
     def get_selection(self):
         start = min(self.selection_start, self.cursor_pos)
@@ -773,18 +3569,53 @@ class CodeEditorModal:
             return
         
         start, end = self.get_selection()
-        self.code = self.code[:start] + self.code[end:]
+        self.delete_text(start, end)
         self.cursor_pos = start
         self.selection_start = start
 
     def get_cursor_row_col(self):
-        lines = self.get_lines()
-        pos = 0
-        for i, line in enumerate(lines):
-            if pos + len(line) + 1 > self.cursor_pos:
-                return i, self.cursor_pos - pos
-            pos += len(line) + 1
-        return len(lines) - 1, len(lines[-1])
+        return self.buffer.row_col(self.cursor_pos)
+
+    def insert_text(self, text):
+        self.delete_selection()
+        self.highlighter.invalidate(self.buffer.row_col(self.cursor_pos)[0])
+        self.buffer.insert(self.cursor_pos, text)
+        self.cursor_pos += len(text)
+        self.selection_start = self.cursor_pos
+
+    def delete_text(self, start, end):
+        self.highlighter.invalidate(self.buffer.row_col(start)[0])
+        self.buffer.delete(start, end)
+
+    def render_line(self, line, state):
+        """Return the highlighted surface of one line, reusing earlier renders"""
+        key = (self.highlighter.enabled, state, line)
+        line_surf = self.line_cache.get(key)
+        if line_surf is not None:
+            self.line_cache.move_to_end(key)
+            return line_surf
+
+        if not self.highlighter.enabled:
+            line_surf = FONT_MONO.render(line, True, TEXT)
+        else:
+            line_surf = pygame.Surface(FONT_MONO.size(line), pygame.SRCALPHA)
+            pos = 0
+            for start, end, kind in self.highlighter.lex(line, state)[0] + [(len(line), len(line), None)]:
+                for text, color in ((line[pos:start], TEXT), (line[start:end], SYNTAX_COLORS.get(kind))):
+                    if text:
+                        line_surf.blit(FONT_MONO.render(text, True, color), (FONT_MONO.size(line[:pos])[0], 0))
+                        pos += len(text)
+        self.line_cache[key] = line_surf
+        if len(self.line_cache) > self.LINE_CACHE_SIZE:
+            self.line_cache.popitem(last=False)
+        return line_surf
+
+    def render_line_number(self, number):
+        key = ('#', number)
+        num_surf = self.line_cache.get(key)
+        if num_surf is None:
+            num_surf = self.line_cache[key] = FONT_MONO.render(str(number), True, CODE_NUM)
+        return num_surf
 
     def draw(self, surface):
         if not self.visible:
@@ -820,9 +3651,9 @@ class CodeEditorModal:
             editor_rect.width - line_number_width, editor_rect.height
         )
 
-        lines = self.get_lines()
         font_height = FONT_MONO.get_height()
         max_visible_lines = editor_rect.height // font_height
+        visible_lines = self.buffer.lines(self.scroll_y, self.scroll_y + max_visible_lines)
         
         text_area_surface = surface.subsurface(text_area_rect)
         text_area_surface.fill(CODE_BG)
@@ -830,9 +3661,16 @@ class CodeEditorModal:
         selection_start_pos, selection_end_pos = self.get_selection()
         char_w, _ = FONT_MONO.size(' ')
 
-        for i, line in enumerate(lines[self.scroll_y:self.scroll_y + max_visible_lines]):
+        if self.highlighter.language != self.language_input.text:
+            self.highlighter.reset(self.language_input.text)
+        self.highlighter.state_at(self.buffer, self.scroll_y + len(visible_lines))
+        states = self.highlighter.states[self.scroll_y:self.scroll_y + len(visible_lines)] if self.highlighter.enabled else []
+
+        line_start_index = self.buffer.line_start(self.scroll_y) if visible_lines else 0
+        for i, line in enumerate(visible_lines):
             y_pos = i * font_height
-            line_start_index = sum(len(l) + 1 for l in lines[:self.scroll_y + i])
+            if i:
+                line_start_index = line_end_index + 1
             line_end_index = line_start_index + len(line)
 
             if selection_start_pos < line_end_index and selection_end_pos > line_start_index:
@@ -843,7 +3681,7 @@ class CodeEditorModal:
                 selection_rect = pygame.Rect(start_x, y_pos, width, font_height)
                 pygame.draw.rect(text_area_surface, (200, 200, 255), selection_rect)
 
-            line_surf = FONT_MONO.render(line, True, TEXT)
+            line_surf = self.render_line(line, states[i] if i < len(states) else None)
             text_area_surface.blit(line_surf, (-self.scroll_x, y_pos))
 
         if self.cursor_visible:
@@ -857,8 +3695,7 @@ class CodeEditorModal:
         line_number_bg = pygame.Rect(editor_rect.x, editor_rect.y, line_number_width, editor_rect.height)
         pygame.draw.rect(surface, (234, 234, 234), line_number_bg)
         for i in range(max_visible_lines):
-            line_num_str = str(self.scroll_y + i + 1)
-            line_num_surf = FONT_MONO.render(line_num_str, True, CODE_NUM)
+            line_num_surf = self.render_line_number(self.scroll_y + i + 1)
             surface.blit(line_num_surf, (editor_rect.x + 5, editor_rect.y + i * font_height))
         
         lang_label_surf = FONT_BASE.render(self.language_label, True, TEXT)
@@ -903,10 +3740,7 @@ class CodeEditorModal:
                 row = self.scroll_y + (my - text_area_rect.y) // FONT_MONO.get_height()
                 char_w, _ = FONT_MONO.size(' ')
                 col = round((mx - text_area_rect.x + self.scroll_x) / char_w)
-                lines = self.get_lines()
-                row = min(row, len(lines) - 1)
-                col = min(col, len(lines[row]))
-                self.cursor_pos = sum(len(l) + 1 for l in lines[:row]) + col
+                self.cursor_pos = self.buffer.offset(row, col)
                 if not (pygame.key.get_mods() & pygame.KMOD_SHIFT):
                     self.selection_start = self.cursor_pos
                 self.cursor_timer = 0
@@ -920,10 +3754,7 @@ class CodeEditorModal:
                 row = self.scroll_y + (my - text_area_rect.y) // FONT_MONO.get_height()
                 char_w, _ = FONT_MONO.size(' ')
                 col = round((mx - text_area_rect.x + self.scroll_x) / char_w)
-                lines = self.get_lines()
-                row = min(row, len(lines) - 1)
-                col = min(col, len(lines[row]))
-                self.cursor_pos = sum(len(l) + 1 for l in lines[:row]) + col
+                self.cursor_pos = self.buffer.offset(row, col)
                 self.cursor_timer = 0
                 self.cursor_visible = True
 
@@ -937,58 +3768,44 @@ class CodeEditorModal:
 
             if event.key == pygame.K_a and pygame.key.get_mods() & pygame.KMOD_CTRL:
                 self.selection_start = 0
-                self.cursor_pos = len(self.code)
+                self.cursor_pos = len(self.buffer)
             elif event.key == pygame.K_LEFT:
                 if self.cursor_pos > 0:
                     self.cursor_pos -= 1
             elif event.key == pygame.K_RIGHT:
-                if self.cursor_pos < len(self.code):
+                if self.cursor_pos < len(self.buffer):
                     self.cursor_pos += 1
             elif event.key == pygame.K_HOME:
                 row, col = self.get_cursor_row_col()
                 self.cursor_pos -= col
             elif event.key == pygame.K_END:
                 row, col = self.get_cursor_row_col()
-                line_len = len(self.get_lines()[row])
+                line_len = len(self.buffer.line(row))
                 self.cursor_pos += line_len - col
             elif event.key == pygame.K_UP:
                 row, col = self.get_cursor_row_col()
                 if row > 0:
-                    prev_len = len(self.get_lines()[row-1])
-                    prev_start = sum(len(l) + 1 for l in self.get_lines()[:row-1])
-                    self.cursor_pos = prev_start + min(prev_len, col)
+                    self.cursor_pos = self.buffer.offset(row - 1, col)
             elif event.key == pygame.K_DOWN:
                 row, col = self.get_cursor_row_col()
-                lines = self.get_lines()
-                if row < len(lines) - 1:
-                    next_len = len(lines[row+1])
-                    next_start = sum(len(l) + 1 for l in lines[:row+1])
-                    self.cursor_pos = next_start + min(next_len, col)
+                if row < self.buffer.line_count() - 1:
+                    self.cursor_pos = self.buffer.offset(row + 1, col)
             elif event.key == pygame.K_BACKSPACE:
                 if self.selection_start != self.cursor_pos: self.delete_selection()
                 elif self.cursor_pos > 0:
-                    self.code = self.code[:self.cursor_pos-1] + self.code[self.cursor_pos:]
+                    self.delete_text(self.cursor_pos - 1, self.cursor_pos)
                     self.cursor_pos -= 1
                     self.selection_start = self.cursor_pos
             elif event.key == pygame.K_DELETE:
                 if self.selection_start != self.cursor_pos: self.delete_selection()
-                elif self.cursor_pos < len(self.code):
-                    self.code = self.code[:self.cursor_pos] + self.code[self.cursor_pos+1:]
+                elif self.cursor_pos < len(self.buffer):
+                    self.delete_text(self.cursor_pos, self.cursor_pos + 1)
             elif event.key == pygame.K_RETURN:
-                self.delete_selection()
-                self.code = self.code[:self.cursor_pos] + '\n' + self.code[self.cursor_pos:]
-                self.cursor_pos += 1
-                self.selection_start = self.cursor_pos
+                self.insert_text('\n')
             elif event.key == pygame.K_TAB:
-                self.delete_selection()
-                self.code = self.code[:self.cursor_pos] + '    ' + self.code[self.cursor_pos:]
-                self.cursor_pos += 4
-                self.selection_start = self.cursor_pos
+                self.insert_text('    ')
             elif event.unicode:
-                self.delete_selection()
-                self.code = self.code[:self.cursor_pos] + event.unicode + self.code[self.cursor_pos:]
-                self.cursor_pos += len(event.unicode)
-                self.selection_start = self.cursor_pos
+                self.insert_text(event.unicode)
         
         row, col = self.get_cursor_row_col()
         max_visible_lines = editor_rect.height // FONT_MONO.get_height()
@@ -1005,6 +3822,9 @@ class CodeEditorModal:
 
 
 class OutputModal:
+    # Rendered output lines kept across frames
+    LINE_CACHE_SIZE = 512
+
     def __init__(self, screen_width, screen_height):
         self.width = int(screen_width * 0.6)
         self.height = int(screen_height * 0.5)
@@ -1016,9 +3836,14 @@ class OutputModal:
         )
         
         self.visible = False
-        self.output = ""
+        self.log = OutputLog()
         self.success = True
+        self.running = False
         self.scroll_y = 0
+        # Keep the last line in view while output streams in
+        self.follow = True
+        self.match_line = None
+        self.line_cache = OrderedDict()
         
         # Create close button
         button_width = 100
@@ -1032,15 +3857,71 @@ class OutputModal:
             button_height,
             "Close"
         )
-    
-    def show(self, output, success=True):
+
+        # Search box; Enter or F3 jumps to the next matching line
+        self.search_input = TextInput(
+            self.rect.x + 70,
+            self.rect.bottom - button_height - margin,
+            200,
+            button_height
+        )
+
+    @property
+    def output(self):
+        return self.log.text()
+
+    def show(self, output, success=True, running=False):
         self.visible = True
-        self.output = output
+        if output is not self.log:
+            self.log.close()
+            self.log = output if isinstance(output, OutputLog) else OutputLog(output)
+        self.line_cache.clear()
         self.success = success
+        self.running = running
         self.scroll_y = 0
+        self.follow = True
+        self.match_line = None
+
+    def output_added(self):
+        """Scroll to new output unless the user scrolled away from the end"""
+        if self.follow:
+            self.scroll_to(len(self.log))
+
+    def finish(self, success):
+        self.running = False
+        self.success = success
+        self.output_added()
     
     def hide(self):
         self.visible = False
+        # A running job's log is closed by the app once the job stops
+        if not self.running:
+            self.log.close()
+
+    def visible_line_count(self):
+        return (self.rect.height - 100) // FONT_MONO.get_height()
+
+    def scroll_to(self, line):
+        max_scroll = max(self.log.first_line, len(self.log) - self.visible_line_count())
+        self.scroll_y = max(self.log.first_line, min(max_scroll, line))
+
+    def find_next(self):
+        start = self.match_line + 1 if self.match_line is not None else self.scroll_y
+        self.match_line = self.log.search(self.search_input.text, start)
+        if self.match_line is not None:
+            self.follow = False
+            self.scroll_to(self.match_line - self.visible_line_count() // 2)
+
+    def render_line(self, number):
+        """Return the surface of one output line, reusing earlier renders"""
+        line = self.log.line(number)
+        key = (number, line)
+        line_surf = self.line_cache.get(key)
+        if line_surf is None:
+            line_surf = self.line_cache[key] = FONT_MONO.render(line, True, TEXT)
+            if len(self.line_cache) > self.LINE_CACHE_SIZE:
+                self.line_cache.popitem(last=False)
+        return line_surf
     
     def draw(self, surface):
         if not self.visible:
@@ -1060,7 +3941,10 @@ class OutputModal:
         title_color = (0, 128, 0) if self.success else (200, 0, 0)
         pygame.draw.rect(surface, title_color, title_rect, border_top_left_radius=4, border_top_right_radius=4)
         
-        title = "Execution Output" if self.success else "Execution Error"
+        if self.running:
+            title = "Running..."
+        else:
+            title = "Execution Output" if self.success else "Execution Error"
         title_surf = FONT_HEADER.render(title, True, SURFACE)
         title_rect = title_surf.get_rect(center=(self.rect.centerx, self.rect.y + 20))
         surface.blit(title_surf, title_rect)
@@ -1075,24 +3959,26 @@ class OutputModal:
         pygame.draw.rect(surface, CODE_BG, output_rect)
         pygame.draw.rect(surface, ACCENT, output_rect, width=1)
         
-        # Draw output text
-        font = FONT_MONO
-        font_height = font.get_height()
-        lines = self.output.split('\n')
-        
-        # Calculate max visible lines
-        max_visible_lines = output_rect.height // font_height
-        
-        # Draw visible lines
-        for i, line in enumerate(lines[self.scroll_y:self.scroll_y + max_visible_lines]):
-            line_color = TEXT
-            line_surf = font.render(line, True, line_color)
-            surface.blit(
-                line_surf,
-                (output_rect.x + 5, output_rect.y + i * font_height)
-            )
-        
-        # Draw close button
+        # Draw only the visible lines
+        font_height = FONT_MONO.get_height()
+        self.scroll_y = max(self.scroll_y, self.log.first_line)
+        last = min(len(self.log), self.scroll_y + self.visible_line_count())
+        for i, number in enumerate(range(self.scroll_y, last)):
+            y = output_rect.y + i * font_height
+            if number == self.match_line:
+                pygame.draw.rect(surface, BUTTON_HOVER, (output_rect.x + 1, y, output_rect.width - 2, font_height))
+            surface.blit(self.render_line(number), (output_rect.x + 5, y))
+
+        # Note output that is only available in the log file
+        if self.log.first_line:
+            note = f"{self.log.first_line} earlier lines in {self.log.log_path}"
+            note_surf = FONT_BASE.render(note, True, ACCENT)
+            surface.blit(note_surf, (output_rect.x, output_rect.bottom + 2))
+        
+        # Draw search box and close button
+        find_surf = FONT_BASE.render("Find:", True, TEXT)
+        surface.blit(find_surf, (self.rect.x + 20, self.search_input.rect.centery - find_surf.get_height() // 2))
+        self.search_input.draw(surface)
         self.close_button.draw(surface)
     
     def handle_event(self, event):
@@ -1107,21 +3993,117 @@ class OutputModal:
         if result:
             self.hide()
             return True
+
+        # Search on Enter in the search box, or F3 for the next match
+        if self.search_input.handle_event(event) not in (False, True):
+            self.match_line = None
+            self.find_next()
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+            self.find_next()
         
         # Handle mouse wheel for scrolling
         if event.type == pygame.MOUSEWHEEL:
-            self.scroll_y = max(0, self.scroll_y - event.y)
-            
-            lines = self.output.split('\n')
-            font_height = FONT_MONO.get_height()
-            output_height = self.rect.height - 100
-            max_visible_lines = output_height // font_height
-            
-            max_scroll = max(0, len(lines) - max_visible_lines)
-            self.scroll_y = min(max_scroll, self.scroll_y)
+            self.scroll_to(self.scroll_y - event.y)
+            self.follow = self.scroll_y + self.visible_line_count() >= len(self.log)
         
         return False
 
+class FrameProfiler:
+    """Per-frame timings of the phases of the main loop.
+
+    Phases are timed with section() (or add() for manual timings) between
+    begin_frame() and end_frame(); nothing is recorded while disabled. The
+    last max_frames frames are kept for the overlay and for export.
+    """
+    BUDGET_MS = 1000 / 60
+
+    def __init__(self, max_frames: int = 600):
+        self.enabled = False
+        self.frames: Deque[Dict[str, Any]] = deque(maxlen=max_frames)
+        self.frame_count = 0
+        self.current: Optional[Dict[str, Any]] = None
+        self.frame_start = 0.0
+
+    def begin_frame(self, **tags):
+        """Start timing a frame; tags (e.g. context, depth) are stored with it"""
+        if self.enabled:
+            self.current = {'frame': self.frame_count, **tags, 'phases': {}}
+            self.frame_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def section(self, name: str):
+        if self.current is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        """Add time spent in a phase of the current frame"""
+        if self.current is not None:
+            phases = self.current['phases']
+            phases[name] = phases.get(name, 0.0) + seconds * 1000
+
+    def discard_frame(self):
+        """Drop the current frame, e.g. when nothing was drawn"""
+        self.current = None
+
+    def end_frame(self):
+        if self.current is None:
+            return
+        self.current['total_ms'] = (time.perf_counter() - self.frame_start) * 1000
+        self.frames.append(self.current)
+        self.frame_count += 1
+        self.current = None
+
+    def averages(self, last: int = 60) -> Dict[str, float]:
+        """Mean milliseconds per phase (and 'total') over the last frames"""
+        frames = list(self.frames)[-last:]
+        if not frames:
+            return {}
+        sums: Dict[str, float] = {'total': 0.0}
+        for frame in frames:
+            sums['total'] += frame['total_ms']
+            for name, ms in frame['phases'].items():
+                sums[name] = sums.get(name, 0.0) + ms
+        return {name: total / len(frames) for name, total in sums.items()}
+
+    def export(self, filepath: str):
+        """Write the recorded frames as CSV (by extension) or JSON"""
+        frames = list(self.frames)
+        if not filepath.lower().endswith('.csv'):
+            with open(filepath, 'w', encoding='utf-8') as f:
+                json.dump({'budget_ms': self.BUDGET_MS, 'frames': frames}, f, indent=1)
+            return
+        tags = sorted({key for frame in frames for key in frame} - {'frame', 'phases', 'total_ms'})
+        phases = sorted({name for frame in frames for name in frame['phases']})
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write(','.join(['frame', 'total_ms'] + tags + phases) + '\n')
+            for frame in frames:
+                row = [str(frame['frame']), f"{frame['total_ms']:.3f}"]
+                row += [str(frame.get(tag, '')) for tag in tags]
+                row += [f"{frame['phases'].get(name, 0.0):.3f}" for name in phases]
+                f.write(','.join(row) + '\n')
+
+    def draw(self, surface: pygame.Surface, topright: Tuple[int, int]):
+        """Draw the average phase timings, slowest first, as a panel"""
+        averages = self.averages()
+        total = averages.pop('total', 0.0)
+        rows = [(f"frame {total:6.2f} ms", ACCENT if total <= self.BUDGET_MS else (200, 0, 0))]
+        for name, ms in sorted(averages.items(), key=lambda item: -item[1]):
+            rows.append((f"{name:<22}{ms:6.2f}", TEXT))
+        line_height = FONT_MONO.get_height()
+        width = max(FONT_MONO.size(text)[0] for text, _ in rows) + 12
+        panel = pygame.Surface((width, line_height * len(rows) + 8), pygame.SRCALPHA)
+        panel.fill((255, 255, 255, 220))
+        for i, (text, color) in enumerate(rows):
+            panel.blit(FONT_MONO.render(text, True, color), (6, 4 + i * line_height))
+        surface.blit(panel, panel.get_rect(topright=topright))
+
+
 class QuadtreeApp:
     """Main application class"""
     
@@ -1153,6 +4135,21 @@ class QuadtreeApp:
         # State
         self.dragging = False
         self.hover_pos = None
+        # Hovered (ctx, cell, payload) and its tooltip, rebuilt only when it changes
+        self.hover_key = None
+        self.hover_tooltip = None
+        # (layer size, quadtree size, viewport) and the grid surface drawn for it
+        self.grid_cache = None
+        self.subtree_clipboard = None
+        # Spill layers other than the visible one to disk on depth/context change (F4)
+        self.evict_hidden_layers = os.environ.get("QUADTREE_EVICT_LAYERS", "") not in ("", "0")
+        self.context_paths = {}
+        self.status_text = ""
+        self.running_job = None
+        # Set whenever the window needs to be redrawn
+        self.dirty = True
+        # Frame timings; F2 toggles recording and the overlay, Shift+F2 exports
+        self.profiler = FrameProfiler()
     
     def setup_ui(self):
         # Context section
@@ -1208,6 +4205,27 @@ class QuadtreeApp:
             self.export_png_action
         )
         
+        # Autosave toggle
+        self.autosave_btn = Button(
+            10, 300, SIDEBAR_WIDTH - 20, 30,
+            "Autosave: Off",
+            self.toggle_autosave_action
+        )
+        
+        # Export every context to a directory
+        self.export_all_btn = Button(
+            10, 340, SIDEBAR_WIDTH - 20, 30,
+            "Export All",
+            self.export_all_action
+        )
+        
+        # Join or leave a context shared through server.py
+        self.session_btn = Button(
+            10, 380, SIDEBAR_WIDTH - 20, 30,
+            "Join Session",
+            self.toggle_session_action
+        )
+        
         # All UI elements
         self.ui_elements = [
             self.context_dropdown,
@@ -1216,7 +4234,10 @@ class QuadtreeApp:
             self.export_ctx_btn,
             self.size_input,
             self.depth_slider,
-            self.export_png_btn
+            self.export_png_btn,
+            self.autosave_btn,
+            self.export_all_btn,
+            self.session_btn
         ]
         
         # Context menu (will be populated when right-clicking)
@@ -1236,35 +4257,57 @@ class QuadtreeApp:
             # Update dropdown
             self.context_dropdown.options = self.matrix.get_context_list()
             self.context_dropdown.selected = ctx_id
+            self.update_context_buttons()
         
         return True
     
     def import_context_action(self):
         root = tk.Tk()
         root.withdraw()
-        filepath = filedialog.askopenfilename(
+        filepaths = filedialog.askopenfilenames(
             title="Import Matrix",
             filetypes=[("JSON files", "*.json")]
         )
         root.destroy()
         
-        if filepath:
-            ctx_id = self.matrix.load_json(filepath)
-            if ctx_id:
-                self.matrix.current_ctx = ctx_id
-                
-                # Update UI to match imported matrix
-                matrix = self.matrix.contexts[ctx_id]
-                self.quadtree_size = matrix.quadtree_size
-                self.size_input.text = str(self.quadtree_size)
-                
-                # Update depth slider
-                self.max_depth = matrix.max_depth
-                self.depth_slider.max = self.max_depth
-                
-                # Update dropdown
-                self.context_dropdown.options = self.matrix.get_context_list()
-                self.context_dropdown.selected = ctx_id
+        if filepaths:
+            # Files are parsed in worker processes and picked up in update()
+            self.matrix.import_files_async(list(filepaths))
+            self.status_text = f"Importing {len(filepaths)} file(s)..."
+        
+        return True
+    
+    def select_context(self, ctx_id):
+        """Make ctx_id current and sync the sidebar controls to it"""
+        self.matrix.current_ctx = ctx_id
+        
+        # Update UI to match the matrix
+        matrix = self.matrix.contexts[ctx_id]
+        self.quadtree_size = matrix.quadtree_size
+        self.size_input.text = str(self.quadtree_size)
+        
+        # Update depth slider
+        self.max_depth = matrix.max_depth
+        self.depth_slider.max = self.max_depth
+        
+        # Update dropdown
+        self.context_dropdown.options = self.matrix.get_context_list()
+        self.context_dropdown.selected = ctx_id
+        self.update_context_buttons()
+    
+    def export_all_action(self):
+        root = tk.Tk()
+        root.withdraw()
+        directory = filedialog.askdirectory(title="Export All Contexts")
+        root.destroy()
+        
+        if directory:
+            targets = [
+                (ctx_id, os.path.join(directory, f"{ctx_id}.json"))
+                for ctx_id in self.matrix.get_context_list()
+            ]
+            self.matrix.export_contexts_async(targets)
+            self.status_text = f"Exporting {len(targets)} context(s)..."
         
         return True
     
@@ -1282,10 +4325,72 @@ class QuadtreeApp:
         root.destroy()
         
         if filepath:
-            self.matrix.save_json(self.matrix.current_ctx, filepath)
+            if self.matrix.save_json(self.matrix.current_ctx, filepath):
+                self.context_paths[self.matrix.current_ctx] = filepath
+        
+        return True
+    
+    def toggle_autosave_action(self):
+        ctx_id = self.matrix.current_ctx
+        if not ctx_id:
+            return False
+        
+        if ctx_id in self.matrix.autosaves:
+            self.matrix.disable_autosave(ctx_id)
+        else:
+            filepath = self.context_paths.get(ctx_id)
+            if not filepath:
+                root = tk.Tk()
+                root.withdraw()
+                filepath = filedialog.asksaveasfilename(
+                    title="Autosave Matrix",
+                    defaultextension=".json",
+                    filetypes=[("JSON files", "*.json")]
+                )
+                root.destroy()
+            
+            if filepath:
+                self.matrix.enable_autosave(ctx_id, filepath)
+                self.context_paths[ctx_id] = filepath
+        
+        self.update_context_buttons()
+        return True
+    
+    def toggle_session_action(self):
+        ctx_id = self.matrix.current_ctx
+        if ctx_id in self.matrix.sessions:
+            self.matrix.leave_session(ctx_id)
+            self.update_context_buttons()
+            return True
+        
+        root = tk.Tk()
+        root.withdraw()
+        url = simpledialog.askstring("Join Session", "Coordinator URL (http://host:port/context):",
+                                     initialvalue="http://127.0.0.1:8765/default")
+        root.destroy()
         
+        if url:
+            try:
+                ctx_id = self.matrix.join_session(url)
+            except (OSError, ValueError) as e:
+                print(f"Error joining session: {e}")
+                self.status_text = "Could not join session"
+                return False
+            self.select_context(ctx_id)
+            self.status_text = f"Joined {ctx_id}"
         return True
     
+    def evict_hidden(self):
+        if self.evict_hidden_layers and self.matrix.current_ctx:
+            self.matrix.evict_layers(self.matrix.current_ctx, {self.current_depth})
+    
+    def update_context_buttons(self):
+        """Sync the autosave and session button labels with the current context"""
+        enabled = self.matrix.current_ctx in self.matrix.autosaves
+        self.autosave_btn.text = "Autosave: On" if enabled else "Autosave: Off"
+        shared = self.matrix.current_ctx in self.matrix.sessions
+        self.session_btn.text = "Leave Session" if shared else "Join Session"
+    
     def export_png_action(self):
         if not self.matrix.current_ctx:
             return False
@@ -1307,6 +4412,24 @@ class QuadtreeApp:
         
         return True
     
+    def export_profile_action(self):
+        if not self.profiler.frames:
+            self.status_text = "No frames recorded (press F2)"
+            return False
+
+        root = tk.Tk()
+        root.withdraw()
+        filepath = filedialog.asksaveasfilename(
+            title="Export Frame Trace",
+            defaultextension=".json",
+            filetypes=[("JSON files", "*.json"), ("CSV files", "*.csv")]
+        )
+        root.destroy()
+
+        if filepath:
+            self.profiler.export(filepath)
+        return True
+
     def show_context_menu(self, position, cell):
         # Create menu options
         options = [
@@ -1315,17 +4438,24 @@ class QuadtreeApp:
             ("📝 Add Code", lambda: self.handle_context_action("add_code", cell)),
             ("🖼️ Add Image", lambda: self.handle_context_action("add_image", cell)),
             ("↪ Subdivide", lambda: self.handle_context_action("subdivide", cell)),
+            ("⤓ Subdivide to Max", lambda: self.handle_context_action("subdivide_all", cell)),
+            ("🪣 Flood Fill", lambda: self.handle_context_action("flood_fill", cell)),
+            ("⎘ Copy Subtree", lambda: self.handle_context_action("copy_subtree", cell)),
             ("---", None),
-            ("↩ Reset Cell", lambda: self.handle_context_action("reset_cell", cell))
+            ("↩ Reset Cell", lambda: self.handle_context_action("reset_cell", cell)),
+            ("✖ Clear Subtree", lambda: self.handle_context_action("clear_subtree", cell))
         ]
+
+        if self.subtree_clipboard:
+            options.insert(8, ("📋 Paste Subtree", lambda: self.handle_context_action("paste_subtree", cell)))
         
         # Check if cell has code to add Edit Code option
         if self.matrix.current_ctx:
             matrix = self.matrix.contexts[self.matrix.current_ctx]
             d, idx = cell
-            key = f"{d}:{idx}"
+            payload = matrix.get_payload(d, idx)
             
-            if key in matrix.payload_pool and matrix.payload_pool[key].get('type') == 'code':
+            if payload and payload.get('type') == 'code':
                 # Insert edit code option after add code
                 options.insert(3, ("✏️ Edit Code", lambda: self.handle_context_action("edit_code", cell)))
                 # Insert execute code option
@@ -1343,7 +4473,12 @@ class QuadtreeApp:
     def handle_context_action(self, action, cell):
         if not self.matrix.current_ctx or not cell:
             return False
-        
+
+        # Every change made by one menu action becomes one undo step
+        with self.matrix.contexts[self.matrix.current_ctx].edit(action):
+            return self._perform_context_action(action, cell)
+
+    def _perform_context_action(self, action, cell):
         matrix = self.matrix.contexts[self.matrix.current_ctx]
         d, idx = cell
         
@@ -1357,7 +4492,7 @@ class QuadtreeApp:
                 # Convert RGB to int color
                 r, g, b = [int(c) for c in color]
                 color_int = (r << 16) | (g << 8) | b
-                matrix.layers[d].nodes[idx] = color_int
+                matrix.set_color(d, idx, color_int)
         
         elif action == "add_text":
             root = tk.Tk()
@@ -1371,11 +4506,11 @@ class QuadtreeApp:
                 
                 if color:
                     r, g, b = [int(c) for c in color]
-                    matrix.payload_pool[f"{d}:{idx}"] = {
+                    matrix.set_payload(d, idx, {
                         'type': 'text',
                         'text': text,
                         'color': [r, g, b]
-                    }
+                    })
             else:
                 root.destroy()
         
@@ -1386,24 +4521,21 @@ class QuadtreeApp:
             
             # Load existing code if editing
             if action == "edit_code":
-                key = f"{d}:{idx}"
-                if key in matrix.payload_pool and matrix.payload_pool[key].get('type') == 'code':
-                    code = matrix.payload_pool[key].get('code', '')
-                    language = matrix.payload_pool[key].get('language', 'python')
+                payload = matrix.get_payload(d, idx)
+                if payload and payload.get('type') == 'code':
+                    code = payload.get('code', '')
+                    language = payload.get('language', 'python')
             
             self.code_editor.show(code, language, cell)
         
         elif action == "execute_code":
-            key = f"{d}:{idx}"
-            if key in matrix.payload_pool and matrix.payload_pool[key].get('type') == 'code':
-                code = matrix.payload_pool[key].get('code', '')
-                language = matrix.payload_pool[key].get('language', 'python')
-                
-                # Execute the code
-                success, output = self.matrix.code_executor.execute(code, language)
+            payload = matrix.get_payload(d, idx)
+            if payload and payload.get('type') == 'code':
+                code = payload.get('code', '')
+                language = payload.get('language', 'python')
                 
-                # Show output window
-                self.output_modal.show(output, success)
+                # Execute the code, streaming output into the output window
+                self.run_code(code, language)
         
         elif action == "add_image":
             root = tk.Tk()
@@ -1422,44 +4554,45 @@ class QuadtreeApp:
                     # Convert to base64 for storage
                     b64_data = base64.b64encode(img_data).decode('utf-8')
                     
-                    matrix.payload_pool[f"{d}:{idx}"] = {
+                    matrix.set_payload(d, idx, {
                         'type': 'image',
                         'data': b64_data
-                    }
+                    })
                 except Exception as e:
                     print(f"Error loading image: {e}")
         
         elif action == "subdivide":
             if d < matrix.max_depth:
-                parent_key = f"{d}:{idx}"
-                color = matrix.layers[d].nodes[idx]
-                payload = matrix.payload_pool.get(parent_key)
-                
-                d1 = d + 1
-                layer1 = matrix.layers[d1]
-                
-                cx = idx % matrix.layers[d].size
-                cy = idx // matrix.layers[d].size
-                
-                base_x = cx * 2
-                base_y = cy * 2
-                
-                for dy in range(2):
-                    for dx in range(2):
-                        cx1 = base_x + dx
-                        cy1 = base_y + dy
-                        idx1 = cy1 * layer1.size + cx1
-                        
-                        layer1.nodes[idx1] = color
-                        
-                        if payload:
-                            matrix.payload_pool[f"{d1}:{idx1}"] = payload.copy()
+                cy, cx = divmod(idx, matrix.layers[d].size)
+                matrix.subdivide_region(d, cx, cy, cx + 1, cy + 1, d + 1)
+
+        elif action == "subdivide_all":
+            cy, cx = divmod(idx, matrix.layers[d].size)
+            matrix.subdivide_region(d, cx, cy, cx + 1, cy + 1, matrix.max_depth)
+
+        elif action == "flood_fill":
+            root = tk.Tk()
+            root.withdraw()
+            color = colorchooser.askcolor(title="Fill Color")[0]
+            root.destroy()
+
+            if color:
+                r, g, b = [int(c) for c in color]
+                matrix.flood_fill(d, idx, (r << 16) | (g << 8) | b)
+
+        elif action == "copy_subtree":
+            self.subtree_clipboard = matrix.copy_subtree(d, idx)
+
+        elif action == "paste_subtree":
+            if self.subtree_clipboard:
+                matrix.paste_subtree(self.subtree_clipboard, d, idx)
+
+        elif action == "clear_subtree":
+            matrix.clear_subtree(d, idx)
         
         elif action == "reset_cell":
-            matrix.layers[d].nodes[idx] = 0
-            key = f"{d}:{idx}"
-            if key in matrix.payload_pool:
-                del matrix.payload_pool[key]
+            matrix.set_color(d, idx, 0)
+            matrix.remove_payload(d, idx)
         
         # Return True to indicate action was handled
         return True
@@ -1483,43 +4616,65 @@ class QuadtreeApp:
         # Clear canvas
         self.canvas.fill(BG)
         
-        # Draw cells
-        for i, color in enumerate(layer.nodes):
-            if color:
-                cx = i % layer.size
-                cy = i // layer.size
-                x = int(cx * cell_size) + offset_x
-                y = int(cy * cell_size) + offset_y
+        profiler = self.profiler
+        start = time.perf_counter()
+
+        # Draw cells (only occupied cells of this layer)
+        nodes = layer.nodes
+        for i in matrix.color_index(d).iter_rect(0, 0, layer.size, layer.size):
+            color = nodes[i]
+            cx = i % layer.size
+            cy = i // layer.size
+            x = int(cx * cell_size) + offset_x
+            y = int(cy * cell_size) + offset_y
+            
+            # Extract RGB components
+            r = (color >> 16) & 0xFF
+            g = (color >> 8) & 0xFF
+            b = color & 0xFF
+            
+            pygame.draw.rect(
+                self.canvas,
+                (r, g, b),
+                (x, y, int(cell_size), int(cell_size))
+            )
+            
+        profiler.add('render.colors', time.perf_counter() - start)
+
+        # Draw payloads (only occupied cells of this layer)
+        for i, payload in matrix.layer_payloads(d).items():
+            if profiler.enabled:
+                start = time.perf_counter()
+            cx = i % layer.size
+            cy = i // layer.size
+            x = int(cx * cell_size) + offset_x
+            y = int(cy * cell_size) + offset_y
+            
+            if payload.get('type') == 'text':
+                text = payload.get('text', '')
+                color = payload.get('color', [0, 0, 0])
                 
-                # Extract RGB components
-                r = (color >> 16) & 0xFF
-                g = (color >> 8) & 0xFF
-                b = color & 0xFF
+                # Render text
+                font_size = int(cell_size * 0.3)
+                font = pygame.font.SysFont("Arial", max(12, min(font_size, 36)))
+                text_surf = font.render(text, True, color)
                 
-                pygame.draw.rect(
-                    self.canvas,
-                    (r, g, b),
-                    (x, y, int(cell_size), int(cell_size))
-                )
-            
-            # Draw payloads
-            key = f"{d}:{i}"
-            payload = matrix.payload_pool.get(key)
+                # Center text
+                text_rect = text_surf.get_rect(center=(
+                    x + cell_size/2,
+                    y + cell_size/2
+                ))
+                
+                self.canvas.blit(text_surf, text_rect)
             
-            if payload:
-                cx = i % layer.size
-                cy = i // layer.size
-                x = int(cx * cell_size) + offset_x
-                y = int(cy * cell_size) + offset_y
+            elif payload.get('type') == 'code':
+                code = payload.get('code', '')
                 
-                if payload.get('type') == 'text':
-                    text = payload.get('text', '')
-                    color = payload.get('color', [0, 0, 0])
-                    
-                    # Render text
-                    font_size = int(cell_size * 0.3)
-                    font = pygame.font.SysFont("Arial", max(12, min(font_size, 36)))
-                    text_surf = font.render(text, True, color)
+                if cell_size < 100:
+                    # Small cell, just show code symbol
+                    font_size = int(cell_size * 0.5)
+                    font = pygame.font.SysFont("Courier New", max(12, min(font_size, 36)), bold=True)
+                    text_surf = font.render("{ }", True, (51, 51, 51))
                     
                     # Center text
                     text_rect = text_surf.get_rect(center=(
@@ -1528,138 +4683,146 @@ class QuadtreeApp:
                     ))
                     
                     self.canvas.blit(text_surf, text_rect)
-                
-                elif payload.get('type') == 'code':
-                    code = payload.get('code', '')
-                    
-                    if cell_size < 100:
-                        # Small cell, just show code symbol
-                        font_size = int(cell_size * 0.5)
-                        font = pygame.font.SysFont("Courier New", max(12, min(font_size, 36)), bold=True)
-                        text_surf = font.render("{ }", True, (51, 51, 51))
-                        
-                        # Center text
-                        text_rect = text_surf.get_rect(center=(
-                            x + cell_size/2,
-                            y + cell_size/2
-                        ))
-                        
-                        self.canvas.blit(text_surf, text_rect)
-
-                        if self.hover_pos:
-                            hx, hy = self.hover_pos
-                            if SIDEBAR_WIDTH + x <= hx <= SIDEBAR_WIDTH + x + cell_size and y <= hy <= y + cell_size:
-                                preview = code.split('\n', 1)[0][:30]
-                                tip_font = FONT_MONO
-                                tip_surf = tip_font.render(preview, True, TEXT)
-                                bg_rect = tip_surf.get_rect()
-                                bg_rect.topleft = (x, y - bg_rect.height - 2)
-                                pygame.draw.rect(self.canvas, SURFACE, bg_rect)
-                                pygame.draw.rect(self.canvas, ACCENT, bg_rect, 1)
-                                self.canvas.blit(tip_surf, bg_rect)
-                    else:
-                        # --- clipping region (unchanged) ---
-                        cell_rect = pygame.Rect(x + 2, y + 2, cell_size - 4, cell_size - 4)
-                        old_clip  = self.canvas.get_clip()
-                        # ---------------- sizing constants (restore these!) ----------------
-                        code_lines     = code.split("\n")
-                        line_height    = min(cell_size * 0.09, 16)      # px per rendered row
-                        padding        = 8                               # top/left inset
-                        line_num_width = 20                              # gutter for numbers
-                        max_lines      = int((cell_size - 2*padding) / line_height)
-                        # -------------------------------------------------------------------
-
-                        self.canvas.set_clip(cell_rect)
-
-                        # --- background rectangles (unchanged) ---
-                        pygame.draw.rect(self.canvas, CODE_BG, (x + 2, y + 2, cell_size - 4, cell_size - 4))
-                        pygame.draw.rect(self.canvas, (234, 234, 234), (x + 2, y + 2, line_num_width, cell_size - 4))
-
-                        # --- wrapped code rendering ---
-                        font          = pygame.font.SysFont("Courier New", int(line_height * 0.75))
-                        line_idx      = 0
-                        y_pos         = y + padding
-                        for raw_line in code_lines:
-                            wrapped_segments = wrap_text(raw_line, font, cell_size - line_num_width - 10)
-                            for seg in wrapped_segments:
-                                if line_idx >= max_lines:          # vertical clip
-                                    break
-
-                                # line number
-                                ln_surf = font.render(str(line_idx + 1), True, CODE_NUM)
-                                self.canvas.blit(
-                                    ln_surf,
-                                    (x + line_num_width - 2 - ln_surf.get_width(), y_pos)
-                                )
-
-                                # code text
-                                code_surf = font.render(seg, True, (51, 51, 51))
-                                self.canvas.blit(
-                                    code_surf,
-                                    (x + line_num_width + 5, y_pos)
-                                )
-
-                                y_pos    += line_height
-                                line_idx += 1
-                            if line_idx >= max_lines:
+                else:
+                    # --- clipping region (unchanged) ---
+                    cell_rect = pygame.Rect(x + 2, y + 2, cell_size - 4, cell_size - 4)
+                    old_clip  = self.canvas.get_clip()
+                    # ---------------- sizing constants (restore these!) ----------------
+                    code_lines     = code.split("\n")
+                    line_height    = min(cell_size * 0.09, 16)      # px per rendered row
+                    padding        = 8                               # top/left inset
+                    line_num_width = 20                              # gutter for numbers
+                    max_lines      = int((cell_size - 2*padding) / line_height)
+                    # -------------------------------------------------------------------
+
+                    self.canvas.set_clip(cell_rect)
+
+                    # --- background rectangles (unchanged) ---
+                    pygame.draw.rect(self.canvas, CODE_BG, (x + 2, y + 2, cell_size - 4, cell_size - 4))
+                    pygame.draw.rect(self.canvas, (234, 234, 234), (x + 2, y + 2, line_num_width, cell_size - 4))
+
+                    # --- wrapped code rendering ---
+                    font          = pygame.font.SysFont("Courier New", int(line_height * 0.75))
+                    line_idx      = 0
+                    y_pos         = y + padding
+                    for raw_line in code_lines:
+                        wrapped_segments = wrap_text(raw_line, font, cell_size - line_num_width - 10)
+                        for seg in wrapped_segments:
+                            if line_idx >= max_lines:          # vertical clip
                                 break
 
-                        # --- overflow ellipsis ---
-                        if line_idx < len(code_lines):
-                            dots = font.render("⋯", True, (102, 102, 102))
+                            # line number
+                            ln_surf = font.render(str(line_idx + 1), True, CODE_NUM)
                             self.canvas.blit(
-                                dots,
-                                (x + cell_size / 2 - dots.get_width() / 2, y + cell_size - padding - line_height)
+                                ln_surf,
+                                (x + line_num_width - 2 - ln_surf.get_width(), y_pos)
                             )
 
-                        # --- restore previous clip ---
-                        self.canvas.set_clip(old_clip)
-
+                            # code text
+                            code_surf = font.render(seg, True, (51, 51, 51))
+                            self.canvas.blit(
+                                code_surf,
+                                (x + line_num_width + 5, y_pos)
+                            )
 
+                            y_pos    += line_height
+                            line_idx += 1
+                        if line_idx >= max_lines:
+                            break
 
-                
-                elif payload.get('type') == 'image':
-                    try:
-                        # Decode base64 image data
-                        img_data = base64.b64decode(payload.get('data', ''))
-                        img = Image.open(io.BytesIO(img_data))
-                        
-                        # Convert PIL Image to Pygame surface
-                        mode = img.mode
-                        size = img.size
-                        data = img.tobytes()
-                        
-                        img_surface = pygame.image.fromstring(data, size, mode)
-                        
-                        # Scale to fit cell
-                        img_surface = pygame.transform.scale(
-                            img_surface,
-                            (int(cell_size), int(cell_size))
+                    # --- overflow ellipsis ---
+                    if line_idx < len(code_lines):
+                        dots = font.render("⋯", True, (102, 102, 102))
+                        self.canvas.blit(
+                            dots,
+                            (x + cell_size / 2 - dots.get_width() / 2, y + cell_size - padding - line_height)
                         )
-                        
-                        # Draw image
-                        self.canvas.blit(img_surface, (x, y))
-                    except Exception as e:
-                        print(f"Error rendering image: {e}")
-        
-        # Draw grid lines
-        for i in range(layer.size + 1):
-            pos = int(i * cell_size) + offset_x
-            pygame.draw.line(
-                self.canvas,
-                GRID_COLOR,
-                (pos, offset_y),
-                (pos, offset_y + S)
-            )
+
+                    # --- restore previous clip ---
+                    self.canvas.set_clip(old_clip)
+
+
+
             
-            pos = int(i * cell_size) + offset_y
-            pygame.draw.line(
-                self.canvas,
-                GRID_COLOR,
-                (offset_x, pos),
-                (offset_x + S, pos)
-            )
+            elif payload.get('type') == 'image':
+                try:
+                    # Decode base64 image data
+                    img_data = base64.b64decode(payload.get('data', ''))
+                    img = Image.open(io.BytesIO(img_data))
+                    
+                    # Convert PIL Image to Pygame surface
+                    mode = img.mode
+                    size = img.size
+                    data = img.tobytes()
+                    
+                    img_surface = pygame.image.fromstring(data, size, mode)
+                    
+                    # Scale to fit cell
+                    img_surface = pygame.transform.scale(
+                        img_surface,
+                        (int(cell_size), int(cell_size))
+                    )
+                    
+                    # Draw image
+                    self.canvas.blit(img_surface, (x, y))
+                except Exception as e:
+                    print(f"Error rendering image: {e}")
+
+            if profiler.enabled:
+                profiler.add(f"render.{payload.get('type')}", time.perf_counter() - start)
+    
+        # Draw grid lines
+        with profiler.section('render.grid'):
+            self.canvas.blit(self.grid_surface(layer.size, S), (offset_x, offset_y))
+
+    def grid_surface(self, layer_size: int, S: int) -> pygame.Surface:
+        """Return the grid lines for a layer as a cached transparent surface"""
+        key = (layer_size, S, self.canvas.get_size())
+        if self.grid_cache is not None and self.grid_cache[0] == key:
+            return self.grid_cache[1]
+
+        cell_size = S / layer_size
+        grid = pygame.Surface((S + 1, S + 1), pygame.SRCALPHA)
+        for i in range(layer_size + 1):
+            pos = int(i * cell_size)
+            pygame.draw.line(grid, GRID_COLOR, (pos, 0), (pos, S))
+            pygame.draw.line(grid, GRID_COLOR, (0, pos), (S, pos))
+        self.grid_cache = (key, grid)
+        return grid
     
+    def update_hover(self, pos):
+        """Rebuild the code preview tooltip when the hovered cell changes"""
+        cell = self.get_cell_at_position(pos)
+        payload = None
+        if cell:
+            matrix = self.matrix.contexts[self.matrix.current_ctx]
+            payload = matrix.get_payload(*cell)
+        key = (self.matrix.current_ctx, cell, payload) if payload is not None else None
+        if key == self.hover_key:
+            return
+        self.hover_key = key
+        self.hover_tooltip = None
+        if payload is None or payload.get('type') != 'code':
+            return
+
+        S = matrix.quadtree_size
+        size = matrix.layers[cell[0]].size
+        cell_size = S / size
+        # Large code cells already show their source, so only small ones get a preview
+        if cell_size >= 100:
+            return
+        preview = payload.get('code', '').split('\n', 1)[0][:30]
+        tip_surf = FONT_MONO.render(preview, True, TEXT)
+        tooltip = pygame.Surface((tip_surf.get_width(), tip_surf.get_height()))
+        tooltip.fill(SURFACE)
+        tooltip.blit(tip_surf, (0, 0))
+        pygame.draw.rect(tooltip, ACCENT, tooltip.get_rect(), 1)
+
+        cy, cx = divmod(cell[1], size)
+        x = int(cx * cell_size) + (MAIN_WIDTH - S) // 2 + SIDEBAR_WIDTH
+        y = int(cy * cell_size) + (SCREEN_HEIGHT - S) // 2
+        self.hover_tooltip = (tooltip, (x, y - tooltip.get_height() - 2))
+
     def get_cell_at_position(self, pos):
         """Get cell coordinates at mouse position"""
         if not self.matrix.current_ctx:
@@ -1698,21 +4861,40 @@ class QuadtreeApp:
             code, language, cell = data
             if cell and self.matrix.current_ctx:
                 d, idx = cell
-                self.matrix.contexts[self.matrix.current_ctx].payload_pool[f"{d}:{idx}"] = {
-                    'type': 'code',
-                    'code': code,
-                    'language': language
-                }
+                matrix = self.matrix.contexts[self.matrix.current_ctx]
+                with matrix.edit('save_code'):
+                    matrix.set_payload(d, idx, {
+                        'type': 'code',
+                        'code': code,
+                        'language': language
+                    })
         
         elif action == 'execute':
             code, language = data
+            self.run_code(code, language)
+
+    def run_code(self, code, language):
+        """Start code in the background and show its output as it arrives"""
+        if self.running_job:
+            self.running_job.cancel()
+            self.running_job.wait()
+        try:
+            job = self.matrix.code_executor.start(code, language)
+        except Exception as e:
+            self.output_modal.show(f"Execution error: {str(e)}", False)
+            return
+        if job is None:
             success, output = self.matrix.code_executor.execute(code, language)
             self.output_modal.show(output, success)
+            return
+        self.running_job = job
+        self.output_modal.show(job.log, True, running=True)
     
-    def handle_events(self):
-        """Handle pygame events"""
+    def handle_events(self, pending=()):
+        """Handle pygame events (pending ones already taken off the queue first)"""
         mouse_pos = pygame.mouse.get_pos()
         self.hover_pos = mouse_pos
+        self.update_hover(mouse_pos)
 
         # Update hover state for UI elements before processing events
         for element in self.ui_elements:
@@ -1724,7 +4906,9 @@ class QuadtreeApp:
             self.context_menu.check_hover(mouse_pos)
 
         # Process the event queue
-        for event in pygame.event.get():
+        for event in [*pending, *pygame.event.get()]:
+            # Any input may change what is on screen
+            self.dirty = True
             if event.type == pygame.QUIT:
                 return False
 
@@ -1739,6 +4923,35 @@ class QuadtreeApp:
             if self.output_modal.handle_event(event):
                 continue # Event handled, move to next event
 
+            # Profiler overlay and trace export
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F2:
+                if event.mod & pygame.KMOD_SHIFT:
+                    self.export_profile_action()
+                else:
+                    self.profiler.enabled = not self.profiler.enabled
+                continue
+
+            # Toggle spilling of the layers that are not on screen
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                self.evict_hidden_layers = not self.evict_hidden_layers
+                self.status_text = f"Evict hidden layers: {'on' if self.evict_hidden_layers else 'off'}"
+                self.evict_hidden()
+                continue
+
+            # Undo / redo shortcuts (the code editor keeps its own keys)
+            if (event.type == pygame.KEYDOWN and event.mod & pygame.KMOD_CTRL
+                    and not self.code_editor.visible and self.matrix.current_ctx):
+                matrix = self.matrix.contexts[self.matrix.current_ctx]
+                if event.key == pygame.K_z and event.mod & pygame.KMOD_SHIFT:
+                    matrix.redo()
+                    continue
+                if event.key == pygame.K_z:
+                    matrix.undo()
+                    continue
+                if event.key == pygame.K_y:
+                    matrix.redo()
+                    continue
+
             # Handle context menu if it's active
             if self.context_menu:
                 action = self.context_menu.handle_event(event)
@@ -1770,9 +4983,12 @@ class QuadtreeApp:
                             self.size_input.text = str(self.quadtree_size)
                             self.max_depth = matrix.max_depth
                             self.depth_slider.max = self.max_depth
+                            self.update_context_buttons()
+                            self.evict_hidden()
 
                     elif element == self.depth_slider:
                         self.current_depth = result
+                        self.evict_hidden()
 
                     elif element == self.size_input:
                         try:
@@ -1799,8 +5015,63 @@ class QuadtreeApp:
         return True
     
     def update(self, dt):
-        """Update game state"""
-        pass
+        """Update game state and mark the window dirty if anything visible changed"""
+        finished = self.matrix.poll_background()
+        for kind, filepath, ctx_id, error in finished:
+            if error is not None:
+                print(f"Error during {kind} of {filepath}: {error}")
+            elif ctx_id:
+                self.context_paths[ctx_id] = filepath
+                self.select_context(ctx_id)
+        if finished:
+            pending = len(self.matrix.io_pending)
+            self.status_text = f"{pending} file(s) in progress..." if pending else ""
+            self.dirty = True
+        
+        for autosave in self.matrix.autosaves.values():
+            autosave.maybe_compact()
+
+        changed = self.matrix.poll_sessions()
+        if changed:
+            if self.matrix.current_ctx in changed:
+                self.dirty = True
+            self.update_context_buttons()
+        for ctx_id, client in self.matrix.sessions.items():
+            if client.errors:
+                self.status_text = f"{ctx_id} rejected an edit: {client.errors[-1]}"
+                client.errors.clear()
+                self.dirty = True
+
+        job = self.running_job
+        if job:
+            # Closing the output window stops the run
+            if not self.output_modal.visible:
+                job.cancel()
+            if job.poll() and job.log is self.output_modal.log:
+                self.output_modal.output_added()
+                self.dirty = True
+            if job.done:
+                if job.log is self.output_modal.log:
+                    self.output_modal.finish(job.success)
+                if job.log is not self.output_modal.log or not self.output_modal.visible:
+                    job.log.close()
+                self.running_job = None
+                self.dirty = True
+
+    def blinking(self):
+        """Whether a text cursor is on screen and needs periodic redraws"""
+        return (self.code_editor.visible or self.output_modal.search_input.active
+                or any(isinstance(e, TextInput) and e.active for e in self.ui_elements))
+
+    def wait_timeout(self):
+        """Milliseconds the loop may sleep without missing timed work (None = until input)"""
+        if self.running_job or self.matrix.io_pending or self.matrix.sessions:
+            return 50
+        if self.blinking():
+            return 250
+        if self.matrix.autosaves:
+            return 1000
+        return None
     
     def draw(self):
         """Draw the application"""
@@ -1827,6 +5098,11 @@ class QuadtreeApp:
             if element is not self.context_dropdown:
                 element.draw(self.screen)
 
+        # Draw background job status
+        if self.status_text:
+            status_surf = FONT_BASE.render(self.status_text, True, ACCENT)
+            self.screen.blit(status_surf, (10, SCREEN_HEIGHT - status_surf.get_height() - 10))
+
         # Draw the dropdown last so options appear on top
         self.context_dropdown.draw(self.screen)
         
@@ -1842,27 +5118,62 @@ class QuadtreeApp:
         
         # Draw canvas to screen
         self.screen.blit(self.canvas, (SIDEBAR_WIDTH, 0))
+
+        # Draw the hover tooltip as an overlay above the canvas
+        if self.hover_tooltip:
+            self.screen.blit(*self.hover_tooltip)
         
         # Draw context menu if active
         if self.context_menu:
             self.context_menu.draw(self.screen)
         
         # Draw modals on top if visible
-        self.code_editor.draw(self.screen)
-        self.output_modal.draw(self.screen)
+        with self.profiler.section('modals'):
+            self.code_editor.draw(self.screen)
+            self.output_modal.draw(self.screen)
+
+        if self.profiler.enabled:
+            self.profiler.draw(self.screen, (SCREEN_WIDTH - 10, 10))
         
         # Update display
-        pygame.display.flip()
+        with self.profiler.section('flip'):
+            pygame.display.flip()
     
     def run(self):
-        """Main game loop"""
+        """Main loop: sleep until input or a timer is due, redraw only when dirty"""
         running = True
         while running:
+            timeout = self.wait_timeout()
+            event = pygame.event.wait() if timeout is None else pygame.event.wait(timeout)
+            pending = [event] if event.type != pygame.NOEVENT else []
+            # Still cap the frame rate while input keeps arriving
             dt = self.clock.tick(60) / 1000.0
-            
-            running = self.handle_events()
-            self.update(dt)
-            self.draw()
+
+            self.profiler.begin_frame(ctx=self.matrix.current_ctx, depth=self.current_depth)
+            with self.profiler.section('handle_events'):
+                running = self.handle_events(pending)
+            with self.profiler.section('update'):
+                self.update(dt)
+            if self.dirty or self.blinking():
+                self.draw()
+                self.dirty = False
+                self.profiler.end_frame()
+            else:
+                self.profiler.discard_frame()
+        
+        # Fold any pending change logs into their snapshots
+        for ctx_id in list(self.matrix.autosaves):
+            self.matrix.disable_autosave(ctx_id)
+        for ctx_id in list(self.matrix.sessions):
+            self.matrix.leave_session(ctx_id)
+        if self.matrix.io_executor:
+            self.matrix.io_executor.shutdown()
+        if self.running_job:
+            self.running_job.cancel()
+            self.running_job.wait()
+        if self.matrix.code_executor.service:
+            self.matrix.code_executor.service.close()
+        self.output_modal.log.close()
 
 if __name__ == "__main__":
     app = QuadtreeApp()
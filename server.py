@@ -0,0 +1,596 @@
+"""Local HTTP/WebSocket server exposing QuadtreeMatrix contexts to nodes.html.
+
+The browser client fetches context metadata first and then only the
+layers and tiles it actually displays, so matrices far too large to ship
+as one JSON blob can still be viewed and edited:
+
+    GET  /                                        nodes.html
+    GET  /api/contexts                            list of context IDs
+    POST /api/contexts                            create {"id", "quadtree_size", "max_depth"}
+    GET  /api/contexts/<id>                       metadata (?hash=1 adds content_hash)
+    GET  /api/contexts/<id>/file                  full snapshot, as written by save_json
+    GET  /api/contexts/<id>/layers/<d>            one layer (?format=compressed|packed|plain)
+    GET  /api/contexts/<id>/layers/<d>/raw        little-endian uint32 nodes; honours Range
+    GET  /api/contexts/<id>/layers/<d>/payloads   payloads of one layer
+    GET  /api/contexts/<id>/layers/<d>/tiles/<tx>/<ty>?size=64
+                                                  nodes and payloads of one tile
+    GET  /ws/<id>                                 WebSocket channel for edit deltas
+
+Clients send edits on the WebSocket as JSON messages such as
+{"op": "set_color", "d": 3, "idx": 17, "color": 16711680}, or as absolute
+{"op": "records", "records": [...]} like the autosave change log uses.
+The server is the session coordinator: edits are applied one at a time,
+each gets the context's next sequence number, and the resulting records
+are broadcast to all clients of the context as
+{"type": "ops", "seq": ..., "client": ..., "client_seq": ..., "label": ...,
+ "ops": [[kind, depth, position, value], ...]}.
+Applying broadcasts in seq order makes every copy converge, with the
+highest-numbered write winning for each cell. A client learns its ID and
+the current seq from the {"type": "hello"} message sent on connect; the
+snapshot from /file carries the seq it reflects in X-Session-Seq.
+There is no shared undo: a client undoes its own edits by sending their
+inverse records like any other edit.
+
+Any web page the user visits could otherwise reach the server through
+the browser, so requests must name an allowed host in Host (against DNS
+rebinding), must come from the server's own origin if they carry an
+Origin header, and POST bodies must be sent as application/json.
+
+    python server.py [matrix.json ...] [--host 127.0.0.1] [--port 8765]
+                     [--allow-host NAME ...]
+
+Only the standard library is used on top of nodes.py.
+"""
+import argparse
+import contextlib
+import json
+import os
+import queue
+import re
+import socket
+import sys
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# The engine never opens a window here
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import nodes
+
+HTML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nodes.html")
+MAX_MESSAGE_BYTES = nodes.WS_MAX_MESSAGE_BYTES
+MAX_TILE_SIZE = 1024
+# Messages queued for one WebSocket before the client is considered stalled
+MAX_PENDING_MESSAGES = 1024
+LAYER_FORMATS = (nodes.LAYER_COMPRESSED, nodes.LAYER_PACKED, nodes.LAYER_PLAIN)
+
+
+class RequestError(Exception):
+    """An HTTP error response to send back to the client"""
+
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# --- Engine access ---
+
+def browser_payload_to_engine(payload: Any) -> Any:
+    """Convert a payload in nodes.html form (CSS colors, data URLs) to the engine's form"""
+    if not isinstance(payload, dict):
+        return payload
+    payload = dict(payload)
+    if payload.get("type") == "text" and "color" in payload:
+        payload["color"] = nodes._css_to_rgb(payload["color"])
+    elif payload.get("type") == "image" and isinstance(payload.get("data"), str) and payload["data"].startswith("data:"):
+        payload["data"] = payload["data"].split(",", 1)[-1]
+    elif payload.get("type") == "code":
+        payload.setdefault("language", "python")
+    return payload
+
+
+class Subscriber:
+    """A WebSocket client of a context channel with its own writer thread.
+
+    Broadcasts are queued while the server lock is held, so every client
+    receives them in order, and sent from the writer thread outside it.
+    A client that stops reading is disconnected once max_pending messages
+    are waiting, instead of stalling every other connection.
+    """
+
+    def __init__(self, ws: nodes.WebSocket, max_pending: int = MAX_PENDING_MESSAGES):
+        self.ws = ws
+        self.outbox: queue.Queue = queue.Queue(max_pending)
+        self.dropped = False
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def push(self, text: str) -> bool:
+        """Queue a message; returns False once the client has been dropped"""
+        if self.dropped:
+            return False
+        try:
+            self.outbox.put_nowait(text)
+        except queue.Full:
+            self.disconnect()
+            return False
+        return True
+
+    def push_json(self, message: Any) -> bool:
+        return self.push(json.dumps(message, separators=(",", ":")))
+
+    def _write(self):
+        while True:
+            text = self.outbox.get()
+            if text is None or self.dropped:
+                return
+            try:
+                self.ws.send(text)
+            except (OSError, nodes.WebSocketClosed):
+                self.disconnect()
+                return
+
+    def stop(self):
+        """Let the writer thread exit once it has sent what is already queued"""
+        with contextlib.suppress(queue.Full):
+            self.outbox.put_nowait(None)
+
+    def disconnect(self):
+        """Drop the client without waiting for a writer that may be blocked on it"""
+        self.dropped = True
+        if self.ws.sock is not None:
+            # Unblocks the writer's send and ends the handler's receive loop
+            with contextlib.suppress(OSError):
+                self.ws.sock.shutdown(socket.SHUT_RDWR)
+        self.stop()
+
+
+class MatrixServer(ThreadingHTTPServer):
+    """HTTP server sharing one QuadtreeMatrix engine between all requests.
+
+    Every engine access holds self.lock, so edits from different
+    connections are applied one at a time and broadcast in that order.
+    Nothing is written to a socket while the lock is held.
+    """
+
+    daemon_threads = True
+    verbose = False
+    max_pending_messages = MAX_PENDING_MESSAGES
+
+    def __init__(self, address: Tuple[str, int], engine: Optional[nodes.QuadtreeMatrix] = None):
+        super().__init__(address, EngineRequestHandler)
+        self.engine = engine if engine is not None else nodes.QuadtreeMatrix()
+        self.lock = threading.RLock()
+        # ctx_id -> Subscribers receiving its edits
+        self.channels: Dict[str, set] = {}
+        # ctx_id -> sequence number of the last edit broadcast
+        self.seq: Dict[str, int] = {}
+        self.next_client = 0
+        # Host names requests may address; more can be added for remote use
+        self.allowed_hosts = {"localhost", "127.0.0.1", "::1"}
+        if address[0] not in ("", "0.0.0.0", "::"):
+            self.allowed_hosts.add(address[0].lower())
+
+    def allowed_host(self, hostname: Optional[str], port: Optional[int]) -> bool:
+        """Whether hostname:port names this server"""
+        return hostname is not None and hostname.lower() in self.allowed_hosts and port == self.server_port
+
+    def matrix(self, ctx_id: str) -> nodes.Matrix:
+        if ctx_id not in self.engine.contexts:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"unknown context {ctx_id!r}")
+        matrix = self.engine.contexts[ctx_id]
+        if matrix.journal is None:
+            # Contexts reloaded after spilling come back without their history
+            matrix.journal = nodes.Journal()
+        return matrix
+
+    def layer_depth(self, matrix: nodes.Matrix, value: str) -> int:
+        d = int(value)
+        if not 0 <= d <= matrix.max_depth:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"depth {d} out of range 0..{matrix.max_depth}")
+        return d
+
+    def apply(self, ctx_id: str, message: Any, edit: Callable[[nodes.Matrix, Dict[str, Any]], None],
+              client: Optional[int] = None) -> List[Tuple[nodes.Edit, bool]]:
+        """Run edit on a context under the lock, broadcast and return the journal edits it produced"""
+        with self.lock:
+            matrix = self.matrix(ctx_id)
+            edits = []
+            listener = lambda e, undo: edits.append((e, undo))
+            matrix.journal.listeners.append(listener)
+            try:
+                edit(matrix, message)
+            finally:
+                matrix.journal.listeners.remove(listener)
+            for e, undo in edits:
+                self.seq[ctx_id] = self.seq.get(ctx_id, 0) + 1
+                self.broadcast(ctx_id, {"type": "ops", "seq": self.seq[ctx_id], "client": client,
+                                        "client_seq": message.get("client_seq"), "label": e.label,
+                                        "ops": e.records(undo)})
+        return edits
+
+    def subscribe(self, ctx_id: str, ws: nodes.WebSocket) -> Tuple[Subscriber, int]:
+        """Add ws to a context's channel, greet it and return its subscriber and client ID"""
+        subscriber = Subscriber(ws, self.max_pending_messages)
+        with self.lock:
+            self.next_client += 1
+            # Queued ahead of any broadcast with a higher seq
+            subscriber.push_json({"type": "hello", "client": self.next_client, "seq": self.seq.get(ctx_id, 0)})
+            self.channels.setdefault(ctx_id, set()).add(subscriber)
+            return subscriber, self.next_client
+
+    def unsubscribe(self, ctx_id: str, subscriber: Subscriber):
+        with self.lock:
+            subscribers = self.channels.get(ctx_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.channels[ctx_id]
+
+    def broadcast(self, ctx_id: str, message: Dict[str, Any]):
+        text = json.dumps(message, separators=(",", ":"))
+        for subscriber in list(self.channels.get(ctx_id, ())):
+            if not subscriber.push(text):
+                self.unsubscribe(ctx_id, subscriber)
+
+
+def _cell(matrix: nodes.Matrix, message: Dict[str, Any]) -> Tuple[int, int]:
+    d = nodes._check_int(message.get("d"), "d", 0, matrix.max_depth)
+    size = matrix.layers[d].size
+    idx = nodes._check_int(message.get("idx"), "idx", 0, size * size - 1)
+    return d, idx
+
+
+def edit_set_color(matrix: nodes.Matrix, message: Dict[str, Any]):
+    d, idx = _cell(matrix, message)
+    matrix.set_color(d, idx, nodes._check_int(message.get("color"), "color", 0, nodes.MAX_COLOR))
+
+
+def edit_set_payload(matrix: nodes.Matrix, message: Dict[str, Any]):
+    d, idx = _cell(matrix, message)
+    payload = browser_payload_to_engine(message.get("payload"))
+    nodes.validate_payload(payload, "payload")
+    matrix.set_payload(d, idx, payload)
+
+
+def edit_remove_payload(matrix: nodes.Matrix, message: Dict[str, Any]):
+    matrix.remove_payload(*_cell(matrix, message))
+
+
+def edit_reset(matrix: nodes.Matrix, message: Dict[str, Any]):
+    d, idx = _cell(matrix, message)
+    with matrix.edit("reset_cell"):
+        matrix.set_color(d, idx, 0)
+        matrix.remove_payload(d, idx)
+
+
+def edit_subdivide(matrix: nodes.Matrix, message: Dict[str, Any]):
+    d, idx = _cell(matrix, message)
+    if d < matrix.max_depth:
+        cy, cx = divmod(idx, matrix.layers[d].size)
+        matrix.subdivide_region(d, cx, cy, cx + 1, cy + 1, d + 1)
+
+
+def edit_records(matrix: nodes.Matrix, message: Dict[str, Any]):
+    """Apply absolute records made by a SessionClient's local journal as one edit"""
+    records = message.get("records")
+    if not isinstance(records, list):
+        raise nodes.MatrixFormatError("records: expected a list")
+    for i, record in enumerate(records):
+        where = f"records[{i}]"
+        if not isinstance(record, list) or len(record) != 4 or record[0] not in ("nodes", "payload"):
+            raise nodes.MatrixFormatError(f"{where}: expected [kind, depth, position, value]")
+        kind, d, pos, value = record
+        d = nodes._check_int(d, f"{where} depth", 0, matrix.max_depth)
+        cells = matrix.layers[d].size ** 2
+        if kind == "nodes":
+            if not isinstance(value, list):
+                raise nodes.MatrixFormatError(f"{where}: expected a list of colors")
+            nodes._check_int(pos, f"{where} position", 0, cells - len(value))
+            for color in value:
+                nodes._check_int(color, f"{where} color", 0, nodes.MAX_COLOR)
+        else:
+            nodes._check_int(pos, f"{where} position", 0, cells - 1)
+            if value is not None:
+                nodes.validate_payload(value, where)
+    with matrix.edit(str(message.get("label", "records"))):
+        matrix.apply_records(records)
+
+
+# WebSocket message op -> edit applied to the context
+EDIT_OPS: Dict[str, Callable[[nodes.Matrix, Dict[str, Any]], None]] = {
+    "set_color": edit_set_color,
+    "set_payload": edit_set_payload,
+    "remove_payload": edit_remove_payload,
+    "reset": edit_reset,
+    "subdivide": edit_subdivide,
+    "records": edit_records,
+}
+
+
+def parse_range(header: str, total: int) -> Optional[Tuple[int, int]]:
+    """Parse a single 'bytes=' Range header into a half-open (start, end) span.
+
+    Returns None when the header should be ignored (multiple ranges or an
+    unknown unit) and raises RequestError for unsatisfiable ranges.
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header)
+    if match is None or not (match.group(1) or match.group(2)):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last) + 1, total) if last else total
+    else:
+        start = max(total - int(last), 0)
+        end = total
+    if start >= total or start >= end:
+        raise RequestError(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, f"range not satisfiable for {total} bytes")
+    return start, end
+
+
+class EngineRequestHandler(BaseHTTPRequestHandler):
+    server: MatrixServer
+    protocol_version = "HTTP/1.1"
+
+    ROUTES = [
+        ("GET", re.compile(r"/"), "get_index"),
+        ("GET", re.compile(r"/nodes\.html"), "get_index"),
+        ("GET", re.compile(r"/api/contexts"), "get_contexts"),
+        ("POST", re.compile(r"/api/contexts"), "post_context"),
+        ("GET", re.compile(r"/api/contexts/([^/]+)"), "get_context"),
+        ("GET", re.compile(r"/api/contexts/([^/]+)/file"), "get_file"),
+        ("GET", re.compile(r"/api/contexts/([^/]+)/layers/(\d+)"), "get_layer"),
+        ("GET", re.compile(r"/api/contexts/([^/]+)/layers/(\d+)/raw"), "get_layer_raw"),
+        ("GET", re.compile(r"/api/contexts/([^/]+)/layers/(\d+)/payloads"), "get_layer_payloads"),
+        ("GET", re.compile(r"/api/contexts/([^/]+)/layers/(\d+)/tiles/(\d+)/(\d+)"), "get_tile"),
+        ("GET", re.compile(r"/ws/([^/]+)"), "websocket"),
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method: str):
+        url = urlsplit(self.path)
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            self.check_origin()
+            for route_method, pattern, name in self.ROUTES:
+                match = pattern.fullmatch(url.path)
+                if match and route_method == method:
+                    getattr(self, name)(*(unquote(g) for g in match.groups()))
+                    return
+            raise RequestError(HTTPStatus.NOT_FOUND, f"no route for {method} {url.path}")
+        except RequestError as e:
+            self.send_json({"error": str(e)}, e.status)
+        except (nodes.MatrixFormatError, ValueError) as e:
+            self.send_json({"error": str(e)}, HTTPStatus.BAD_REQUEST)
+
+    def check_origin(self):
+        """Reject requests addressed to another host or sent from another site's pages"""
+        # The request body, if any, is never read, so the connection cannot be reused
+        if not self.allowed_url("//" + self.headers.get("Host", "")):
+            self.close_connection = True
+            raise RequestError(HTTPStatus.FORBIDDEN, "unknown Host")
+        origin = self.headers.get("Origin")
+        # Browsers leave Origin out of same-origin navigation, and scripts send none
+        if origin is not None and not (origin.startswith("http://") and self.allowed_url(origin)):
+            self.close_connection = True
+            raise RequestError(HTTPStatus.FORBIDDEN, f"cross-origin request from {origin[:100]}")
+
+    def allowed_url(self, url: str) -> bool:
+        try:
+            parts = urlsplit(url)
+            return self.server.allowed_host(parts.hostname, parts.port or 80)
+        except ValueError:
+            return False
+
+    # --- Responses ---
+
+    def send_body(self, body: bytes, content_type: str, status: HTTPStatus = HTTPStatus.OK, headers: Dict[str, str] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_json(self, data: Any, status: HTTPStatus = HTTPStatus.OK, headers: Dict[str, str] = None):
+        self.send_body(nodes._json_dumps(data), "application/json", status, headers)
+
+    def read_json(self) -> Any:
+        # Browsers send text/plain cross-site without asking first; JSON needs a preflight
+        if self.headers.get_content_type() != "application/json":
+            self.close_connection = True
+            raise RequestError(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, "request body must be application/json")
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_MESSAGE_BYTES:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "request body too large")
+        try:
+            return json.loads(self.rfile.read(length) or b"null")
+        except ValueError as e:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"invalid JSON: {e}")
+
+    # --- Routes ---
+
+    def get_index(self):
+        with open(HTML_PATH, "rb") as f:
+            self.send_body(f.read(), "text/html; charset=utf-8")
+
+    def get_contexts(self):
+        with self.server.lock:
+            contexts = self.server.engine.get_context_list()
+        self.send_json({"contexts": contexts})
+
+    def post_context(self):
+        data = self.read_json()
+        if not isinstance(data, dict) or not isinstance(data.get("id"), str) or not data["id"]:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "expected {\"id\", \"quadtree_size\", \"max_depth\"}")
+        size = nodes._check_int(data.get("quadtree_size", 512), "quadtree_size", 1)
+        max_depth = nodes._check_int(data.get("max_depth", 6), "max_depth", 0, 16)
+        with self.server.lock:
+            if data["id"] in self.server.engine.contexts:
+                raise RequestError(HTTPStatus.CONFLICT, f"context {data['id']!r} already exists")
+            self.server.engine.create_new_context(data["id"], size, max_depth)
+        self.send_json({"id": data["id"]}, HTTPStatus.CREATED)
+
+    def get_context(self, ctx_id: str):
+        with self.server.lock:
+            matrix = self.server.matrix(ctx_id)
+            meta = {
+                "id": ctx_id,
+                "version": matrix.version,
+                "quadtree_size": matrix.quadtree_size,
+                "max_depth": matrix.max_depth,
+                "layers": [{"size": layer.size, "loaded": layer.loaded} for layer in matrix.layers],
+                "payload_counts": {str(d): len(cells) for d, cells in matrix.payloads.items()},
+            }
+            if self.query.get("hash") == "1":
+                meta["content_hash"] = matrix.content_hash()
+        self.send_json(meta)
+
+    def get_file(self, ctx_id: str):
+        with self.server.lock:
+            data = nodes.matrix_to_data(self.server.matrix(ctx_id))
+            seq = self.server.seq.get(ctx_id, 0)
+        self.send_json(data, headers={"Content-Disposition": f'attachment; filename="{ctx_id}.json"',
+                                      "X-Session-Seq": str(seq)})
+
+    def get_layer(self, ctx_id: str, d: str):
+        layer_format = self.query.get("format", nodes.LAYER_COMPRESSED)
+        if layer_format not in LAYER_FORMATS:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"format must be one of {', '.join(LAYER_FORMATS)}")
+        with self.server.lock:
+            matrix = self.server.matrix(ctx_id)
+            data = matrix.layers[self.server.layer_depth(matrix, d)].to_json(layer_format)
+        self.send_json(data)
+
+    def get_layer_raw(self, ctx_id: str, d: str):
+        with self.server.lock:
+            matrix = self.server.matrix(ctx_id)
+            layer = matrix.layers[self.server.layer_depth(matrix, d)]
+            total = 4 * layer.size * layer.size
+            span = parse_range(self.headers["Range"], total) if self.headers.get("Range") else None
+            start, end = span or (0, total)
+            # Only encode the nodes that overlap the requested bytes
+            first = start // 4
+            body = nodes._u32_bytes(layer.nodes[first:(end + 3) // 4])[start - 4 * first:end - 4 * first]
+        headers = {"Accept-Ranges": "bytes", "X-Layer-Size": str(layer.size)}
+        if span is None:
+            self.send_body(body, "application/octet-stream", headers=headers)
+        else:
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{total}"
+            self.send_body(body, "application/octet-stream", HTTPStatus.PARTIAL_CONTENT, headers)
+
+    def get_layer_payloads(self, ctx_id: str, d: str):
+        with self.server.lock:
+            matrix = self.server.matrix(ctx_id)
+            payloads = matrix.layer_payloads(self.server.layer_depth(matrix, d))
+            data = {str(idx): payload for idx, payload in payloads.items()}
+        self.send_json(data)
+
+    def get_tile(self, ctx_id: str, d: str, tx: str, ty: str):
+        tile = nodes._check_int(int(self.query.get("size", 64)), "size", 1, MAX_TILE_SIZE)
+        with self.server.lock:
+            matrix = self.server.matrix(ctx_id)
+            depth = self.server.layer_depth(matrix, d)
+            size = matrix.layers[depth].size
+            x0, y0 = int(tx) * tile, int(ty) * tile
+            if x0 >= size or y0 >= size:
+                raise RequestError(HTTPStatus.NOT_FOUND, f"tile ({tx}, {ty}) outside layer {depth}")
+            x1, y1 = min(x0 + tile, size), min(y0 + tile, size)
+            layer_nodes = matrix.layers[depth].nodes
+            tile_nodes = []
+            for y in range(y0, y1):
+                tile_nodes.extend(layer_nodes[y * size + x0:y * size + x1])
+            payloads = {str(idx): matrix.get_payload(depth, idx)
+                        for idx in matrix.payload_index(depth).iter_rect(x0, y0, x1, y1)}
+        self.send_json({"d": depth, "x0": x0, "y0": y0, "width": x1 - x0, "height": y1 - y0,
+                        "nodes": tile_nodes, "payloads": payloads})
+
+    def websocket(self, ctx_id: str):
+        with self.server.lock:
+            self.server.matrix(ctx_id)
+        key = self.headers.get("Sec-WebSocket-Key")
+        if "websocket" not in self.headers.get("Upgrade", "").lower() or not key:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "expected a WebSocket upgrade")
+        self.send_response(HTTPStatus.SWITCHING_PROTOCOLS)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", nodes.websocket_accept(key))
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        ws = nodes.WebSocket(self.rfile, self.wfile, sock=self.connection)
+        subscriber, client = self.server.subscribe(ctx_id, ws)
+        try:
+            while not subscriber.dropped:
+                text = ws.receive()
+                if text is None:
+                    break
+                self.handle_message(ctx_id, subscriber, client, text)
+        finally:
+            self.server.unsubscribe(ctx_id, subscriber)
+            subscriber.stop()
+            ws.close()
+
+    def handle_message(self, ctx_id: str, subscriber: Subscriber, client: int, text: str):
+        message = None
+        try:
+            message = json.loads(text)
+            if not isinstance(message, dict) or message.get("op") not in EDIT_OPS:
+                raise nodes.MatrixFormatError(f"unknown op; expected one of {', '.join(EDIT_OPS)}")
+            edits = self.server.apply(ctx_id, message, EDIT_OPS[message["op"]], client)
+            if not edits and "client_seq" in message:
+                # Nothing changed, so no broadcast will acknowledge it
+                subscriber.push_json({"type": "ack", "client_seq": message["client_seq"]})
+        except (ValueError, RequestError) as e:
+            client_seq = message.get("client_seq") if isinstance(message, dict) else None
+            subscriber.push_json({"type": "error", "message": str(e), "client_seq": client_seq, "request": text[:200]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve quadtree matrix contexts to nodes.html")
+    parser.add_argument("files", nargs="*", help="matrix JSON files to load as contexts")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--allow-host", action="append", default=[], metavar="NAME",
+                        help="also accept requests addressed to this host name (e.g. for LAN access)")
+    parser.add_argument("--memory-budget", type=int, default=1 << 30, help="bytes of context data kept resident")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    engine = nodes.QuadtreeMatrix(args.memory_budget)
+    for path in args.files:
+        if engine.load_json(path) is None:
+            sys.exit(f"could not load {path}")
+    if not args.files:
+        engine.create_new_context("default", 400, 4)
+
+    server = MatrixServer((args.host, args.port), engine)
+    server.verbose = args.verbose
+    server.allowed_hosts.update(name.lower() for name in args.allow_host)
+    print(f"Serving {', '.join(engine.get_context_list())} on http://{args.host}:{server.server_port}/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Round trips of matrix files between nodes.py and nodes.html.
+
+The browser side runs the loader functions from nodes.html under node,
+so these tests are skipped when node is not installed.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import nodes  # noqa: E402
+
+
+def browser_export(data):
+    """Load data the way nodes.html imports a file and return what its Export button writes"""
+    with open(os.path.join(ROOT, 'nodes.html'), encoding='utf-8') as f:
+        page = f.read()
+    start = page.index('// --- Matrix files written by nodes.py ---')
+    end = page.index('// --- UI Elements ---')
+    script = page[start:end] + '''
+    let input = '';
+    process.stdin.on('data', chunk => { input += chunk; });
+    process.stdin.on('end', async () => {
+      const matrix = await normalizeMatrix(JSON.parse(input));
+      process.stdout.write(JSON.stringify(matrix, null, 2));
+    });
+    '''
+    result = subprocess.run(['node', '-e', script], input=json.dumps(data), capture_output=True,
+                            text=True, check=True, timeout=60)
+    return json.loads(result.stdout)
+
+
+def sample_matrix():
+    matrix = nodes.Matrix(quadtree_size=256, max_depth=3,
+                          layers=[nodes.Layer(size=1 << d, nodes=[0] * (1 << d) ** 2) for d in range(4)])
+    matrix.set_color(2, 5, 0x336699)
+    matrix.set_color(3, 17, 0xFF8000)
+    matrix.set_payload(1, 0, {'type': 'text', 'text': 'hello', 'color': [255, 128, 0]})
+    matrix.set_payload(2, 3, {'type': 'image', 'data': 'iVBORw0KGgo='})
+    matrix.set_payload(3, 9, {'type': 'code', 'code': 'print(1)', 'language': 'python'})
+    return matrix
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason="node is not installed")
+@pytest.mark.parametrize('layer_format', [nodes.LAYER_PLAIN, nodes.LAYER_PACKED, nodes.LAYER_COMPRESSED])
+def test_python_file_survives_browser_export(layer_format):
+    matrix = sample_matrix()
+    exported = browser_export(nodes.matrix_to_data(matrix, layer_format))
+    assert exported['version'] == 1
+
+    loaded = nodes.matrix_from_data(exported)
+    assert loaded.quadtree_size == matrix.quadtree_size
+    assert loaded.max_depth == matrix.max_depth
+    for d in range(matrix.max_depth + 1):
+        assert list(loaded.layers[d].nodes) == list(matrix.layers[d].nodes)
+    assert loaded.payloads == matrix.payloads
+
+
+def test_browser_export_with_current_version_is_migrated():
+    # Written by pages that kept the version of the file they had loaded
+    data = {
+        'version': nodes.MATRIX_FORMAT_VERSION,
+        'quadtreeSize': 300,
+        'maxDepth': 1,
+        'layers': [{'size': 1, 'nodes': [0]}, {'size': 2, 'nodes': [1, 2, 3, 4]}],
+        'payloadPool': {
+            '1:0': {'type': 'text', 'text': 'x', 'color': 'rgb(255,128,0)'},
+            '1:1': {'type': 'image', 'data': 'data:image/png;base64,AAAA'},
+        },
+    }
+    matrix = nodes.matrix_from_data(data)
+    assert matrix.quadtree_size == 300
+    assert matrix.version == nodes.MATRIX_FORMAT_VERSION
+    assert matrix.payloads[1][0]['color'] == [255, 128, 0]
+    assert matrix.payloads[1][1]['data'] == 'AAAA'